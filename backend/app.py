@@ -1,22 +1,34 @@
 import os
+import json
 import time
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import logging
-from flask import Flask, jsonify, request, make_response
+from flask import Flask, Response, jsonify, request, make_response, stream_with_context
 from flask_cors import CORS
 
-#pip install --upgrade google-auth
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
-
-from pinecone.grpc import PineconeGRPC as Pinecone
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 
 
-from modules.articleCleaner import clean_article
-from modules.articleFetcher import fetchArticleById
-from modules.embeddingFuncs import generateQueryEmbedding
+from modules.admission import AdmissionController, OverloadedError
+from modules.answerCache import SemanticAnswerCache
+from modules.articleFetcher import getArticleCacheStats, getArticleFetchFlightStats
+from modules.auth import verifyToken, isStudentMediaAccount, getVerifiedTokenCacheStats
+from modules.contextBuilder import buildContext
+from modules.dateFilter import extractDateRange, buildDateFilter
+from modules.documentStore import DocumentStore
+from modules.embeddingCache import QueryEmbeddingCache, normalizeQuery
+from modules.embeddingFuncs import generateQueryEmbedding, generateQueryEmbeddings
+from modules.generation import HedgedGenerator
+from modules.metrics import (span, startRequest, finishRequest, currentRequest, deferRequest, finishDeferredRequest,
+                             registerCollector, renderMetrics)
+from modules.indexRegistry import UnknownIndexError, IndexNotReadyError
+from modules.lexicalIndex import LexicalIndex
+from modules.retrieval import createIndexRegistry, selectMatchesInRange
+from modules.singleFlight import SingleFlight
 
 app = Flask(__name__)
 log = logging.getLogger('werkzeug')
@@ -34,12 +46,46 @@ load_dotenv()
 GOOGLE_GENAI_API_KEY = os.getenv("GOOGLE_GENAI_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
+DOCUMENT_STORE_PATH = os.getenv("DOCUMENT_STORE_PATH", "./documents.db")
+# Where vectors are searched: "pinecone" or "local" (an exact in-process index, see modules/localIndex.py)
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "pinecone")
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "./local_index")
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE", "float32")
+# Leave empty to keep query embeddings in memory only
+QUERY_EMBEDDING_CACHE_PATH = os.getenv("QUERY_EMBEDDING_CACHE_PATH", "./query_embeddings.db")
+# How similar (cosine) two questions must be to share a cached answer
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+# Max (estimated) tokens of article text put in the prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+# Also search the article text by keyword (BM25) and fuse both result lists
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+# Vector matches less similar (cosine) than this are dropped
+MIN_MATCH_SCORE = float(os.getenv("MIN_MATCH_SCORE", "0.3"))
+# How much the picked articles trade relevance for variety (0 = pure score order)
+MMR_DIVERSITY = float(os.getenv("MMR_DIVERSITY", "0.3"))
+# Max number of questions in one /api/query_batch/ request
+MAX_BATCH_QUERIES = int(os.getenv("MAX_BATCH_QUERIES", "50"))
 
 # Configure the Google Generative AI library
 genai.configure(api_key=GOOGLE_GENAI_API_KEY)
 
-# Configure the Pinecone database
-pc = Pinecone(api_key=PINECONE_API_KEY)
+# Configure the vector database (validates index names and keeps one warm handle per index)
+index_registry = createIndexRegistry(RETRIEVAL_BACKEND,
+                                     pinecone_api_key=PINECONE_API_KEY,
+                                     local_index_path=LOCAL_INDEX_PATH,
+                                     local_index_dtype=LOCAL_INDEX_DTYPE)
+
+# Cleaned articles written by store.py/update.py (missing ones are fetched from wordpress)
+document_store = DocumentStore(DOCUMENT_STORE_PATH)
+
+# Keyword index over the same cleaned articles, filled by store.py/update.py
+lexical_index = LexicalIndex(DOCUMENT_STORE_PATH)
+
+# Repeated questions reuse their embedding instead of calling gemini again
+query_embedding_cache = QueryEmbeddingCache(db_path=QUERY_EMBEDDING_CACHE_PATH or None)
+
+# Near-duplicate questions reuse a previous answer (expires when update.py/store.py ingest new articles)
+answer_cache = SemanticAnswerCache(threshold=ANSWER_CACHE_THRESHOLD)
 
 generation_config = {
   "temperature": 1.5,
@@ -55,6 +101,13 @@ model = genai.GenerativeModel(
   generation_config=generation_config,
 )
 
+# Used when the main model is slow or fails (built once here instead of on every failure)
+fallback_model_name = "gemini-1.5-flash"
+fallback_model = genai.GenerativeModel(
+  model_name=fallback_model_name,
+  generation_config=generation_config,
+)
+
 # Safety Settings are currently set to MAX
 # See official documentation: https://ai.google.dev/gemini-api/docs/safety-settings?t
 safety_settings = {
@@ -65,7 +118,39 @@ safety_settings = {
     # HarmCategory.HARM_CATEGORY_UNSPECIFIED: HarmBlockThreshold.BLOCK_LOW_AND_ABOVE, # I'm not sure what this category is
 }
 
+# Number of distinct articles used as context
 NUM_ARTICLES_QUERY = 5
+# Each search returns more candidates than we keep (chunks of the same article are collapsed, then the picks diversified)
+NUM_CANDIDATES_QUERY = NUM_ARTICLES_QUERY * 4
+
+# Ask the fallback model too once the main model is slower than this percentile of its recent requests
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# Seconds before a response generation is given up on
+GENERATION_DEADLINE = float(os.getenv("GENERATION_DEADLINE", "30"))
+
+# Gemini calls allowed at the same time, more wait in a queue of GENERATION_QUEUE_SIZE for up to
+# GENERATION_QUEUE_TIMEOUT seconds. Beyond that requests are turned away (429/503 with Retry-After)
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "16"))
+GENERATION_QUEUE_SIZE = int(os.getenv("GENERATION_QUEUE_SIZE", "32"))
+GENERATION_QUEUE_TIMEOUT = float(os.getenv("GENERATION_QUEUE_TIMEOUT", "10"))
+
+admission = AdmissionController(max_in_flight=MAX_CONCURRENT_GENERATIONS,
+                                max_queue=GENERATION_QUEUE_SIZE,
+                                queue_timeout=GENERATION_QUEUE_TIMEOUT)
+
+generator = HedgedGenerator(primary_model=model,
+                            fallback_model=fallback_model,
+                            safety_settings=safety_settings,
+                            hedge_percentile=HEDGE_PERCENTILE,
+                            deadline=GENERATION_DEADLINE,
+                            admission=admission)
+
+# Identical questions (same index and normalized text) in flight at the same time share one answer
+query_flights = SingleFlight()
+
+# Runs the pinecone queries and generations of a batch request concurrently
+BATCH_WORKERS = 8
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="query-batch")
 
 print("----LOADED ENVIRONMENT VARIABLES----")
 
@@ -82,6 +167,18 @@ def get_message():
     except Exception as e:
         return jsonify({"message": f'Encountered Error {str(e)}'})
     
+@app.route('/api/cache_stats/')
+def cache_stats():
+    """
+    Cache counters (hits, misses, evictions, ...) used to tune cache sizes and TTLs
+    """
+    return jsonify({
+        "articles": getArticleCacheStats(),
+        "query_embeddings": query_embedding_cache.stats(),
+        "answers": answer_cache.stats(),
+        "verified_tokens": getVerifiedTokenCacheStats()
+    })
+
 """
 HANDLING USER AUTHENTICATION
 """
@@ -97,18 +194,15 @@ def login():
         return resp
 
     try:
-        # Verify the token using Google's OAuth2 library
-        id_info = id_token.verify_oauth2_token(TOKEN, google_requests.Request(), GOOGLE_CLIENT_ID)
+        # Verify the token using Google's OAuth2 library (cached until the token expires)
+        id_info = verifyToken(TOKEN, GOOGLE_CLIENT_ID)
 
         # Check if the email is verified and belongs to the correct domain
-        email = id_info.get('email')
-        email_verified = id_info.get('email_verified', False)
-
-        if email_verified and email.endswith("@media.ucla.edu"):
+        if isStudentMediaAccount(id_info):
             resp.status_code = 200
             resp = jsonify({
                 "name": id_info.get('name'),
-                "email": email
+                "email": id_info.get('email')
             })
             print("Login successful.")
         else:
@@ -121,189 +215,117 @@ def login():
     return resp
 
 """
-LIVE TIMING FUNCTIONS
+METRICS
 """
-timer_start_time = None
-timer_running = False
-timer_duration = 0
-timer_start_timeR = None
-timer_runningR = False
-timer_durationR = 0
-def timer():
-    """
-    Toggle timer function that starts/stops the timer.
-    Returns the timer's state and duration.
-    """
-    global timer_start_time, timer_running, timer_duration
-    
-    if not timer_running:
-        # Start the timer
-        timer_start_time = time.time()
-        timer_running = True
-        return jsonify({"status": "started"})
-    else:
-        # Stop the timer
-        timer_running = False
-        end_time = time.time()
-        timer_duration = end_time - timer_start_time
-        return jsonify({
-            "status": "stopped",
-            "duration": str(timer_duration)
-        })
-
-@app.route('/api/get_timer/')
-def get_timer():
-    global timer_start_time, timer_running, timer_duration
-    
-    if timer_start_time and timer_running:
-        current_time = time.time()
-        current_duration = current_time - timer_start_time
-        return jsonify({
-            "status": "running",
-            "duration": str(current_duration)
-        })
-    elif not timer_running and timer_start_time:
-        return jsonify({
-            "status": "stopped",
-            "duration": str(timer_duration)
-        })
-    else:
-        return jsonify({"status": "waiting"})
-    
-# Response Timer
-def timerR():
+@app.before_request
+def start_request_timer():
+    startRequest()
+
+@app.after_request
+def finish_request_timer(response):
+    route = request.url_rule.rule if request.url_rule else "unknown"
+    finishRequest(route, response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics():
     """
-    Toggle timer function that starts/stops the timer.
-    Returns the timer's state and duration.
+    Stage latency histograms, request counters and cache counters in the Prometheus text format
     """
-    global timer_start_timeR, timer_runningR, timer_durationR
-    
-    if not timer_runningR:
-        # Start the timer
-        timer_start_timeR = time.time()
-        timer_runningR = True
-        return jsonify({"status": "started"})
-    else:
-        # Stop the timer
-        timer_runningR = False
-        end_time = time.time()
-        timer_durationR = end_time - timer_start_timeR
-        return jsonify({
-            "status": "stopped",
-            "duration": str(timer_durationR)
-        })
-
-@app.route('/api/get_timerR/')
-def get_timerR():
-    global timer_start_timeR, timer_runningR, timer_durationR
-    
-    if timer_start_timeR and timer_runningR:
-        current_time = time.time()
-        current_duration = current_time - timer_start_time
-        return jsonify({
-            "status": "running",
-            "duration": str(current_duration)
-        })
-    elif not timer_runningR and timer_start_timeR:
-        return jsonify({
-            "status": "stopped",
-            "duration": str(timer_durationR)
-        })
-    else:
-        return jsonify({"status": "waiting"})
+    return Response(renderMetrics(), mimetype="text/plain; version=0.0.4")
 
-# Disable logging for these constant update functions
+def _prefixed(prefix: str, stats: dict) -> dict:
+    return {f"{prefix}_{name}": value for name, value in stats.items()}
+
+registerCollector(lambda: _prefixed("dbllm_article_cache", getArticleCacheStats()))
+registerCollector(lambda: _prefixed("dbllm_query_embedding_cache", query_embedding_cache.stats()))
+registerCollector(lambda: _prefixed("dbllm_answer_cache", answer_cache.stats()))
+registerCollector(lambda: _prefixed("dbllm_verified_token_cache", getVerifiedTokenCacheStats()))
+registerCollector(lambda: _prefixed("dbllm_generation", generator.stats()))
+registerCollector(lambda: _prefixed("dbllm_admission", admission.stats()))
+registerCollector(lambda: _prefixed("dbllm_query_flights", query_flights.stats()))
+registerCollector(lambda: _prefixed("dbllm_article_fetch_flights", getArticleFetchFlightStats()))
 
 """
 AUTHENTICATION HELPER FUNCTION USED IN QUERY ROUTE
 """
 def isAuthenticated(TOKEN: str) -> bool:
     try:
-        # Verify the token using Google's OAuth2 library
-        id_info = id_token.verify_oauth2_token(TOKEN, google_requests.Request(), GOOGLE_CLIENT_ID)
+        # Verify the token using Google's OAuth2 library (cached until the token expires)
+        id_info = verifyToken(TOKEN, GOOGLE_CLIENT_ID)
 
         # Check if the email is verified and belongs to the correct domain
-        email = id_info.get('email')
-        email_verified = id_info.get('email_verified', False)
-
-        if email_verified and email.endswith("@media.ucla.edu"):
-            return True
-        else:
-            return False
+        return isStudentMediaAccount(id_info)
     except ValueError as e:
         return False
     
-@app.route('/api/query/', methods=['GET'])
-def query():
-    if "token" not in request.args:
-        return jsonify({"response": "Unauthorized. Please sign in with a student media account."}), 401
-    
-    jwt_token = request.args.get('token')
-    if not isAuthenticated(jwt_token):
-        return jsonify({"response": "Unauthorized. Please sign in with a student media account."}), 401
-    
-    DATABASE_INDEX_NAME = request.args.get('index')
-    EMBEDDING_MODEL = "models/text-embedding-004"
-
-    if DATABASE_INDEX_NAME not in pc.list_indexes().names():
-        print("Invalid index name. Exiting.")
-        exit()
-
-    while not pc.describe_index(DATABASE_INDEX_NAME).status['ready']:
-        time.sleep(1)
+"""
+QUERY HELPER FUNCTIONS SHARED BY THE QUERY ROUTES
+"""
+@app.errorhandler(UnknownIndexError)
+def unknown_index(e):
+    return jsonify({"error": "Invalid index name"}), 404
 
-    index = pc.Index(DATABASE_INDEX_NAME)
+@app.errorhandler(IndexNotReadyError)
+def index_not_ready(e):
+    return jsonify({"error": "Index is not ready yet. Please try again later."}), 503
 
-    # Start query timer
-    t0_query = time.time()
-    user_query = request.args.get('query')
-    if not user_query:
-        return jsonify({"error": "No query parameter provided"}), 400
+@app.errorhandler(OverloadedError)
+def overloaded(e):
+    print(e)
+    return (jsonify({"response": "Oliver is helping too many people right now. Please try again shortly."}),
+            e.status_code,
+            {"Retry-After": str(e.retry_after)})
 
-    embedding = generateQueryEmbedding(genai=genai,
-                                       embedding_model=EMBEDDING_MODEL,
-                                       query=user_query)
+EMBEDDING_MODEL = "models/text-embedding-004"
 
-    results = index.query(
-        vector=embedding,
-        top_k=NUM_ARTICLES_QUERY,
-        include_values=False,
-        include_metadata=True
-    )
-    t1_query = time.time()
-    query_time = round(t1_query - t0_query, 2)
-    print(f'Querying took ~{query_time} seconds.')
-    """ 
-    /////////////////////////////////
-    //////  Generate Response
-    /////////////////////////////////
+def retrieve(index, user_query: str):
     """
+    Embed the query and find the closest articles
 
-    print("\n----GENERATING RESPONSE----")
-    
-    t0_response = time.time() # start timer for generating response
-    timerR()
-    # Generate context for the response
-    context = ""
-
-    for result in results['matches']:
-        # Get ID (incase it's a chunk, only get whatever is before '_')
-        # ex: if id="18352_chunk0", we only want id="18352"
-        id = result['id'].split('_')[0]
-
-        # Get article
-        article = fetchArticleById(id)
+    @return: A tuple (query embedding, pinecone query results)
+    """
+    with span("query_embedding"):
+        embedding = generateQueryEmbedding(genai=genai,
+                                           embedding_model=EMBEDDING_MODEL,
+                                           query=user_query,
+                                           cache=query_embedding_cache)
 
-        # Clean article
-        cleanedArticle = clean_article(article)
+    return embedding, searchArticles(index, embedding, user_query)
 
-        # Add context to feed into LLM
-        link = result['metadata']['link']
-        context += f"""\nARTICLE START (Source: {link})\n
-        {cleanedArticle}
-        \nARTICLE END\n
-        """
+def searchArticles(index, embedding, user_query: str) -> dict:
+    """
+    Find the NUM_ARTICLES_QUERY distinct articles to use as context: the vector index is over-fetched
+    (restricted to the dates the question mentions, if any), fused with a BM25 keyword search of the
+    question if HYBRID_SEARCH is on, then narrowed down by selectMatchesInRange
 
+    @param embedding: The query embedding
+    @return: Query results holding only the picked matches
+    """
+    def search(date_range):
+        with span("pinecone_query"):
+            # The vectors are used to diversify the picked articles
+            vector_matches = index.query(vector=embedding,
+                                         top_k=NUM_CANDIDATES_QUERY,
+                                         filter=buildDateFilter(date_range),
+                                         include_values=True,
+                                         include_metadata=True)['matches']
+
+        keyword_matches = None
+        if HYBRID_SEARCH:
+            with span("keyword_query"):
+                keyword_matches = lexical_index.search(user_query, top_k=NUM_CANDIDATES_QUERY, date_range=date_range)
+        return vector_matches, keyword_matches
+
+    # Vectors stored before dates were added to the metadata can't pass the date filter, the search
+    # is widened to every date rather than answering from too few articles
+    matches = selectMatchesInRange(search, extractDateRange(user_query),
+                                   top_k=NUM_ARTICLES_QUERY,
+                                   min_score=MIN_MATCH_SCORE,
+                                   diversity=MMR_DIVERSITY)
+    return {"matches": matches}
+
+def buildInstructions(user_query: str, context: str) -> str:
     instructions = f"""
     # Who You Are:
     You are an advanced RAG LLM named Oliver, serving the UCLA Daily Bruin Newspaper.
@@ -341,38 +363,330 @@ def query():
     - ...as detailed in this [article](https://dailybruin.com/2024/05/03/daily-bruin-print-issue-may-3/)
     - The Daily Bruin also had a TV program that became [Daily Bruin Video](https://dailybruin.com/2009/09/20/prodvideo/).
     """
+    return instructions
+
+def withTimings(response: dict) -> dict:
+    """
+    Add the per-stage time breakdown of this request to the response if the client asked for it (?timings=true)
+    """
+    if request.args.get('timings') == 'true' and currentRequest() is not None:
+        response["timings"] = currentRequest().timings()
+    return response
+
+@app.route('/api/query/', methods=['GET'])
+def query():
+    if "token" not in request.args:
+        return jsonify({"response": "Unauthorized. Please sign in with a student media account."}), 401
     
-    # Generate response 
-    # model = genai.GenerativeModel("gemini-2.0-flash-exp")
-    try:
-        response = model.generate_content(
-            instructions,
-            safety_settings=safety_settings
-        )
-        t1_response = time.time()
-        response_time = round(t1_response - t0_response, 2)
-        return jsonify({
-            "response": response.text,
+    jwt_token = request.args.get('token')
+    with span("auth"):
+        authenticated = isAuthenticated(jwt_token)
+    if not authenticated:
+        return jsonify({"response": "Unauthorized. Please sign in with a student media account."}), 401
+    
+    DATABASE_INDEX_NAME = request.args.get('index')
+    index = index_registry.get_index(DATABASE_INDEX_NAME)
+
+    user_query = request.args.get('query')
+    if not user_query:
+        return jsonify({"error": "No query parameter provided"}), 400
+
+    # The same question asked by many people at once (ex: breaking news) is only answered once,
+    # everyone asking while it's being answered gets that answer
+    response, status_code, answered_by = query_flights.do((DATABASE_INDEX_NAME, normalizeQuery(user_query)),
+                                                          answerQuery, DATABASE_INDEX_NAME, index, user_query)
+    # The response is shared, don't add this request's timings to everyone's copy
+    return jsonify(withTimings(sharedResponse(response, answered_by))), status_code
+
+def sharedResponse(response: dict, answered_by) -> dict:
+    """
+    Copy a response that may have been answered for another request (see query_flights). If it was,
+    it's marked as coalesced and this request's timings get the stages of the request that answered it
+    """
+    response = dict(response)
+    response["coalesced"] = answered_by is not currentRequest()
+    if response["coalesced"] and currentRequest() is not None:
+        currentRequest().adopt(answered_by)
+    return response
+
+def answerQuery(index_name: str, index, user_query: str, embedding=None) -> tuple:
+    """
+    Retrieve articles for a question and generate the answer
+
+    @param embedding: The question's embedding, if it's already known (ex: embedded with the rest of a batch)
+    @return: A tuple (response body, status code, RequestTimer of the request that answered it)
+    """
+    # Start query timer
+    t0_query = time.time()
+
+    if embedding is None:
+        embedding, results = retrieve(index, user_query)
+    else:
+        results = searchArticles(index, embedding, user_query)
+    t1_query = time.time()
+    query_time = round(t1_query - t0_query, 2)
+    print(f'Querying took ~{query_time} seconds.')
+    """ 
+    /////////////////////////////////
+    //////  Generate Response
+    /////////////////////////////////
+    """
+
+    print("\n----GENERATING RESPONSE----")
+    
+    t0_response = time.time() # start timer for generating response
+
+    # Paraphrases of a recent question that retrieved the same articles get the same answer
+    article_ids = [match['id'] for match in results['matches']]
+    corpus_version = document_store.get_corpus_version()
+    cached_answer = answer_cache.get(index_name, embedding, article_ids, corpus_version)
+    if cached_answer is not None:
+        response_time = round(time.time() - t0_response, 2)
+        return {
+            "response": cached_answer,
             "query_time": query_time,
-            "response_time": response_time
-        })
-    except Exception as e:
+            "response_time": response_time,
+            "model": None,
+            "hedged": False,
+            "cached": True
+        }, 200, currentRequest()
+
+    # Generate context for the response
+    context = buildContext(results['matches'],
+                           document_store=document_store,
+                           token_budget=CONTEXT_TOKEN_BUDGET)
+    with span("prompt_build"):
+        instructions = buildInstructions(user_query, context)
+    
+    # Generate response (hedged with the fallback model if the main model is slow or fails,
+    # as long as a slot is free for it)
+    try:
+        with span("admission_wait"):
+            acquired_at = admission.acquire()
+        # The generator gives the slot back once the model call holding it is done
+        with span("generation"):
+            generation = generator.generate(instructions, slot=acquired_at)
+    except TimeoutError as e:
         print(e)
-        model_old = genai.GenerativeModel(
-            model_name="gemini-1.5-flash",
-            generation_config=generation_config,
-        )
-        response = model_old.generate_content(
-            instructions,
-            safety_settings=safety_settings
-        )
-        t1_response = time.time()
-        response_time = round(t1_response - t0_response, 2)
-        return jsonify({
-            "response": response.text,
+        return {"response": "Oliver took too long to respond. Please try again."}, 504, currentRequest()
+    response_text = generation["text"]
+
+    # Save the answer for near-duplicate questions
+    answer_cache.put(index_name, embedding, article_ids, corpus_version, response_text)
+
+    t1_response = time.time()
+    response_time = round(t1_response - t0_response, 2)
+    return {
+        "response": response_text,
+        "query_time": query_time,
+        "response_time": response_time,
+        "model": generation["model"],
+        "hedged": generation["hedged"],
+        "cached": False
+    }, 200, currentRequest()
+
+"""
+BATCH QUERY ROUTE
+"""
+def parseBatchQueries(data: dict):
+    """
+    @return: The list of questions in a batch request body, or None if it isn't a valid list
+    """
+    queries = data.get('queries')
+    if not isinstance(queries, list) or not queries:
+        return None
+    if not all(isinstance(user_query, str) and user_query.strip() for user_query in queries):
+        return None
+    return queries
+
+@app.route('/api/query_batch/', methods=['POST'])
+def query_batch():
+    """
+    Answer several questions in one request. The body is JSON: {"token": ..., "index": ..., "queries": [...]}
+
+    All questions are embedded with one batched gemini call, then answered concurrently by answerQuery.
+    A question asked twice (after normalizing) is answered once, and a question that is already being
+    answered (for /api/query/ or another batch) shares that answer, see query_flights. An article matched
+    by several questions is only fetched once (see fetchArticleById).
+    Returns one entry per question, in order, with either a "response" or an "error".
+    """
+    data = request.get_json(silent=True) or {}
+
+    with span("auth"):
+        authenticated = bool(data.get('token')) and isAuthenticated(data['token'])
+    if not authenticated:
+        return jsonify({"response": "Unauthorized. Please sign in with a student media account."}), 401
+
+    DATABASE_INDEX_NAME = data.get('index')
+    index = index_registry.get_index(DATABASE_INDEX_NAME)
+
+    queries = parseBatchQueries(data)
+    if queries is None:
+        return jsonify({"error": "queries must be a non-empty list of questions"}), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return jsonify({"error": f"At most {MAX_BATCH_QUERIES} queries can be sent at once"}), 400
+
+    # Start query timer
+    t0_query = time.time()
+
+    # The same question asked twice (after normalizing) is only answered once
+    unique_queries = {}
+    for user_query in queries:
+        unique_queries.setdefault(normalizeQuery(user_query), user_query)
+
+    with span("query_embedding"):
+        embeddings = generateQueryEmbeddings(genai=genai,
+                                             embedding_model=EMBEDDING_MODEL,
+                                             queries=list(unique_queries.values()),
+                                             cache=query_embedding_cache)
+    query_time = round(time.time() - t0_query, 2)
+
+    t0_response = time.time()
+
+    def answer(user_query: str, embedding) -> dict:
+        if embedding is None:
+            return {"query": user_query, "error": "Could not embed this query."}
+        # Shares the answer with the same question being asked on /api/query/ (or in another batch) at the same time
+        try:
+            response, status_code, answered_by = query_flights.do((DATABASE_INDEX_NAME, normalizeQuery(user_query)),
+                                                                  answerQuery, DATABASE_INDEX_NAME, index, user_query,
+                                                                  embedding)
+        except OverloadedError as e:
+            print(e)
+            return {"query": user_query, "error": "Oliver is helping too many people right now. Please try again shortly.",
+                    "retry_after": e.retry_after}
+        except Exception as e:
+            print(e)
+            return {"query": user_query, "error": "An error occurred while generating the response."}
+        return batchEntry(user_query, sharedResponse(response, answered_by), status_code)
+
+    # Each question runs in a copy of this request's context, so its stages count towards the batch's timings
+    futures = [batch_executor.submit(contextvars.copy_context().run, answer, user_query, embedding)
+               for user_query, embedding in zip(unique_queries.values(), embeddings)]
+    entries = dict(zip(unique_queries, (future.result() for future in futures)))
+
+    return jsonify(withTimings({
+        "answers": [dict(entries[normalizeQuery(user_query)], query=user_query) for user_query in queries],
+        "query_time": query_time,
+        "response_time": round(time.time() - t0_response, 2)
+    }))
+
+def batchEntry(user_query: str, response: dict, status_code: int) -> dict:
+    """
+    @param response: A response body from answerQuery
+    @return: The question's entry in a batch response, with either a "response" or an "error"
+    """
+    if status_code != 200:
+        return {"query": user_query, "error": response["response"]}
+    return {"query": user_query, **response}
+
+"""
+STREAMING QUERY ROUTE
+"""
+def serverSentEvent(event: str, data: dict) -> str:
+    """
+    Format one server-sent event
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/query_stream/', methods=['GET'])
+def query_stream():
+    """
+    Same as /api/query/, but the answer is streamed as server-sent events while gemini generates it:
+        metadata - the sources used and query_time (sent before generation starts)
+        token    - a piece of the answer text
+        error    - generation failed part way through
+        done     - query_time, response_time and time_to_first_token (and the stage timings with ?timings=true)
+    """
+    if "token" not in request.args:
+        return jsonify({"response": "Unauthorized. Please sign in with a student media account."}), 401
+    
+    jwt_token = request.args.get('token')
+    with span("auth"):
+        authenticated = isAuthenticated(jwt_token)
+    if not authenticated:
+        return jsonify({"response": "Unauthorized. Please sign in with a student media account."}), 401
+    
+    DATABASE_INDEX_NAME = request.args.get('index')
+    index = index_registry.get_index(DATABASE_INDEX_NAME)
+
+    # Start query timer
+    t0_query = time.time()
+    user_query = request.args.get('query')
+    if not user_query:
+        return jsonify({"error": "No query parameter provided"}), 400
+
+    embedding, results = retrieve(index, user_query)
+    query_time = round(time.time() - t0_query, 2)
+
+    article_ids = [match['id'] for match in results['matches']]
+    corpus_version = document_store.get_corpus_version()
+    cached_answer = answer_cache.get(DATABASE_INDEX_NAME, embedding, article_ids, corpus_version)
+
+    # Turn the request away before the stream starts (and the status code is sent) if gemini is overloaded.
+    # The stream gives the slot back once the model calls are done (or the response is closed before it started)
+    stream = None
+    if cached_answer is None:
+        with span("admission_wait"):
+            stream = generator.stream(slot=admission.acquire())
+
+    # The stages of the stream are timed as it runs, the request is only recorded once it's closed
+    timer = deferRequest(request.url_rule.rule, 200)
+    send_timings = request.args.get('timings') == 'true'
+
+    def generate():
+        t0_response = time.time()
+
+        # Send retrieval info right away, before waiting on gemini
+        sources = [match['metadata']['link'] for match in results['matches']]
+        yield serverSentEvent("metadata", {"sources": sources, "query_time": query_time})
+
+        response_text = cached_answer
+        time_to_first_token = None
+
+        if response_text is not None:
+            time_to_first_token = round(time.time() - t0_response, 2)
+            yield serverSentEvent("token", {"text": response_text})
+        else:
+            context = buildContext(results['matches'],
+                           document_store=document_store,
+                           token_budget=CONTEXT_TOKEN_BUDGET)
+            with span("prompt_build"):
+                instructions = buildInstructions(user_query, context)
+
+            response_text = ""
+            try:
+                # Hedged with the fallback model until the first chunk arrives, like /api/query/
+                with span("generation"), contextlib.closing(stream.texts(instructions)) as texts:
+                    for text in texts:
+                        if time_to_first_token is None:
+                            time_to_first_token = round(time.time() - t0_response, 2)
+                        response_text += text
+                        yield serverSentEvent("token", {"text": text})
+
+                # Only cache complete answers
+                answer_cache.put(DATABASE_INDEX_NAME, embedding, article_ids, corpus_version, response_text)
+            except Exception as e:
+                print(e)
+                yield serverSentEvent("error", {"message": "An error occurred while generating the response."})
+
+        done = {
             "query_time": query_time,
-            "response_time": response_time
-        })
+            "response_time": round(time.time() - t0_response, 2),
+            "time_to_first_token": time_to_first_token
+        }
+        if send_timings and timer is not None:
+            done["timings"] = timer.timings()
+        yield serverSentEvent("done", done)
+
+    response = Response(stream_with_context(generate()),
+                        mimetype="text/event-stream",
+                        # Don't let proxies buffer the stream
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    if stream is not None:
+        response.call_on_close(stream.close)
+    response.call_on_close(lambda: finishDeferredRequest(timer))
+    return response
 
 
 if __name__ == '__main__':
@@ -0,0 +1,444 @@
+"""
+Async version of the query pipeline, served by an ASGI server instead of a thread per request:
+hypercorn asgi:app --bind 0.0.0.0:5001
+
+Models, caches and the index registry are shared with app.py, so both servers behave the same
+and return the same JSON.
+"""
+
+import re
+import time
+import asyncio
+import contextlib
+
+import httpx
+from quart import Quart, Response, jsonify, request
+from quart_cors import cors
+
+# Reuse everything app.py configured (models, caches, index registry, prompt)
+import app as shared
+from modules.admission import OverloadedError
+from modules.articleFetcher import CONNECTION_POOL_SIZE, getArticleCacheStats
+from modules.auth import verifyToken, isStudentMediaAccount, getVerifiedTokenCacheStats
+from modules.contextBuilder import buildContextAsync
+from modules.embeddingCache import normalizeQuery
+from modules.embeddingFuncs import generateQueryEmbeddingAsync, generateQueryEmbeddingsAsync
+from modules.indexRegistry import UnknownIndexError, IndexNotReadyError
+from modules.metrics import (span, startRequest, finishRequest, currentRequest, deferRequest, finishDeferredRequest,
+                             renderMetrics)
+from modules.singleFlight import SingleFlight
+
+app = Quart(__name__)
+# Same as flask-cors' supports_credentials: reflect any origin
+app = cors(app, allow_origin=re.compile(".*"), allow_credentials=True)
+
+# Identical questions embedded at the same time share one embedding call
+embedding_flights = SingleFlight()
+
+# One pooled client for every wordpress request made by this process
+wordpress_client = None
+
+@app.before_serving
+async def open_wordpress_client():
+    global wordpress_client
+    wordpress_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=CONNECTION_POOL_SIZE,
+                                                             max_keepalive_connections=CONNECTION_POOL_SIZE))
+
+@app.after_serving
+async def close_wordpress_client():
+    await wordpress_client.aclose()
+
+@app.before_request
+async def start_request_timer():
+    startRequest()
+
+@app.after_request
+async def finish_request_timer(response):
+    route = request.url_rule.rule if request.url_rule else "unknown"
+    finishRequest(route, response.status_code)
+    return response
+
+@app.route('/metrics')
+async def metrics():
+    # Same registry (and collectors) as app.py
+    return Response(renderMetrics(), mimetype="text/plain; version=0.0.4")
+
+@app.errorhandler(UnknownIndexError)
+async def unknown_index(e):
+    return jsonify({"error": "Invalid index name"}), 404
+
+@app.errorhandler(IndexNotReadyError)
+async def index_not_ready(e):
+    return jsonify({"error": "Index is not ready yet. Please try again later."}), 503
+
+@app.errorhandler(OverloadedError)
+async def overloaded(e):
+    print(e)
+    return (jsonify({"response": "Oliver is helping too many people right now. Please try again shortly."}),
+            e.status_code,
+            {"Retry-After": str(e.retry_after)})
+
+@app.route('/api/get_message/')
+async def get_message():
+    try:
+        response = await shared.model.generate_content_async(
+            "type 'hi'",
+        )
+        if response.text:
+            return jsonify({"message": 'Connection Successful', "model": shared.model_name})
+        else:
+            return jsonify({"message": "Unknown Error."})
+    except Exception as e:
+        return jsonify({"message": f'Encountered Error {str(e)}'})
+
+@app.route('/api/login/', methods=['POST'])
+async def login():
+    data = await request.get_json()
+    TOKEN = data.get('token') if data else None
+
+    if not TOKEN:
+        print("No token provided.")
+        return "Response", 400
+
+    try:
+        id_info = await asyncio.to_thread(verifyToken, TOKEN, shared.GOOGLE_CLIENT_ID)
+    except ValueError as e:
+        print(f"Invalid token: {e}")
+        return "Response", 401
+
+    if not isStudentMediaAccount(id_info):
+        print("Login unsuccessful. Not a student media email or email not verified.")
+        return "Response", 401
+
+    print("Login successful.")
+    return jsonify({
+        "name": id_info.get('name'),
+        "email": id_info.get('email')
+    })
+
+@app.route('/api/cache_stats/')
+async def cache_stats():
+    return jsonify({
+        "articles": getArticleCacheStats(),
+        "query_embeddings": shared.query_embedding_cache.stats(),
+        "answers": shared.answer_cache.stats(),
+        "verified_tokens": getVerifiedTokenCacheStats()
+    })
+
+async def timed(stage: str, awaitable):
+    """
+    Await something inside a metrics span (so it can be wrapped in a task and still be timed)
+    """
+    with span(stage):
+        return await awaitable
+
+def withTimings(response: dict) -> dict:
+    """
+    Add the per-stage time breakdown of this request to the response if the client asked for it (?timings=true)
+    """
+    if request.args.get('timings') == 'true' and currentRequest() is not None:
+        response["timings"] = currentRequest().timings()
+    return response
+
+@app.route('/api/query/', methods=['GET'])
+async def query():
+    if "token" not in request.args:
+        return jsonify({"response": "Unauthorized. Please sign in with a student media account."}), 401
+
+    jwt_token = request.args.get('token')
+    DATABASE_INDEX_NAME = request.args.get('index')
+    user_query = request.args.get('query')
+
+    # Start query timer
+    t0_query = time.time()
+
+    # Verifying the token and embedding the query don't depend on each other, so run them at the same time
+    auth_task = asyncio.create_task(timed("auth", asyncio.to_thread(shared.isAuthenticated, jwt_token)))
+    embedding_task = None
+    if user_query:
+        # Identical questions asked at the same time share the embedding call too
+        embedding_task = asyncio.create_task(timed("query_embedding",
+                                                   embedding_flights.do_async(normalizeQuery(user_query),
+                                                                              generateQueryEmbeddingAsync,
+                                                                              genai=shared.genai,
+                                                                              embedding_model=shared.EMBEDDING_MODEL,
+                                                                              query=user_query,
+                                                                              cache=shared.query_embedding_cache)))
+
+    if not await auth_task:
+        if embedding_task:
+            embedding_task.cancel()
+        return jsonify({"response": "Unauthorized. Please sign in with a student media account."}), 401
+
+    if not user_query:
+        return jsonify({"error": "No query parameter provided"}), 400
+
+    try:
+        index = shared.index_registry.get_index(DATABASE_INDEX_NAME)
+    except (UnknownIndexError, IndexNotReadyError):
+        # Don't leave the embedding running for a request we're rejecting
+        embedding_task.cancel()
+        raise
+
+    # The same question asked by many people at once (ex: breaking news) is only answered once,
+    # everyone asking while it's being answered gets that answer
+    key = (DATABASE_INDEX_NAME, normalizeQuery(user_query))
+    response, status_code, answered_by = await shared.query_flights.do_async(key, answerQuery, DATABASE_INDEX_NAME, index,
+                                                                             user_query, embedding_task, t0_query)
+    # The response is shared, don't add this request's timings to everyone's copy
+    return jsonify(withTimings(shared.sharedResponse(response, answered_by))), status_code
+
+async def answerQuery(index_name: str, index, user_query: str, embedding_task, t0_query: float) -> tuple:
+    """
+    Retrieve articles for a question and generate the answer
+
+    @param embedding_task: The task embedding user_query
+    @param t0_query: When the request started
+    @return: A tuple (response body, status code, RequestTimer of the request that answered it)
+    """
+    embedding = await embedding_task
+
+    # The gRPC pinecone client is blocking, run it in the shared thread pool
+    results = await asyncio.to_thread(shared.searchArticles, index, embedding, user_query)
+    query_time = round(time.time() - t0_query, 2)
+
+    t0_response = time.time()
+
+    # Paraphrases of a recent question that retrieved the same articles get the same answer
+    article_ids = [match['id'] for match in results['matches']]
+    corpus_version = shared.document_store.get_corpus_version()
+    response_text = shared.answer_cache.get(index_name, embedding, article_ids, corpus_version)
+
+    if response_text is not None:
+        return {
+            "response": response_text,
+            "query_time": query_time,
+            "response_time": round(time.time() - t0_response, 2),
+            "model": None,
+            "hedged": False,
+            "cached": True
+        }, 200, currentRequest()
+
+    context = await buildContextAsync(results['matches'],
+                                      wordpress_client,
+                                      document_store=shared.document_store,
+                                      token_budget=shared.CONTEXT_TOKEN_BUDGET)
+    with span("prompt_build"):
+        instructions = shared.buildInstructions(user_query, context)
+
+    # Generate response (hedged with the fallback model if the main model is slow or fails,
+    # as long as a slot is free for it)
+    try:
+        with span("admission_wait"):
+            acquired_at = await shared.admission.acquire_async()
+        # The generator gives the slot back once the model call holding it is done
+        with span("generation"):
+            generation = await shared.generator.generate_async(instructions, slot=acquired_at)
+    except TimeoutError as e:
+        print(e)
+        return {"response": "Oliver took too long to respond. Please try again."}, 504, currentRequest()
+    response_text = generation["text"]
+
+    # Save the answer for near-duplicate questions
+    shared.answer_cache.put(index_name, embedding, article_ids, corpus_version, response_text)
+
+    response_time = round(time.time() - t0_response, 2)
+    return {
+        "response": response_text,
+        "query_time": query_time,
+        "response_time": response_time,
+        "model": generation["model"],
+        "hedged": generation["hedged"],
+        "cached": False
+    }, 200, currentRequest()
+
+@app.route('/api/query_batch/', methods=['POST'])
+async def query_batch():
+    data = await request.get_json(silent=True) or {}
+
+    with span("auth"):
+        authenticated = bool(data.get('token')) and await asyncio.to_thread(shared.isAuthenticated, data['token'])
+    if not authenticated:
+        return jsonify({"response": "Unauthorized. Please sign in with a student media account."}), 401
+
+    DATABASE_INDEX_NAME = data.get('index')
+    index = shared.index_registry.get_index(DATABASE_INDEX_NAME)
+
+    queries = shared.parseBatchQueries(data)
+    if queries is None:
+        return jsonify({"error": "queries must be a non-empty list of questions"}), 400
+    if len(queries) > shared.MAX_BATCH_QUERIES:
+        return jsonify({"error": f"At most {shared.MAX_BATCH_QUERIES} queries can be sent at once"}), 400
+
+    # Start query timer
+    t0_query = time.time()
+
+    # The same question asked twice (after normalizing) is only answered once
+    unique_queries = {}
+    for user_query in queries:
+        unique_queries.setdefault(normalizeQuery(user_query), user_query)
+
+    with span("query_embedding"):
+        embeddings = await generateQueryEmbeddingsAsync(genai=shared.genai,
+                                                        embedding_model=shared.EMBEDDING_MODEL,
+                                                        queries=list(unique_queries.values()),
+                                                        cache=shared.query_embedding_cache)
+    query_time = round(time.time() - t0_query, 2)
+
+    t0_response = time.time()
+
+    async def answer(user_query: str, embedding) -> dict:
+        if embedding is None:
+            return {"query": user_query, "error": "Could not embed this query."}
+        # Shares the answer with the same question being asked on /api/query/ (or in another batch) at the same time
+        embedding_task = asyncio.get_running_loop().create_future()
+        embedding_task.set_result(embedding)
+        try:
+            key = (DATABASE_INDEX_NAME, normalizeQuery(user_query))
+            response, status_code, answered_by = await shared.query_flights.do_async(key, answerQuery, DATABASE_INDEX_NAME,
+                                                                                     index, user_query, embedding_task,
+                                                                                     t0_query)
+        except OverloadedError as e:
+            print(e)
+            return {"query": user_query, "error": "Oliver is helping too many people right now. Please try again shortly.",
+                    "retry_after": e.retry_after}
+        except Exception as e:
+            print(e)
+            return {"query": user_query, "error": "An error occurred while generating the response."}
+        return shared.batchEntry(user_query, shared.sharedResponse(response, answered_by), status_code)
+
+    answered = await asyncio.gather(*[answer(user_query, embedding)
+                                      for user_query, embedding in zip(unique_queries.values(), embeddings)])
+    entries = dict(zip(unique_queries, answered))
+
+    return jsonify(withTimings({
+        "answers": [dict(entries[normalizeQuery(user_query)], query=user_query) for user_query in queries],
+        "query_time": query_time,
+        "response_time": round(time.time() - t0_response, 2)
+    }))
+
+class StreamBody:
+    """
+    Async iterator over a streamed response body that calls on_close once quart closes the body,
+    even if the client went away before the stream started (the async version of flask's call_on_close)
+    """
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._stream.__anext__()
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._on_close is not None:
+                on_close, self._on_close = self._on_close, None
+                on_close()
+
+@app.route('/api/query_stream/', methods=['GET'])
+async def query_stream():
+    """
+    Same as app.py's /api/query_stream/ (same server-sent events), streamed from gemini without a thread per request
+    """
+    if "token" not in request.args:
+        return jsonify({"response": "Unauthorized. Please sign in with a student media account."}), 401
+
+    jwt_token = request.args.get('token')
+    with span("auth"):
+        authenticated = await asyncio.to_thread(shared.isAuthenticated, jwt_token)
+    if not authenticated:
+        return jsonify({"response": "Unauthorized. Please sign in with a student media account."}), 401
+
+    DATABASE_INDEX_NAME = request.args.get('index')
+    index = shared.index_registry.get_index(DATABASE_INDEX_NAME)
+
+    # Start query timer
+    t0_query = time.time()
+    user_query = request.args.get('query')
+    if not user_query:
+        return jsonify({"error": "No query parameter provided"}), 400
+
+    with span("query_embedding"):
+        embedding = await generateQueryEmbeddingAsync(genai=shared.genai,
+                                                      embedding_model=shared.EMBEDDING_MODEL,
+                                                      query=user_query,
+                                                      cache=shared.query_embedding_cache)
+    results = await asyncio.to_thread(shared.searchArticles, index, embedding, user_query)
+    query_time = round(time.time() - t0_query, 2)
+
+    article_ids = [match['id'] for match in results['matches']]
+    corpus_version = shared.document_store.get_corpus_version()
+    cached_answer = shared.answer_cache.get(DATABASE_INDEX_NAME, embedding, article_ids, corpus_version)
+
+    # Turn the request away before the stream starts (and the status code is sent) if gemini is overloaded.
+    # The stream gives the slot back once the model calls are done (or the response is closed before it started)
+    stream = None
+    if cached_answer is None:
+        with span("admission_wait"):
+            stream = shared.generator.stream(slot=await shared.admission.acquire_async())
+
+    # The stages of the stream are timed as it runs, the request is only recorded once it's closed
+    timer = deferRequest(request.url_rule.rule, 200)
+    send_timings = request.args.get('timings') == 'true'
+
+    async def generate():
+        t0_response = time.time()
+
+        # Send retrieval info right away, before waiting on gemini
+        sources = [match['metadata']['link'] for match in results['matches']]
+        yield shared.serverSentEvent("metadata", {"sources": sources, "query_time": query_time})
+
+        response_text = cached_answer
+        time_to_first_token = None
+
+        if response_text is not None:
+            time_to_first_token = round(time.time() - t0_response, 2)
+            yield shared.serverSentEvent("token", {"text": response_text})
+        else:
+            context = await buildContextAsync(results['matches'],
+                                              wordpress_client,
+                                              document_store=shared.document_store,
+                                              token_budget=shared.CONTEXT_TOKEN_BUDGET)
+            with span("prompt_build"):
+                instructions = shared.buildInstructions(user_query, context)
+
+            response_text = ""
+            try:
+                # Hedged with the fallback model until the first chunk arrives, like /api/query/
+                with span("generation"):
+                    async with contextlib.aclosing(stream.texts_async(instructions)) as texts:
+                        async for text in texts:
+                            if time_to_first_token is None:
+                                time_to_first_token = round(time.time() - t0_response, 2)
+                            response_text += text
+                            yield shared.serverSentEvent("token", {"text": text})
+
+                # Only cache complete answers
+                shared.answer_cache.put(DATABASE_INDEX_NAME, embedding, article_ids, corpus_version, response_text)
+            except Exception as e:
+                print(e)
+                yield shared.serverSentEvent("error", {"message": "An error occurred while generating the response."})
+
+        done = {
+            "query_time": query_time,
+            "response_time": round(time.time() - t0_response, 2),
+            "time_to_first_token": time_to_first_token
+        }
+        if send_timings and timer is not None:
+            done["timings"] = timer.timings()
+        yield shared.serverSentEvent("done", done)
+
+    def on_close():
+        if stream is not None:
+            stream.close()
+        finishDeferredRequest(timer)
+
+    return Response(StreamBody(generate(), on_close),
+                    mimetype="text/event-stream",
+                    # Don't let proxies buffer the stream
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,323 @@
+"""
+Benchmark the /api/query/ path end to end without Google, Pinecone or WordPress.
+
+The embedder, vector index, WordPress REST API and Gemini are replaced by local stand-ins that
+sleep for a configurable latency, then the real Flask app is served on localhost and queried at
+a configurable concurrency. Results (p50/p95/p99 per stage and in total, plus throughput) are
+printed as JSON so runs can be compared with each other:
+
+python3 benchmark.py --requests 500 --concurrency 16 --generate-latency lognormal:0.8:0.4 --output run.json
+
+Latencies are given as one of:
+    const:SECONDS
+    uniform:LOW:HIGH
+    lognormal:MEDIAN:SIGMA
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import contextlib
+import platform
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import BaseAdapter
+
+def parseLatency(spec: str):
+    """
+    @param spec: A latency distribution, ex: "const:0.05", "uniform:0.02:0.08" or "lognormal:0.8:0.4"
+    @return: A function returning one latency sample in seconds
+    """
+    kind, *params = spec.split(":")
+    params = [float(param) for param in params]
+
+    if kind == "const" and len(params) == 1:
+        return lambda: params[0]
+    if kind == "uniform" and len(params) == 2:
+        return lambda: random.uniform(params[0], params[1])
+    if kind == "lognormal" and len(params) == 2:
+        return lambda: random.lognormvariate(math.log(params[0]), params[1])
+
+    raise ValueError(f"Invalid latency {spec}, expected const:S, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+
+def fakeVector(text: str, dimension: int) -> list:
+    # The same text always gets the same (random looking) vector
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    return [rng.gauss(0, 1) for _ in range(dimension)]
+
+class FakeGenai:
+    """
+    Stands in for the google.generativeai module (only what the query path uses)
+    """
+    def __init__(self, latency, dimension: int):
+        self._latency = latency
+        self._dimension = dimension
+
+    def embed_content(self, model: str, content, **kwargs) -> dict:
+        time.sleep(self._latency())
+        if isinstance(content, list):
+            return {"embedding": [fakeVector(text, self._dimension) for text in content]}
+        return {"embedding": fakeVector(content, self._dimension)}
+
+class FakeModel:
+    """
+    Stands in for a gemini GenerativeModel
+    """
+    def __init__(self, model_name: str, latency, failure_rate: float = 0):
+        self.model_name = model_name
+        self._latency = latency
+        self._failure_rate = failure_rate
+
+    def generate_content(self, instructions: str, **kwargs):
+        time.sleep(self._latency())
+        if random.random() < self._failure_rate:
+            raise RuntimeError(f"{self.model_name} failed (simulated)")
+        return _FakeResponse("This is a benchmark answer.")
+
+class _FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+class FakeIndex:
+    """
+    Stands in for a pinecone Index, returns random chunks of a fixed set of articles
+    """
+    def __init__(self, latency, num_articles: int, max_chunks: int, dimension: int):
+        self._latency = latency
+        self._num_articles = num_articles
+        self._max_chunks = max_chunks
+        self._dimension = dimension
+
+    def query(self, vector: list, top_k: int = 10, include_values: bool = False, include_metadata: bool = True, **kwargs) -> dict:
+        time.sleep(self._latency())
+
+        # Derive the matches from the vector so the same question gets the same articles
+        rng = random.Random(hash(tuple(vector[:8])))
+        matches = []
+        for rank in range(top_k):
+            article_id = rng.randrange(1, self._num_articles + 1)
+            chunks = 1 + article_id % self._max_chunks
+            match_id = str(article_id) if chunks == 1 else f"{article_id}_chunk{rng.randrange(chunks)}"
+            match = {
+                "id": match_id,
+                "score": 0.9 - rank * 0.01,
+                "metadata": {"link": f"https://dailybruin.com/benchmark/{article_id}", "chunk_total": chunks}
+            }
+            if include_values:
+                match["values"] = fakeVector(match_id, self._dimension)
+            matches.append(match)
+        return {"matches": matches}
+
+class FakeIndexRegistry:
+    def __init__(self, index: FakeIndex):
+        self._index = index
+
+    def is_known(self, name: str) -> bool:
+        return True
+
+    def get_index(self, name: str) -> FakeIndex:
+        return self._index
+
+    def wait_until_ready(self, name: str, verbose: bool = True) -> FakeIndex:
+        return self._index
+
+class FakeWordpressAdapter(BaseAdapter):
+    """
+    Answers the WordPress REST API requests made through the article fetcher's session
+    """
+    def __init__(self, latency, article_chars: int):
+        super().__init__()
+        self._latency = latency
+        self._article_chars = article_chars
+
+    def send(self, request, **kwargs):
+        time.sleep(self._latency())
+
+        article_id = request.path_url.split("?")[0].rstrip("/").split("/")[-1]
+        words = " ".join(f"word{(int(article_id) * 31 + i) % 997}" for i in range(self._article_chars // 8))
+
+        response = requests.Response()
+        response.status_code = 200
+        response.headers["Content-Type"] = "application/json"
+        response._content = json.dumps({
+            "id": int(article_id),
+            "modified": "2024-01-01T00:00:00",
+            "content": {"rendered": f"<p>{words}</p>"}
+        }).encode("utf-8")
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+def percentiles(samples: list) -> dict:
+    """
+    @return: count, mean, p50, p95, p99 and max of the samples (nearest rank)
+    """
+    if not samples:
+        return {"count": 0}
+
+    samples = sorted(samples)
+    def nearestRank(percent):
+        return samples[min(len(samples) - 1, max(0, math.ceil(percent / 100 * len(samples)) - 1))]
+
+    return {
+        "count": len(samples),
+        "mean": round(sum(samples) / len(samples), 6),
+        "p50": round(nearestRank(50), 6),
+        "p95": round(nearestRank(95), 6),
+        "p99": round(nearestRank(99), 6),
+        "max": round(samples[-1], 6),
+    }
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Benchmark /api/query/ with local stand-ins for every external service")
+    parser.add_argument("--requests", type=int, default=200, help="Number of measured requests")
+    parser.add_argument("--warmup", type=int, default=20, help="Requests sent first and left out of the results")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at the same time")
+    parser.add_argument("--query-pool", type=int, default=None,
+                        help="Number of distinct questions to draw from (default: every request is a new question)")
+    parser.add_argument("--articles", type=int, default=2000, help="Number of articles the fake index matches against")
+    parser.add_argument("--max-chunks", type=int, default=3, help="Max chunks per fake article")
+    parser.add_argument("--article-chars", type=int, default=6000, help="Length of each fake article")
+    parser.add_argument("--dimension", type=int, default=768, help="Size of the fake embeddings")
+    parser.add_argument("--embed-latency", default="lognormal:0.08:0.3")
+    parser.add_argument("--index-latency", default="lognormal:0.05:0.3")
+    parser.add_argument("--wordpress-latency", default="lognormal:0.15:0.5")
+    parser.add_argument("--generate-latency", default="lognormal:1.0:0.4")
+    parser.add_argument("--fallback-latency", default="lognormal:0.8:0.3")
+    parser.add_argument("--generate-failure-rate", type=float, default=0.0, help="Fraction of primary model calls that fail")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the JSON results to this file instead of stdout")
+    arguments = parser.parse_args()
+
+    for name in ("embed_latency", "index_latency", "wordpress_latency", "generate_latency", "fallback_latency"):
+        try:
+            parseLatency(getattr(arguments, name))
+        except ValueError as e:
+            parser.error(str(e))
+
+    return arguments
+
+def main():
+    arguments = parseArguments()
+    random.seed(arguments.seed)
+
+    # The app prints as it serves, keep stdout for the results only
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(arguments)
+
+    output = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            file.write(output + "\n")
+        print(f"Results written to {arguments.output}", file=sys.stderr)
+    else:
+        print(output)
+
+def run(arguments) -> dict:
+    """
+    Serve the app with every external service faked and send it the requests
+
+    @return: The benchmark report
+    """
+    # Keep app.py away from real services and real data before importing it
+    workdir = tempfile.mkdtemp(prefix="dbllm-benchmark-")
+    os.environ["RETRIEVAL_BACKEND"] = "local"
+    os.environ["LOCAL_INDEX_PATH"] = os.path.join(workdir, "local_index")
+    os.environ["DOCUMENT_STORE_PATH"] = os.path.join(workdir, "documents.db")
+    os.environ["QUERY_EMBEDDING_CACHE_PATH"] = ""
+
+    import app
+    from modules import articleFetcher
+    from modules.generation import HedgedGenerator
+    from werkzeug.serving import make_server
+
+    app.genai = FakeGenai(parseLatency(arguments.embed_latency), arguments.dimension)
+    app.index_registry = FakeIndexRegistry(FakeIndex(parseLatency(arguments.index_latency),
+                                                     arguments.articles,
+                                                     arguments.max_chunks,
+                                                     arguments.dimension))
+    app.isAuthenticated = lambda token: True
+    app.generator = HedgedGenerator(primary_model=FakeModel("benchmark-primary",
+                                                            parseLatency(arguments.generate_latency),
+                                                            arguments.generate_failure_rate),
+                                    fallback_model=FakeModel("benchmark-fallback", parseLatency(arguments.fallback_latency)),
+                                    safety_settings={},
+                                    hedge_percentile=app.HEDGE_PERCENTILE,
+                                    deadline=app.GENERATION_DEADLINE,
+                                    admission=app.admission)
+    articleFetcher._session.mount("https://wp.dailybruin.com",
+                                  FakeWordpressAdapter(parseLatency(arguments.wordpress_latency), arguments.article_chars))
+
+    # Serve the real app on a free local port
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/api/query/"
+
+    local = threading.local()
+
+    def sendQuery(number: int) -> dict:
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+
+        question = number if arguments.query_pool is None else random.randrange(arguments.query_pool)
+        t0 = time.perf_counter()
+        response = session.get(url, params={"index": "benchmark", "token": "benchmark",
+                                            "query": f"benchmark question {question}", "timings": "true"})
+        latency = time.perf_counter() - t0
+
+        body = response.json() if response.headers.get("Content-Type", "").startswith("application/json") else {}
+        return {"status": response.status_code, "latency": latency, "timings": body.get("timings", {}),
+                "cached": body.get("cached"), "hedged": body.get("hedged")}
+
+    print(f"Warming up with {arguments.warmup} requests...", file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=arguments.concurrency) as executor:
+        list(executor.map(sendQuery, range(-arguments.warmup, 0)))
+
+        print(f"Sending {arguments.requests} requests, {arguments.concurrency} at a time...", file=sys.stderr)
+        t0 = time.perf_counter()
+        results = list(executor.map(sendQuery, range(arguments.requests)))
+        duration = time.perf_counter() - t0
+
+    server.shutdown()
+
+    succeeded = [result for result in results if result["status"] == 200]
+    stage_samples = {}
+    for result in succeeded:
+        for stage, seconds in result["timings"].items():
+            stage_samples.setdefault(stage, []).append(seconds)
+
+    return {
+        "config": {name: value for name, value in vars(arguments).items() if name != "output"},
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "requests": len(results),
+        "errors": len(results) - len(succeeded),
+        "status_codes": {str(status): sum(1 for result in results if result["status"] == status)
+                         for status in sorted({result["status"] for result in results})},
+        "cached": sum(1 for result in succeeded if result["cached"]),
+        "hedged": sum(1 for result in succeeded if result["hedged"]),
+        "duration_seconds": round(duration, 3),
+        "throughput_rps": round(len(results) / duration, 3) if duration else None,
+        "latency_seconds": {
+            "total": percentiles([result["latency"] for result in results]),
+            "stages": {stage: percentiles(samples) for stage, samples in sorted(stage_samples.items())},
+        },
+    }
+
+if __name__ == '__main__':
+    main()
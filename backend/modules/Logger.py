@@ -85,8 +85,8 @@ Most Recent Article's ID: {self._latest_id}
         self._embedding_log += f"{self._get_timestamp()} [WARNING]: Skipped article. Missing content (ID {article_id}).\n"
         self._refresh_log()
 
-    def log_chunking_error(self, article_id):
-        self._embedding_log += f"{self._get_timestamp()} [WARNING]: Skipped article. Failed to chunk (ID {article_id}).\n" 
+    def log_embedding_error(self, article_id):
+        self._embedding_log += f"{self._get_timestamp()} [WARNING]: Skipped article. Failed to embed (ID {article_id}).\n" 
         self._refresh_log()
 
     def log_missing_id(self):
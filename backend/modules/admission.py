@@ -0,0 +1,183 @@
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+
+class OverloadedError(Exception):
+    """
+    Raised when a request can't get a slot, carries the HTTP status and Retry-After (seconds) to answer with
+    """
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class _Waiter:
+    # A request waiting for a slot. Only changed while holding the controller's lock
+    def __init__(self, loop=None):
+        self.granted = False
+        self.abandoned = False
+        self.loop = loop
+        self.event = threading.Event() if loop is None else asyncio.Event()
+
+    def grant(self) -> bool:
+        if self.abandoned:
+            return False
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            # asyncio events can only be set from their own loop
+            self.loop.call_soon_threadsafe(self.event.set)
+        return True
+
+class AdmissionController:
+    """
+    Caps how many requests run something expensive (gemini calls) at the same time.
+
+    Requests over the cap wait in a bounded first-come first-served queue. A request is turned away
+    right away when the queue is full (429), or after waiting queue_timeout seconds for a slot (503),
+    both with a Retry-After estimate, instead of piling more load onto a rate-limited API.
+    Works for threads and asyncio tasks alike (slots are shared between both).
+    """
+    def __init__(self, max_in_flight: int = 16, max_queue: int = 32, queue_timeout: float = 10.0):
+        """
+        @param max_in_flight: Requests allowed to hold a slot at the same time
+        @param max_queue: Requests allowed to wait for a slot, more are rejected immediately
+        @param queue_timeout: Seconds a request may wait for a slot
+        """
+        self._max_in_flight = max_in_flight
+        self._max_queue = max_queue
+        self._queue_timeout = queue_timeout
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters = deque()
+
+        # Moving average of how long a slot is held, used to estimate Retry-After
+        self._hold_seconds = None
+
+        self._admitted = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._wait_seconds = 0.0
+        self._max_queue_depth = 0
+
+    def acquire(self):
+        """
+        Wait for a slot, release() it when done
+
+        @raise OverloadedError: If the queue is full or no slot freed up in time
+        """
+        t0 = time.time()
+        waiter = self._enter()
+        if waiter is not None:
+            waiter.event.wait(self._queue_timeout)
+            self._finish_waiting(waiter, t0)
+        return time.time()
+
+    async def acquire_async(self):
+        """
+        Async version of acquire
+        """
+        t0 = time.time()
+        waiter = self._enter(asyncio.get_running_loop())
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(waiter.event.wait(), self._queue_timeout)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                self._abandon(waiter)
+                raise
+            self._finish_waiting(waiter, t0)
+        return time.time()
+
+    def try_acquire(self):
+        """
+        Take a slot only if one is free right now and nobody is waiting for one (never queues)
+
+        @return: What acquire would have returned, or None if there was no free slot
+        """
+        with self._lock:
+            if self._in_flight >= self._max_in_flight or self._waiters:
+                return None
+            self._in_flight += 1
+            self._admitted += 1
+        return time.time()
+
+    def release(self, acquired_at: float = None):
+        """
+        Give a slot back (straight to the next request in the queue, if any)
+
+        @param acquired_at: What acquire returned, used to estimate Retry-After
+        """
+        with self._lock:
+            if acquired_at is not None:
+                held = time.time() - acquired_at
+                self._hold_seconds = held if self._hold_seconds is None else 0.9 * self._hold_seconds + 0.1 * held
+
+            while self._waiters:
+                if self._waiters.popleft().grant():
+                    return
+            self._in_flight -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "queue_depth": len(self._waiters),
+                "max_queue_depth": self._max_queue_depth,
+                "max_in_flight": self._max_in_flight,
+                "max_queue": self._max_queue,
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out,
+                "wait_seconds_total": round(self._wait_seconds, 4),
+                "hold_seconds": round(self._hold_seconds, 4) if self._hold_seconds is not None else None,
+            }
+
+    def _enter(self, loop=None):
+        # @return: None if a slot was free, else the waiter queued for one
+        with self._lock:
+            if self._in_flight < self._max_in_flight and not self._waiters:
+                self._in_flight += 1
+                self._admitted += 1
+                return None
+
+            if len(self._waiters) >= self._max_queue:
+                self._rejected += 1
+                raise OverloadedError("Too many requests are waiting", 429, self._retry_after())
+
+            waiter = _Waiter(loop)
+            self._waiters.append(waiter)
+            self._max_queue_depth = max(self._max_queue_depth, len(self._waiters))
+            return waiter
+
+    def _finish_waiting(self, waiter: _Waiter, t0: float):
+        with self._lock:
+            self._wait_seconds += time.time() - t0
+            # A slot may have been handed over right as the wait timed out, keep it
+            if waiter.granted:
+                self._admitted += 1
+                return
+
+            waiter.abandoned = True
+            self._waiters.remove(waiter)
+            self._timed_out += 1
+            raise OverloadedError(f"No slot freed up within {self._queue_timeout} seconds", 503, self._retry_after())
+
+    def _abandon(self, waiter: _Waiter):
+        # The waiting task was cancelled, give back the slot if it was already handed over
+        with self._lock:
+            waiter.abandoned = True
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                return
+        self.release()
+
+    def _retry_after(self) -> int:
+        # Roughly how long until everyone ahead in the queue got through (called with the lock held)
+        hold_seconds = self._hold_seconds if self._hold_seconds is not None else 1.0
+        return max(1, math.ceil(hold_seconds * (len(self._waiters) + 1) / self._max_in_flight))
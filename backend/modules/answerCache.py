@@ -0,0 +1,92 @@
+import math
+import threading
+from collections import OrderedDict
+
+def _normalize(vector: list) -> list:
+    norm = math.sqrt(sum(x * x for x in vector))
+    return [x / norm for x in vector] if norm else list(vector)
+
+class SemanticAnswerCache:
+    """
+    Thread-safe cache of generated answers for near-duplicate questions.
+
+    An answer is reused when a new query retrieved the same articles from the same
+    index and its embedding is within a cosine similarity threshold of a cached query.
+    The whole cache is dropped whenever the corpus version changes (new articles ingested).
+    """
+    def __init__(self, threshold: float = 0.95, max_entries: int = 1024):
+        """
+        @param threshold: Minimum cosine similarity between two queries to share an answer (0-1)
+        @param max_entries: How many answers to keep before the least recently used is evicted
+        """
+        self._threshold = threshold
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._corpus_version = None
+
+        # (index name, retrieved article ids) -> list of (normalized query embedding, answer)
+        # Only queries that retrieved exactly the same articles are ever compared
+        self._entries = OrderedDict()
+        self._size = 0
+
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, index_name: str, embedding: list, article_ids: list, corpus_version):
+        """
+        @param index_name: The vector index the articles were retrieved from
+        @param embedding: The query embedding
+        @param article_ids: Ids of the matches the query retrieved
+        @param corpus_version: Current corpus version (see DocumentStore.get_corpus_version)
+        @return: The cached answer, or None on a miss
+        """
+        key = self._key(index_name, article_ids)
+        query_vector = _normalize(embedding)
+
+        with self._lock:
+            self._check_version(corpus_version)
+
+            for cached_vector, answer in self._entries.get(key, []):
+                similarity = sum(a * b for a, b in zip(query_vector, cached_vector))
+                if similarity >= self._threshold:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return answer
+
+            self._misses += 1
+            return None
+
+    def put(self, index_name: str, embedding: list, article_ids: list, corpus_version, answer):
+        key = self._key(index_name, article_ids)
+        query_vector = _normalize(embedding)
+
+        with self._lock:
+            self._check_version(corpus_version)
+
+            self._entries.setdefault(key, []).append((query_vector, answer))
+            self._entries.move_to_end(key)
+            self._size += 1
+
+            # Evict the least recently used group of answers until we're under the cap
+            while self._size > self._max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "entries": self._size,
+                "corpus_version": self._corpus_version,
+            }
+
+    def _check_version(self, corpus_version):
+        # Answers may be outdated once new articles are ingested
+        if corpus_version != self._corpus_version:
+            self._entries.clear()
+            self._size = 0
+            self._corpus_version = corpus_version
+
+    def _key(self, index_name: str, article_ids: list):
+        return (index_name, tuple(sorted(article_ids)))
@@ -1,12 +1,88 @@
+import time
+import random
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.lruCache import LRUCache
+from modules.singleFlight import SingleFlight
+
+# Seconds to wait on WordPress before giving up on a single article request
+ARTICLE_FETCH_TIMEOUT = 10
+# Max number of keep-alive connections kept open to WordPress
+CONNECTION_POOL_SIZE = 16
+
+# Pages of posts downloaded at the same time, and how far iterArticlePages reads ahead of the page
+# its caller (ex: the store.py ingest pipeline) is working on
+PAGE_FETCH_WORKERS = 5
+# Seconds to wait on WordPress for one page of posts (up to 100 full articles)
+PAGE_FETCH_TIMEOUT = 60
+# Times a page request is retried when WordPress is rate limiting (429), failing (5xx) or unreachable
+PAGE_FETCH_RETRIES = 5
+# Backoff before retry n is random between 0 and min(PAGE_FETCH_MAX_BACKOFF, PAGE_FETCH_BACKOFF * 2^n) seconds
+PAGE_FETCH_BACKOFF = 1.0
+PAGE_FETCH_MAX_BACKOFF = 30.0
+
+POSTS_URL = "https://wp.dailybruin.com/wp-json/wp/v2/posts"
+
+# Shared session so concurrent fetches reuse pooled keep-alive connections
+# instead of opening a new connection for every article
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=CONNECTION_POOL_SIZE))
+
+# Size cap of the in-memory article cache (uncleaned html), in bytes
+ARTICLE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Seconds before a cached article is checked against wordpress' 'modified' date again
+ARTICLE_CACHE_TTL = 60 * 60
+
+# id -> (uncleaned content, modified timestamp)
+article_cache = LRUCache(max_bytes=ARTICLE_CACHE_MAX_BYTES,
+                         ttl=ARTICLE_CACHE_TTL,
+                         sizeof=lambda entry: len(entry[0].encode("utf-8")))
+
+# Concurrent fetches of the same article (ex: a popular story matched by many questions at once) share one request
+article_flights = SingleFlight()
+
+def _getWithRetries(url: str, params: dict, timeout: float = PAGE_FETCH_TIMEOUT):
+    """
+    GET through the shared session, retrying with exponential backoff and full jitter on 429, 5xx
+    and connection errors (a Retry-After header from WordPress is respected if it asks for longer)
+
+    @return: The last response (which may still be a 429/5xx once the retries ran out)
+    @raise requests.RequestException: If WordPress couldn't be reached on the last attempt
+    """
+    for attempt in range(PAGE_FETCH_RETRIES + 1):
+        response = None
+        try:
+            response = _session.get(url, params=params, timeout=timeout)
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+            error = f"status {response.status_code}"
+        except requests.RequestException as e:
+            if attempt == PAGE_FETCH_RETRIES:
+                raise
+            error = e
+
+        if attempt == PAGE_FETCH_RETRIES:
+            print(f"Giving up on {url} {params} after {attempt + 1} attempts: {error}")
+            return response
+
+        delay = random.uniform(0, min(PAGE_FETCH_MAX_BACKOFF, PAGE_FETCH_BACKOFF * 2 ** attempt))
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(PAGE_FETCH_MAX_BACKOFF, int(retry_after)))
+        print(f"Retrying {url} {params} in {round(delay, 2)} seconds ({error})")
+        time.sleep(delay)
 
 def findTotalPages(articles_per_page):
     """
     With a set number of articles per page (0-100) and a starting page (1), returns the total number of pages
     """
-    # Get a response element
-    response = requests.get("https://wp.dailybruin.com/wp-json/wp/v2/posts", params={"per_page": articles_per_page, "page": 1})
+    # Get a response element (only the headers are needed, so don't download the articles)
+    response = _getWithRetries(POSTS_URL, params={"per_page": articles_per_page, "page": 1, "_fields": "id"})
 
     # Extract total pages and total articles from the response headers
     total_pages = int(response.headers["X-WP-TotalPages"])
@@ -19,25 +95,49 @@ def findTotalArticles():
     Returns the total number of articles
     """
     # Get a response element
-    response = requests.get("https://wp.dailybruin.com/wp-json/wp/v2/posts", params={"per_page": 1, "page": 1})
+    response = _getWithRetries(POSTS_URL, params={"per_page": 1, "page": 1, "_fields": "id"})
 
     # Extract total pages and total articles from the response headers
     total_articles = int(response.headers["x-WP-Total"])
 
     return total_articles
 
-def fetchArticles(starting_page=1, ending_page=None, posts_per_page=100) -> list:
+def fetchPage(page: int, posts_per_page: int = 100):
+    """
+    @return: The articles on a page, or None if it couldn't be fetched
+    """
+    try:
+        response = _getWithRetries(POSTS_URL, params={"page": page, "per_page": posts_per_page})
+    except requests.RequestException as e:
+        print(f"Error with fetching page {page}: {e}")
+        return None
+
+    # Only follow through if the response says successful
+    if response.status_code != 200:
+        print(f"Error with fetching page {page}")
+        return None
+
+    try:
+        articles = response.json()
+    except ValueError:
+        print(f"Could not make JSON out of articles from page {page}")
+        return None
+
+    print(f"Successfully fetched articles from page {page}")
+    return articles
+
+def fetchArticles(starting_page=1, ending_page=None, posts_per_page=100, max_workers=PAGE_FETCH_WORKERS) -> list:
     """
         Get all articles as an array from the Daily Bruin article database.
+        Pages are downloaded concurrently over pooled connections, and retried when WordPress is busy
 
         @param starting_page: What page to start on, defualt is 1
         @param ending_page: What page to end on, default is None (changed to last available page)
         @param posts_per_page: How many posts to fetch per page from 1 to 100, default is 100
-        @return: An array of articles, with each element being in JSON format
+        @param max_workers: How many pages to download at the same time, default is PAGE_FETCH_WORKERS
+        @return: An array of articles in page order, with each element being in JSON format
+                 (empty if any page still failed after retrying)
     """
-    url = "https://wp.dailybruin.com/wp-json/wp/v2/posts"
-    articles = []
-
     # Find total pages to iterate through
     total_pages = findTotalPages(posts_per_page)
 
@@ -59,32 +159,43 @@ def fetchArticles(starting_page=1, ending_page=None, posts_per_page=100) -> list
         print("Starting page must be less than ending page")
         return []
 
-    # Iterate through the pages
-    page = starting_page
-    while (page <= ending_page):
-        # Request posts_per_page articles from a given page
-        response = requests.get(url, params={"page": page, "per_page": posts_per_page})
-
-        # Only follow through if the response says successful
-        if (response.status_code == 200):
-            try:
-                # Append all articles from this page
-                articles.extend(response.json())
-            except:
-                # Write out error and terminate function
-                print("Could not make JSON out of articles")
-                return []
-
-            print("Successfully fetched articles from page", page)
-            page+=1
-        # If the request was unsuccessful, write out error and terminate function
-        else:
-            print("Error with fetching a page")
+    articles = []
+    for page, page_articles in iterArticlePages(range(starting_page, ending_page + 1), posts_per_page, max_workers):
+        # Give up on the whole range as soon as a page fails for good
+        if page_articles is None:
             return []
-    
+        articles.extend(page_articles)
+
     # Return the articles array
     return articles
 
+def iterArticlePages(pages, posts_per_page=100, max_workers=PAGE_FETCH_WORKERS):
+    """
+    Download pages of articles concurrently and hand them back one page at a time, in page order.
+    At most max_workers pages are downloaded ahead of the caller, so memory stays flat however many pages there are
+
+    @param pages: The page numbers to fetch, in order (ex: range(1, 11))
+    @param posts_per_page: How many posts per page from 1 to 100, default is 100
+    @param max_workers: How many pages to download at the same time, default is PAGE_FETCH_WORKERS
+    @return: A generator of (page, articles), articles is None if the page couldn't be fetched
+             (stop iterating to cancel the pages still being downloaded)
+    """
+    pages = iter(pages)
+    in_flight = deque()
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="page-fetch")
+    try:
+        while True:
+            # Keep max_workers pages downloading ahead of the one being handed back
+            for page in itertools.islice(pages, max_workers - len(in_flight)):
+                in_flight.append((page, executor.submit(fetchPage, page, posts_per_page)))
+            if not in_flight:
+                return
+
+            page, future = in_flight.popleft()
+            yield page, future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
 def fetchArticlesExcept(starting_offset, ending_offset, start_except, end_except) -> list:
     url = "https://wp.dailybruin.com/wp-json/wp/v2/posts"
     articles = []
@@ -142,17 +253,60 @@ def fetchArticlesExcept(starting_offset, ending_offset, start_except, end_except
     # Return the articles array
     return articles
 
-def fetchArticleById(id: str) -> str:
+def _fetchModifiedDate(id: str, timeout: float):
+    """
+    Cheaply get only the 'modified' timestamp of an article (used to revalidate cached articles)
+
+    @return: The modified timestamp, or None if it couldn't be fetched
+    """
+    url = f"https://wp.dailybruin.com/wp-json/wp/v2/posts/{id}"
+    try:
+        response = _session.get(url, params={"_fields": "modified"}, timeout=timeout)
+        if response.status_code == 200:
+            return response.json()['modified']
+    except Exception as e:
+        print(f"Error revalidating the page corresponding with id {id}: {e}")
+    return None
+
+def fetchArticleById(id: str, timeout: float = ARTICLE_FETCH_TIMEOUT) -> str:
     """
     Fetch an uncleaned article with a corresponding id from the wordpress endpoint
+    Articles are kept in article_cache, so popular articles don't go back to wordpress every time,
+    and callers asking for an article that is already being fetched wait for that fetch
 
     @param id: The id of the article
+    @param timeout: Seconds to wait for wordpress before giving up, default is ARTICLE_FETCH_TIMEOUT
     @return: A string of the uncleaned article
     """
+    id = str(id)
+    return article_flights.do(id, _fetchArticleById, id, timeout)
+
+def _fetchArticleById(id: str, timeout: float) -> str:
+
+    # Check the cache first
+    cached, fresh = article_cache.lookup(id)
+    if cached is not None:
+        content, modified = cached
+        if fresh:
+            return content
+
+        # The entry expired, only re-download it if the article changed since we cached it
+        latest_modified = _fetchModifiedDate(id, timeout)
+        if latest_modified == modified:
+            article_cache.touch(id)
+            return content
+        elif latest_modified is None:
+            # Wordpress is unreachable, a slightly stale article is better than none
+            return content
 
     # Get post based on id through wordpress endpoint
     url = f"https://wp.dailybruin.com/wp-json/wp/v2/posts/{id}"
-    response = requests.get(url)
+    try:
+        response = _session.get(url, params={"_fields": "content,modified"}, timeout=timeout)
+    except requests.RequestException as e:
+        # Timed out or could not connect
+        print(f"Error with fetching the page corresponding with id {id}: {e}")
+        return ""
     
     # Only follow through if the response says successful
     if (response.status_code == 200):
@@ -161,15 +315,100 @@ def fetchArticleById(id: str) -> str:
             responseJSON = response.json()
             content = responseJSON['content']['rendered']
 
+            article_cache.put(id, (content, responseJSON.get('modified')))
             return content
         except:
             # We couldn't convert the article into a JSON
-            print("Error producing JSON from page corresponding with id {id}")
+            print(f"Error producing JSON from page corresponding with id {id}")
             return ""
     else:
         # If the request was unsuccessful, write out error and terminate function
         print(f"Error with fetching the page corresponding with id {id}")
         return ""
+
+async def _fetchModifiedDateAsync(client, id: str, timeout: float):
+    """
+    Async version of _fetchModifiedDate
+
+    @param client: An httpx.AsyncClient
+    """
+    url = f"https://wp.dailybruin.com/wp-json/wp/v2/posts/{id}"
+    try:
+        response = await client.get(url, params={"_fields": "modified"}, timeout=timeout)
+        if response.status_code == 200:
+            return response.json()['modified']
+    except Exception as e:
+        print(f"Error revalidating the page corresponding with id {id}: {e}")
+    return None
+
+async def fetchArticleByIdAsync(client, id: str, timeout: float = ARTICLE_FETCH_TIMEOUT) -> str:
+    """
+    Async version of fetchArticleById (shares the same article_cache, and concurrent fetches of the same article)
+
+    @param client: An httpx.AsyncClient, reused across requests so connections stay pooled
+    @param id: The id of the article
+    @param timeout: Seconds to wait for wordpress before giving up, default is ARTICLE_FETCH_TIMEOUT
+    @return: A string of the uncleaned article
+    """
+    id = str(id)
+    return await article_flights.do_async(id, _fetchArticleByIdAsync, client, id, timeout)
+
+async def _fetchArticleByIdAsync(client, id: str, timeout: float) -> str:
+
+    # Check the cache first
+    cached, fresh = article_cache.lookup(id)
+    if cached is not None:
+        content, modified = cached
+        if fresh:
+            return content
+
+        # The entry expired, only re-download it if the article changed since we cached it
+        latest_modified = await _fetchModifiedDateAsync(client, id, timeout)
+        if latest_modified == modified:
+            article_cache.touch(id)
+            return content
+        elif latest_modified is None:
+            # Wordpress is unreachable, a slightly stale article is better than none
+            return content
+
+    # Get post based on id through wordpress endpoint
+    url = f"https://wp.dailybruin.com/wp-json/wp/v2/posts/{id}"
+    try:
+        response = await client.get(url, params={"_fields": "content,modified"}, timeout=timeout)
+    except Exception as e:
+        # Timed out or could not connect
+        print(f"Error with fetching the page corresponding with id {id}: {e}")
+        return ""
+
+    # Only follow through if the response says successful
+    if (response.status_code == 200):
+        try:
+            # Get the content of the article (exclude metadata)
+            responseJSON = response.json()
+            content = responseJSON['content']['rendered']
+
+            article_cache.put(id, (content, responseJSON.get('modified')))
+            return content
+        except:
+            # We couldn't convert the article into a JSON
+            print(f"Error producing JSON from page corresponding with id {id}")
+            return ""
+    else:
+        # If the request was unsuccessful, write out error and terminate function
+        print(f"Error with fetching the page corresponding with id {id}")
+        return ""
+
+def getArticleCacheStats() -> dict:
+    """
+    @return: Hit, miss and eviction counters of the article cache
+    """
+    return article_cache.stats()
+
+def getArticleFetchFlightStats() -> dict:
+    """
+    @return: How many article fetches ran, and how many waited on an identical fetch already in flight
+    """
+    return article_flights.stats()
     
 def getLatestArticlesByID(last_checked_id: str) -> list:
     """
@@ -200,29 +439,49 @@ def getLatestArticlesByDate(last_synced_date: str) -> list:
     """
     @param last_synced_date: Must be in format "yyyy-mm-dd hh:mm:ss"
     """
+    articles = []
+    for page, page_articles in iterLatestArticlePagesByDate(last_synced_date):
+        if page_articles is None:
+            return []
+        articles.extend(page_articles)
+    return articles
+
+def iterLatestArticlePagesByDate(last_synced_date: str, posts_per_page=100):
+    """
+    Hand back the articles published after last_synced_date one page at a time, newest first
+
+    @param last_synced_date: Must be in format "yyyy-mm-dd hh:mm:ss"
+    @return: A generator of (page, articles newer than last_synced_date), articles is None if the page couldn't be fetched
+    """
     # Ensure date is in correct format
     try:
         last_synced_date_obj = datetime.strptime(last_synced_date, '%Y-%m-%d %H:%M:%S')
     except Exception as e:
         print(e)
-        return []
-    
-    articles = []
-    page_num = 1
+        return
 
+    page_num = 1
     while True:
-        one_page_articles = fetchArticles(starting_page=page_num,
-                                        ending_page=page_num)
-        if one_page_articles == []:
-            return []
-        
+        one_page_articles = fetchPage(page_num, posts_per_page)
+        if one_page_articles is None:
+            yield page_num, None
+            return
+
+        newer_articles = []
         for article in one_page_articles:
-            article_date = article['date']
-            article_date_obj = datetime.strptime(article_date, '%Y-%m-%dT%H:%M:%S')
+            article_date_obj = datetime.strptime(article['date'], '%Y-%m-%dT%H:%M:%S')
             # If there's a more recent article than last synced
             if article_date_obj > last_synced_date_obj:
-                articles.append(article)
+                newer_articles.append(article)
             else:
                 # If we found all recent articles
-                return articles
+                if newer_articles:
+                    yield page_num, newer_articles
+                return
+
+        yield page_num, newer_articles
+
+        # The last page
+        if len(one_page_articles) < posts_per_page:
+            return
         page_num += 1
@@ -0,0 +1,95 @@
+import re
+import time
+import hashlib
+import threading
+
+import requests
+from google.oauth2 import id_token
+from google.auth.transport import requests as google_requests
+
+from modules.lruCache import LRUCache
+
+# How many verified tokens to remember
+VERIFIED_TOKEN_CACHE_SIZE = 10000
+
+class CachingRequest(google_requests.Request):
+    """
+    google-auth transport that reuses one pooled session and caches GET responses
+    (Google's public signing certs) for as long as their Cache-Control max-age allows.
+    """
+    def __init__(self):
+        super().__init__(session=requests.Session())
+        self._lock = threading.Lock()
+        # url -> (response, time it expires)
+        self._responses = {}
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=None, **kwargs):
+        if method != "GET":
+            return super().__call__(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+
+        with self._lock:
+            cached = self._responses.get(url)
+            if cached and cached[1] > time.time():
+                return cached[0]
+
+        response = super().__call__(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+
+        max_age = _getMaxAge(response.headers)
+        if response.status == 200 and max_age:
+            with self._lock:
+                self._responses[url] = (response, time.time() + max_age)
+
+        return response
+
+def _getMaxAge(headers) -> int:
+    """
+    @return: The max-age of a Cache-Control header in seconds, or 0 if it shouldn't be cached
+    """
+    cache_control = headers.get("cache-control", "") if headers else ""
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return 0
+
+    match = re.search(r'max-age=(\d+)', cache_control)
+    return int(match.group(1)) if match else 0
+
+# Shared by every request so certs are only downloaded when Google says they expired
+_transport = CachingRequest()
+
+# sha256(token) -> verified token info, the number of entries is capped (every entry counts as 1)
+_verified_tokens = LRUCache(max_bytes=VERIFIED_TOKEN_CACHE_SIZE, sizeof=lambda id_info: 1)
+
+def verifyToken(token: str, client_id: str) -> dict:
+    """
+    Verify a Google ID token. Tokens that were already verified are answered from memory until they expire
+
+    @param token: The ID token sent by the frontend
+    @param client_id: Our Google OAuth client ID
+    @return: The token's claims (email, name, exp, ...)
+    @raise ValueError: If the token is invalid or expired
+    """
+    # Never keep raw tokens around, only their hash
+    key = (hashlib.sha256(token.encode("utf-8")).hexdigest(), client_id)
+
+    id_info = _verified_tokens.get(key)
+    if id_info is not None:
+        # Honor the token's own expiry
+        if id_info.get('exp', 0) > time.time():
+            return id_info
+        _verified_tokens.remove(key)
+
+    id_info = id_token.verify_oauth2_token(token, _transport, client_id)
+    _verified_tokens.put(key, id_info)
+
+    return id_info
+
+def isStudentMediaAccount(id_info: dict) -> bool:
+    """
+    Check if the email is verified and belongs to the correct domain
+    """
+    email = id_info.get('email')
+    email_verified = id_info.get('email_verified', False)
+
+    return bool(email_verified and email and email.endswith("@media.ucla.edu"))
+
+def getVerifiedTokenCacheStats() -> dict:
+    return _verified_tokens.stats()
@@ -0,0 +1,73 @@
+import threading
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+# Largest text (in utf-8 bytes) embedded as a single vector. Gemini rejects embedding requests
+# over 10000 bytes, so anything bigger is split before it's ever sent
+MAX_EMBED_BYTES = 9500
+# Characters shared by consecutive chunks, so a sentence cut in two is still whole in one of them
+CHUNK_OVERLAP = 200
+
+def textBytes(text: str) -> int:
+    """
+    @return: The size of text once sent to gemini (utf-8 bytes, which is what the limit counts)
+    """
+    return len(text.encode("utf-8"))
+
+class Chunker:
+    """
+    Decides from its size whether an article is embedded as one vector or split into chunks,
+    so oversized articles never cost a failing request. One splitter is shared by every article
+    (and every thread). Keeps statistics about the chunks it made.
+    """
+    def __init__(self, max_bytes: int = MAX_EMBED_BYTES, overlap: int = CHUNK_OVERLAP):
+        """
+        @param max_bytes: Largest text embedded as a single vector
+        @param overlap: Characters shared by consecutive chunks
+        """
+        self._max_bytes = max_bytes
+        # Measure in bytes, so multi-byte characters (accents, quotes, emoji) can't push a chunk over the limit
+        self._splitter = RecursiveCharacterTextSplitter(chunk_size=max_bytes - overlap,
+                                                        chunk_overlap=overlap,
+                                                        length_function=textBytes)
+
+        self._lock = threading.Lock()
+        self._articles = 0
+        self._chunked = 0
+        self._chunks = 0
+        self._chunk_bytes = 0
+        self._max_chunk_bytes = 0
+        self._max_chunks = 0
+
+    def split(self, text: str) -> tuple:
+        """
+        @return: (passages, chunked), passages is [text] if it fits in one vector
+        """
+        size = textBytes(text)
+        if size <= self._max_bytes:
+            self._record([size], chunked=False)
+            return [text], False
+
+        passages = self._splitter.split_text(text)
+        self._record([textBytes(passage) for passage in passages], chunked=True)
+        return passages, True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "articles": self._articles,
+                "chunked_articles": self._chunked,
+                "chunks": self._chunks,
+                "mean_chunk_bytes": round(self._chunk_bytes / self._chunks) if self._chunks else None,
+                "max_chunk_bytes": self._max_chunk_bytes,
+                "max_chunks_per_article": self._max_chunks,
+            }
+
+    def _record(self, sizes: list, chunked: bool):
+        with self._lock:
+            self._articles += 1
+            self._chunked += int(chunked)
+            self._chunks += len(sizes)
+            self._chunk_bytes += sum(sizes)
+            self._max_chunk_bytes = max([self._max_chunk_bytes] + sizes)
+            self._max_chunks = max(self._max_chunks, len(sizes))
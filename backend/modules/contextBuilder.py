@@ -0,0 +1,234 @@
+import re
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.articleCleaner import clean_article
+from modules.articleFetcher import fetchArticleById, fetchArticleByIdAsync, ARTICLE_FETCH_TIMEOUT
+from modules.metrics import span
+
+# Max number of articles fetched from wordpress at the same time (shared by every request)
+FETCH_WORKERS = 8
+
+# Max (estimated) tokens of article text put in the prompt, split between the matches
+CONTEXT_TOKEN_BUDGET = 6000
+# Rough average for english text
+CHARS_PER_TOKEN = 4
+
+# One bounded pool for the whole process, so a burst of queries can't open unlimited connections
+_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="article-fetch")
+
+def getArticleId(match_id: str) -> str:
+    """
+    Get the article id of a vector match (incase it's a chunk, only get whatever is before '_')
+    ex: if id="18352_chunk0", we only want id="18352"
+    """
+    return match_id.split('_')[0]
+
+def _fetchAndClean(id: str, timeout: float) -> str:
+    # Get article
+    article = fetchArticleById(id, timeout=timeout)
+
+    # Clean article
+    with span("cleaning"):
+        return clean_article(article)
+
+def fetchCleanedArticles(ids: list, timeout: float = ARTICLE_FETCH_TIMEOUT) -> list:
+    """
+    Fetch and clean several articles in parallel
+
+    @param ids: The article ids to fetch
+    @param timeout: Seconds to wait on each wordpress request
+    @return: The cleaned articles, in the same order as ids
+    """
+    # Each fetch runs in a copy of the caller's context, so its timings count towards the caller's request
+    futures = [_executor.submit(contextvars.copy_context().run, _fetchAndClean, id, timeout) for id in ids]
+
+    # Results are collected in submission order, no matter which fetch finishes first
+    return [future.result() for future in futures]
+
+def getChunkIndex(match_id: str):
+    """
+    Get the chunk number of a vector match
+    ex: if id="18352_chunk3", we want 3. If id="18352" (embedded whole), we want None
+    """
+    match = re.search(r'_chunk(\d+)$', match_id)
+    return int(match.group(1)) if match else None
+
+def estimateTokens(text: str) -> int:
+    """
+    Rough token count of a text (good enough for budgeting, no tokenizer call needed)
+    """
+    return len(text) // CHARS_PER_TOKEN
+
+def selectPassage(content: str, chunk_bounds: list, chunk_index, char_budget: int) -> str:
+    """
+    Pick the part of an article to use as context: the matched chunk, grown into its
+    neighboring chunks while the budget allows, or cut down if the chunk alone is too long
+
+    @param content: The cleaned article text
+    @param chunk_bounds: (start, end) offsets of the article's embedded chunks, or None if unknown
+    @param chunk_index: Which chunk matched, None if the article was embedded whole
+    @param char_budget: Max number of characters to return
+    """
+    if chunk_bounds and chunk_index is not None and chunk_index < len(chunk_bounds):
+        start, end = chunk_bounds[chunk_index]
+        # Neighbors are the previous and next chunks (or nothing at the edges of the article)
+        lowest_start = chunk_bounds[chunk_index - 1][0] if chunk_index > 0 else start
+        highest_end = chunk_bounds[chunk_index + 1][1] if chunk_index + 1 < len(chunk_bounds) else end
+    else:
+        # Whole article match (or no recorded chunks), start from the top of the article
+        start, end = 0, len(content)
+        lowest_start, highest_end = start, end
+
+    if end - start >= char_budget:
+        end = start + char_budget
+    else:
+        # Split the spare budget between both neighbors, giving whatever one side can't use to the other
+        spare = char_budget - (end - start)
+        right = min(highest_end - end, spare - min(start - lowest_start, spare // 2))
+        left = min(start - lowest_start, spare - right)
+        start, end = start - left, end + right
+
+    passage = content[start:end]
+
+    # Don't leave half words at the edges we cut (a cut next to whitespace is already between two words)
+    if 0 < start < end and not content[start - 1].isspace() and not content[start].isspace():
+        words = passage.split(None, 1)
+        passage = words[1] if len(words) > 1 else passage
+    if start < end < len(content) and not content[end - 1].isspace() and not content[end].isspace():
+        words = passage.rsplit(None, 1)
+        passage = words[0] if len(words) > 1 else passage
+
+    return passage
+
+def formatContext(matches: list, ids: list, cleaned_articles: dict, chunk_bounds: dict = None,
+                  token_budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    Format the matched parts of the cleaned articles as the context blocks fed to the LLM
+
+    @param matches: The vector query matches, in order
+    @param ids: The article id of each match
+    @param cleaned_articles: A dict of article id -> cleaned article text
+    @param chunk_bounds: A dict of article id -> (start, end) offsets of its chunks (see DocumentStore.get_chunks)
+    @param token_budget: Max (estimated) tokens of article text in the whole context, None for whole articles
+    """
+    chunk_bounds = chunk_bounds or {}
+
+    # The same chunk only needs to be in the prompt once
+    selected = []
+    seen = set()
+    for match, id in zip(matches, ids):
+        chunk_index = getChunkIndex(match['id'])
+        if (id, chunk_index) not in seen:
+            seen.add((id, chunk_index))
+            selected.append((match, id, chunk_index))
+
+    passages = [cleaned_articles[id] for _, id, _ in selected]
+    if token_budget is not None:
+        # How much each match would use with no budget (its chunk plus neighbors)
+        wanted = [len(selectPassage(cleaned_articles[id], chunk_bounds.get(id), chunk_index, len(cleaned_articles[id])))
+                  for _, id, chunk_index in selected]
+
+        # Hand out the budget smallest first, so whatever a short match doesn't need goes to the longer ones
+        remaining_chars = token_budget * CHARS_PER_TOKEN
+        char_budgets = {}
+        by_size = sorted(range(len(selected)), key=lambda k: wanted[k])
+        for position, k in enumerate(by_size):
+            char_budgets[k] = min(wanted[k], remaining_chars // (len(selected) - position))
+            remaining_chars -= char_budgets[k]
+
+        passages = [selectPassage(cleaned_articles[id], chunk_bounds.get(id), chunk_index, char_budgets[k])
+                    for k, (_, id, chunk_index) in enumerate(selected)]
+
+    context = ""
+    for (match, _, _), cleanedArticle in zip(selected, passages):
+        # Add context to feed into LLM
+        link = match['metadata']['link']
+        context += f"""\nARTICLE START (Source: {link})\n
+        {cleanedArticle}
+        \nARTICLE END\n
+        """
+
+    return context
+
+def buildContext(matches: list, document_store=None, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 timeout: float = ARTICLE_FETCH_TIMEOUT) -> str:
+    """
+    Build the LLM context out of the matches returned by a vector query
+
+    @param matches: The 'matches' list of a pinecone query result
+    @param document_store: Optional DocumentStore to read cleaned articles (and their chunk offsets) from before falling back to wordpress
+    @param token_budget: Max (estimated) tokens of article text in the context, None for whole articles
+    @param timeout: Seconds to wait on each wordpress request
+    @return: The articles formatted as context blocks, in match order
+    """
+    return buildContexts([matches], document_store=document_store, token_budget=token_budget, timeout=timeout)[0]
+
+def buildContexts(matches_list: list, document_store=None, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                  timeout: float = ARTICLE_FETCH_TIMEOUT) -> list:
+    """
+    Build the LLM context of several queries at once. An article matched by more than
+    one query is only read (or fetched from wordpress) once.
+
+    @param matches_list: The 'matches' list of each pinecone query result
+    @return: One context per matches list, in the same order
+    """
+    ids_list = [[getArticleId(match['id']) for match in matches] for matches in matches_list]
+    ids = list(dict.fromkeys(id for ids in ids_list for id in ids))
+
+    with span("article_fetch"):
+        # Use the articles cleaned at ingest time when we have them
+        stored_articles = document_store.get_articles(ids) if document_store else {}
+        chunk_bounds = document_store.get_chunks(ids) if document_store else {}
+
+        # Only go out to wordpress for the articles that are missing
+        missing_ids = [id for id in ids if id not in stored_articles]
+        if missing_ids:
+            stored_articles.update(zip(missing_ids, fetchCleanedArticles(missing_ids, timeout=timeout)))
+
+    with span("prompt_build"):
+        return [formatContext(matches, ids, stored_articles, chunk_bounds, token_budget)
+                for matches, ids in zip(matches_list, ids_list)]
+
+async def _fetchAndCleanAsync(client, id: str, timeout: float) -> str:
+    article = await fetchArticleByIdAsync(client, id, timeout=timeout)
+
+    # Parsing html is CPU work, keep it off the event loop
+    with span("cleaning"):
+        return await asyncio.to_thread(clean_article, article)
+
+async def buildContextAsync(matches: list, client, document_store=None, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                            timeout: float = ARTICLE_FETCH_TIMEOUT) -> str:
+    """
+    Async version of buildContext, all missing articles are fetched concurrently
+
+    @param client: An httpx.AsyncClient used for the wordpress requests
+    """
+    contexts = await buildContextsAsync([matches], client, document_store=document_store,
+                                        token_budget=token_budget, timeout=timeout)
+    return contexts[0]
+
+async def buildContextsAsync(matches_list: list, client, document_store=None, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                             timeout: float = ARTICLE_FETCH_TIMEOUT) -> list:
+    """
+    Async version of buildContexts
+    """
+    ids_list = [[getArticleId(match['id']) for match in matches] for matches in matches_list]
+    ids = list(dict.fromkeys(id for ids in ids_list for id in ids))
+
+    with span("article_fetch"):
+        # Use the articles cleaned at ingest time when we have them
+        stored_articles = document_store.get_articles(ids) if document_store else {}
+        chunk_bounds = document_store.get_chunks(ids) if document_store else {}
+
+        # Only go out to wordpress for the articles that are missing
+        missing_ids = [id for id in ids if id not in stored_articles]
+        if missing_ids:
+            # gather() keeps the results in the same order as missing_ids
+            cleaned_articles = await asyncio.gather(*[_fetchAndCleanAsync(client, id, timeout) for id in missing_ids])
+            stored_articles.update(zip(missing_ids, cleaned_articles))
+
+    with span("prompt_build"):
+        return [formatContext(matches, ids, stored_articles, chunk_bounds, token_budget)
+                for matches, ids in zip(matches_list, ids_list)]
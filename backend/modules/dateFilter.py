@@ -0,0 +1,117 @@
+import re
+from datetime import datetime, timezone
+
+# The Daily Bruin's first year, anything earlier is not a year we have articles for
+FIRST_YEAR = 1919
+
+MONTHS = {
+    "january": 1, "jan": 1, "february": 2, "feb": 2, "march": 3, "mar": 3, "april": 4, "apr": 4,
+    "may": 5, "june": 6, "jun": 6, "july": 7, "jul": 7, "august": 8, "aug": 8,
+    "september": 9, "sept": 9, "sep": 9, "october": 10, "oct": 10, "november": 11, "nov": 11,
+    "december": 12, "dec": 12,
+}
+
+_YEAR = r"((?:19|20)\d{2})"
+_MONTH = r"(" + "|".join(sorted(MONTHS, key=len, reverse=True)) + r")\.?"
+_SEASON = r"(?:fall|spring|winter|summer)"
+
+# A year on its own is only a date next to words that make it one, so numbers like
+# "number 2000" or "1999 yards" don't filter anything out
+_YEAR_IN_CONTEXT = [
+    # ex: "in 2019", "during 2019", "in fall 2019" (but not "in the 2000 block")
+    r"\b(?:in|during|throughout|until|till)\s+(?:" + _SEASON + r"\s+(?:of\s+)?)?" + _YEAR + r"\b",
+    # ex: "fall 2019", "spring of 2019"
+    r"\b" + _SEASON + r"\s+(?:of\s+)?" + _YEAR + r"\b",
+    # ex: "the 2019 season", "2019 fall quarter", "the 2019 school year"
+    r"\b" + _YEAR + r"\s+(?:" + _SEASON + r"\s+)?(?:season|quarter|school year|academic year)\b",
+]
+# ex: "'19" (but not "'90s" or "rock'n'roll")
+_SHORT_YEAR = r"(?<![\w'’])['’](\d{2})\b"
+
+def dateToTimestamp(date_gmt: str) -> int:
+    """
+    Convert a wordpress date_gmt (ex: "2024-05-03T17:02:11") to a unix timestamp, used as numeric metadata
+    """
+    return int(datetime.fromisoformat(date_gmt).replace(tzinfo=timezone.utc).timestamp())
+
+def _timestamp(year: int, month: int = 1) -> int:
+    # Months past december roll over into the next year
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp())
+
+def _isYear(year: int, now: datetime) -> bool:
+    return FIRST_YEAR <= year <= now.year
+
+def _shortYear(digits: str, now: datetime) -> int:
+    # The most recent year ending in those digits, ex: "'19" -> 2019, "'98" -> 1998
+    year = (now.year // 100) * 100 + int(digits)
+    return year if year <= now.year else year - 100
+
+def extractDateRange(query: str, now: datetime = None):
+    """
+    Find the dates a question is explicitly about
+    ex: "what happened at homecoming in 2019", "the 2019 season", "fall '19" -> all of 2019
+        "games between 2015 and 2017", "2015-17 seasons" -> 2015 through 2017
+        "october 2020 protests" -> october 2020
+        "since 2021", "from 2021 on", "before 2000", "this year", "last year"
+    A number that is only shaped like a year isn't one (ex: "who wore number 2000", "1999 yards",
+    "advice from 2000 alumni")
+
+    @param now: The current time, default is now (UTC)
+    @return: (start, end) unix timestamps (start included, end excluded), or None if the question has no dates
+    """
+    now = now or datetime.now(timezone.utc)
+    text = query.lower()
+
+    # Month and year, ex: "may 2019"
+    match = re.search(_MONTH + r"\s+(?:of\s+)?" + _YEAR + r"\b", text)
+    if match and _isYear(int(match.group(2)), now):
+        year, month = int(match.group(2)), MONTHS[match.group(1)]
+        return _timestamp(year, month), _timestamp(year, month + 1)
+
+    # Ranges, ex: "between 2015 and 2017", "from 2015 to 2017", "2015-2017", "2015-17"
+    match = (re.search(r"\b" + _YEAR + r"\s*(?:-|–|to|through|until)\s*(\d{4}|\d{2})\b", text)
+             or re.search(r"\bbetween\s+" + _YEAR + r"\s+and\s+" + _YEAR + r"\b", text))
+    if match:
+        start = int(match.group(1))
+        end = match.group(2)
+        # "2015-17" means 2017
+        end = int(end) if len(end) == 4 else (start // 100) * 100 + int(end)
+        if _isYear(start, now) and start <= end:
+            return _timestamp(start), _timestamp(min(end, now.year) + 1)
+
+    # Open ended, ex: "since 2021", "before 2000", "from 2015 on" ("from" alone isn't a date,
+    # ex: "advice from 2000 alumni", and "from 2015 to 2017" is a range)
+    match = (re.search(r"\b(since|after|before|prior to)\s+" + _YEAR + r"\b", text)
+             or re.search(r"\b(from)\s+" + _YEAR + r"\s+(?:on|onwards?|forward)\b", text))
+    if match and _isYear(int(match.group(2)), now):
+        year = int(match.group(2))
+        if match.group(1) in ("since", "from"):
+            return _timestamp(year), _timestamp(now.year + 1)
+        if match.group(1) == "after":
+            return _timestamp(year + 1), _timestamp(now.year + 1)
+        return _timestamp(FIRST_YEAR), _timestamp(year)
+
+    # Single years, ex: "in 2019", "the 2019 season", "'19"
+    years = [int(year) for pattern in _YEAR_IN_CONTEXT for year in re.findall(pattern, text)]
+    years += [_shortYear(digits, now) for digits in re.findall(_SHORT_YEAR, text)]
+    years = [year for year in years if _isYear(year, now)]
+    if years:
+        return _timestamp(min(years)), _timestamp(max(years) + 1)
+
+    if re.search(r"\bthis year\b", text):
+        return _timestamp(now.year), _timestamp(now.year + 1)
+    if re.search(r"\blast year\b", text):
+        return _timestamp(now.year - 1), _timestamp(now.year)
+
+    return None
+
+def buildDateFilter(date_range) -> dict:
+    """
+    @param date_range: (start, end) unix timestamps, as returned by extractDateRange
+    @return: A pinecone metadata filter on the "timestamp" field, or None if there's no range
+    """
+    if date_range is None:
+        return None
+    start, end = date_range
+    return {"timestamp": {"$gte": start, "$lt": end}}
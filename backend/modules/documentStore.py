@@ -0,0 +1,211 @@
+import sqlite3
+import threading
+
+def chunkOffsets(content: str, chunk_texts: list) -> list:
+    """
+    @param content: The cleaned article text
+    @param chunk_texts: Chunks of it, in order (they may overlap)
+    @return: The (start, end) character offsets of each chunk in content
+    """
+    offsets = []
+    cursor = 0
+    for chunk_text in chunk_texts:
+        start = content.find(chunk_text, cursor)
+        if start == -1:
+            # The splitter changed the text (ex: stripped whitespace), the cursor is the best guess
+            start = cursor
+        offsets.append((start, min(start + len(chunk_text), len(content))))
+        cursor = start + 1
+    return offsets
+
+class DocumentStore:
+    """
+    On-disk store of cleaned articles, keyed by article id.
+
+    Written to by store.py/update.py at ingest time and read by the query path,
+    so answering a query doesn't have to download and re-clean every article.
+    Safe to share across threads (each thread gets its own sqlite connection).
+    """
+    def __init__(self, db_path: str):
+        self._db_path = db_path
+        self._local = threading.local()
+
+        connection = self._connection()
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS articles (
+                id TEXT PRIMARY KEY,
+                link TEXT,
+                date_gmt TEXT,
+                modified TEXT,
+                content TEXT NOT NULL,
+                date TEXT
+            )
+        """)
+        # Stores created before the local date was kept (needed to rebuild vector metadata, see warmIndex.py)
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(articles)")]
+        if "date" not in columns:
+            connection.execute("ALTER TABLE articles ADD COLUMN date TEXT")
+        # Character offsets into the cleaned content of every embedded chunk
+        # (an article embedded whole has a single chunk 0 covering all of it)
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                article_id TEXT NOT NULL,
+                chunk_index INTEGER NOT NULL,
+                start_offset INTEGER NOT NULL,
+                end_offset INTEGER NOT NULL,
+                PRIMARY KEY (article_id, chunk_index)
+            )
+        """)
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        connection.commit()
+
+    def put_articles(self, articles: list) -> int:
+        """
+        Insert or replace cleaned articles
+
+        @param articles: Wordpress article JSONs whose content has already been cleaned (see clean_all_articles)
+        @return: How many articles were written
+        """
+        rows = []
+        for article in articles:
+            content = article['content']['rendered']
+            article_id = str(article.get('id', ''))
+
+            # Same rule as embedding: need both content and an id
+            if content and article_id:
+                rows.append((article_id,
+                             article.get('link'),
+                             article.get('date_gmt'),
+                             article.get('modified'),
+                             content,
+                             article.get('date')))
+
+        # An update rather than a replace, so the lexical index sees the old text go (see LexicalIndex)
+        connection = self._connection()
+        connection.executemany("""
+            INSERT INTO articles (id, link, date_gmt, modified, content, date) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET link = excluded.link, date_gmt = excluded.date_gmt,
+                modified = excluded.modified, content = excluded.content, date = excluded.date
+        """, rows)
+        connection.commit()
+
+        return len(rows)
+
+    def get_article(self, article_id: str):
+        """
+        @return: The cleaned article text, or None if it isn't stored
+        """
+        row = self._connection().execute("SELECT content FROM articles WHERE id = ?",
+                                         (str(article_id),)).fetchone()
+        return row[0] if row else None
+
+    def get_articles(self, article_ids: list) -> dict:
+        """
+        @return: A dict of article id -> cleaned article text, only for the ids that are stored
+        """
+        ids = list({str(article_id) for article_id in article_ids})
+        if not ids:
+            return {}
+
+        placeholders = ",".join("?" * len(ids))
+        rows = self._connection().execute(f"SELECT id, content FROM articles WHERE id IN ({placeholders})",
+                                          ids).fetchall()
+        return dict(rows)
+
+    def put_chunks(self, article_id: str, content: str, chunk_texts: list):
+        """
+        Record where each embedded chunk of an article starts and ends
+
+        @param article_id: The id of the article
+        @param content: The cleaned article text
+        @param chunk_texts: The chunks, in order, exactly as they were embedded (ex: [content] if it wasn't split)
+        """
+        rows = [(str(article_id), i, start, end) for i, (start, end) in enumerate(chunkOffsets(content, chunk_texts))]
+
+        connection = self._connection()
+        connection.execute("DELETE FROM chunks WHERE article_id = ?", (str(article_id),))
+        connection.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", rows)
+        connection.commit()
+
+    def get_chunks(self, article_ids: list) -> dict:
+        """
+        @return: A dict of article id -> list of (start offset, end offset), ordered by chunk index
+                 (only for the ids that have chunks recorded)
+        """
+        ids = list({str(article_id) for article_id in article_ids})
+        if not ids:
+            return {}
+
+        placeholders = ",".join("?" * len(ids))
+        rows = self._connection().execute(f"""
+            SELECT article_id, start_offset, end_offset FROM chunks
+            WHERE article_id IN ({placeholders})
+            ORDER BY article_id, chunk_index
+        """, ids).fetchall()
+
+        chunks = {}
+        for article_id, start, end in rows:
+            chunks.setdefault(article_id, []).append((start, end))
+        return chunks
+
+    def iter_articles(self, batch_size: int = 500):
+        """
+        Go through every stored article, batch_size at a time (without loading them all in memory)
+
+        @return: A generator of lists of dicts with "id", "link", "date", "date_gmt" and "content"
+        """
+        last_id = ""
+        while True:
+            rows = self._connection().execute("""
+                SELECT id, link, date, date_gmt, content FROM articles
+                WHERE id > ? ORDER BY id LIMIT ?
+            """, (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+
+            yield [{"id": article_id, "link": link, "date": date, "date_gmt": date_gmt, "content": content}
+                   for article_id, link, date, date_gmt, content in rows]
+            last_id = rows[-1][0]
+
+    def get_modified(self, article_id: str):
+        """
+        @return: The wordpress 'modified' timestamp of the stored article, or None if it isn't stored
+        """
+        row = self._connection().execute("SELECT modified FROM articles WHERE id = ?",
+                                         (str(article_id),)).fetchone()
+        return row[0] if row else None
+
+    def get_corpus_version(self) -> int:
+        """
+        @return: A counter that changes every time new articles are ingested (0 if nothing was ingested yet)
+        """
+        row = self._connection().execute("SELECT value FROM meta WHERE key = 'corpus_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def bump_corpus_version(self) -> int:
+        """
+        Mark that new articles were ingested, so anything derived from the old corpus (ex: cached answers) expires
+
+        @return: The new corpus version
+        """
+        connection = self._connection()
+        version = self.get_corpus_version() + 1
+        connection.execute("INSERT OR REPLACE INTO meta VALUES ('corpus_version', ?)", (str(version),))
+        connection.commit()
+
+        return version
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads, so keep one per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._db_path)
+            # WAL lets the web app keep reading while an ingest script is writing
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
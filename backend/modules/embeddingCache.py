@@ -0,0 +1,176 @@
+import re
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+from modules.lruCache import LRUCache
+
+def normalizeQuery(query: str) -> str:
+    """
+    Normalize a query so trivially different questions share a cache entry
+    ex: "  Did UCLA beat USC? " and "did ucla   beat usc" both become "did ucla beat usc"
+    """
+    query = re.sub(r'\s+', ' ', query).strip().lower()
+    return query.rstrip("?!. ")
+
+class QueryEmbeddingCache:
+    """
+    Thread-safe cache of query embeddings, keyed by embedding model and normalized query text.
+
+    Lookups go to an in-memory LRU first. If db_path is given, entries are also
+    persisted to sqlite so the cache survives restarts.
+    """
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024, db_path: str = None):
+        """
+        @param max_bytes: Size cap of the in-memory LRU, in bytes
+        @param db_path: Optional sqlite file to persist embeddings to, default is None (memory only)
+        """
+        # Embeddings are kept as float32 arrays (4 bytes per dimension)
+        self._memory = LRUCache(max_bytes=max_bytes, sizeof=lambda vector: vector.itemsize * len(vector))
+        self._db_path = db_path
+        self._local = threading.local()
+
+        if self._db_path:
+            connection = self._connection()
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS query_embeddings (
+                    model TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    PRIMARY KEY (model, query)
+                )
+            """)
+            connection.commit()
+
+    def get(self, embedding_model: str, query: str):
+        """
+        @return: The cached embedding as a list of floats, or None on a miss
+        """
+        key = (embedding_model, normalizeQuery(query))
+
+        vector = self._memory.get(key)
+        if vector is None and self._db_path:
+            row = self._connection().execute("SELECT embedding FROM query_embeddings WHERE model = ? AND query = ?",
+                                             key).fetchone()
+            if row:
+                vector = array('f', row[0])
+                # Promote to memory so the next lookup doesn't touch disk
+                self._memory.put(key, vector)
+
+        return vector.tolist() if vector is not None else None
+
+    def put(self, embedding_model: str, query: str, embedding: list):
+        key = (embedding_model, normalizeQuery(query))
+        vector = array('f', embedding)
+
+        self._memory.put(key, vector)
+        if self._db_path:
+            connection = self._connection()
+            connection.execute("INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?)",
+                               (*key, vector.tobytes()))
+            connection.commit()
+
+    def stats(self) -> dict:
+        return self._memory.stats()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads, so keep one per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._db_path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+def contentHash(text: str) -> str:
+    """
+    @return: A hash of the exact text that was embedded (any change to it, even whitespace, changes the hash)
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ArticleEmbeddingCache:
+    """
+    Persistent cache of article (and chunk) embeddings, keyed by embedding model and a hash of the
+    exact text embedded.
+
+    Re-storing articles whose cleaned text hasn't changed costs no gemini calls, and a fresh index
+    can be filled from it without embedding anything (see warmIndex.py). Safe to share across threads.
+    """
+    # Most hashes looked up in one query (sqlite limits the number of parameters)
+    _LOOKUP_SIZE = 500
+
+    def __init__(self, db_path: str):
+        """
+        @param db_path: The sqlite file to keep embeddings in
+        """
+        self._db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._writes = 0
+
+        connection = self._connection()
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS article_embeddings (
+                model TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                PRIMARY KEY (model, content_hash)
+            )
+        """)
+        connection.commit()
+
+    def get_many(self, embedding_model: str, texts: list) -> list:
+        """
+        @return: The cached embeddings (lists of floats), in the same order as texts (None for every miss)
+        """
+        hashes = [contentHash(text) for text in texts]
+        found = {}
+        connection = self._connection()
+        for start in range(0, len(hashes), self._LOOKUP_SIZE):
+            lookup = list(set(hashes[start:start + self._LOOKUP_SIZE]))
+            placeholders = ",".join("?" * len(lookup))
+            rows = connection.execute(f"""
+                SELECT content_hash, embedding FROM article_embeddings
+                WHERE model = ? AND content_hash IN ({placeholders})
+            """, (embedding_model, *lookup)).fetchall()
+            found.update(rows)
+
+        embeddings = [array('f', found[h]).tolist() if h in found else None for h in hashes]
+
+        hits = sum(embedding is not None for embedding in embeddings)
+        with self._lock:
+            self._hits += hits
+            self._misses += len(embeddings) - hits
+        return embeddings
+
+    def put_many(self, embedding_model: str, texts: list, embeddings: list):
+        """
+        @param embeddings: In the same order as texts, None entries (texts that couldn't be embedded) are left out
+        """
+        rows = [(embedding_model, contentHash(text), array('f', embedding).tobytes())
+                for text, embedding in zip(texts, embeddings) if embedding is not None]
+        if not rows:
+            return
+
+        connection = self._connection()
+        connection.executemany("INSERT OR REPLACE INTO article_embeddings VALUES (?, ?, ?)", rows)
+        connection.commit()
+
+        with self._lock:
+            self._writes += len(rows)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses, "writes": self._writes}
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads, so keep one per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._db_path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
@@ -1,3 +1,122 @@
+import time
+import random
+import asyncio
+
+from google.api_core import exceptions as google_exceptions
+
+from modules.dateFilter import dateToTimestamp
+
+# Most texts gemini embeds in one batchEmbedContents request
+EMBED_BATCH_SIZE = 100
+# Times a batch is retried when gemini is rate limiting or unavailable, with exponential backoff (seconds)
+EMBED_RETRIES = 5
+EMBED_BACKOFF = 2.0
+
+# Errors worth retrying the same request for (anything else is a problem with the texts themselves)
+_TRANSIENT_ERRORS = (google_exceptions.ResourceExhausted,
+                     google_exceptions.ServiceUnavailable,
+                     google_exceptions.DeadlineExceeded,
+                     google_exceptions.InternalServerError)
+
+def articleVector(article, values: list, chunk: int = None, chunk_total: int = None) -> dict:
+    """
+    Build the vector upserted for an article (or one of its chunks)
+
+    @param article: The article, including its id, link, date, etc (not just the page content)
+    @param values: The embedding
+    @param chunk: The chunk number, None if the whole article was embedded
+    @param chunk_total: How many chunks the article was split into
+    """
+    metadata = {
+        "date": article['date'],
+        "date_gmt": article['date_gmt'],
+        # Numeric, so queries can filter on a date range
+        "timestamp": dateToTimestamp(article['date_gmt']),
+        "link": article['link']
+    }
+    if chunk is None:
+        return {"id": str(article['id']), "values": values, "metadata": metadata}
+
+    # The id for this is a bit different, with a chunk number added to the end (to preserve unique ids)
+    metadata["chunk_total"] = chunk_total
+    return {"id": f"{str(article['id'])}_chunk{chunk}", "values": values, "metadata": metadata}
+
+def embedTexts(genai, embedding_model: str, texts: list, batch_size: int = EMBED_BATCH_SIZE, cache=None) -> list:
+    """
+    Embed many texts with as few gemini calls as possible (batch_size texts per call)
+
+    A batch that gemini rejects as invalid (400) is split in half and retried until the texts it can't embed
+    are found, so one bad text only fails itself. Rate limits and outages are retried with backoff.
+
+    @param genai: The google gemini variable
+    @param embedding_model: As a string, what embedding model to use
+    @param texts: The texts to embed
+    @param cache: Optional ArticleEmbeddingCache, only the texts it doesn't have are sent to gemini
+    @return: The embeddings, in the same order as texts (None for every text gemini rejected)
+    @raise Exception: Any other error (ex: a bad API key, or an outage that outlasted the retries)
+    """
+    embeddings = cache.get_many(embedding_model, texts) if cache is not None else [None] * len(texts)
+
+    # The same text twice (ex: a repeated boilerplate article) is only embedded once
+    missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+    if not missing:
+        return embeddings
+
+    new_embeddings = []
+    for start in range(0, len(missing), batch_size):
+        new_embeddings.extend(_embedBatch(genai, embedding_model, missing[start:start + batch_size]))
+    if cache is not None:
+        cache.put_many(embedding_model, missing, new_embeddings)
+
+    new_embeddings = dict(zip(missing, new_embeddings))
+    return [embedding if embedding is not None else new_embeddings[text] for text, embedding in zip(texts, embeddings)]
+
+def _embedBatch(genai, embedding_model: str, texts: list) -> list:
+    for attempt in range(EMBED_RETRIES + 1):
+        try:
+            # Passing a list makes gemini use batchEmbedContents
+            response = genai.embed_content(
+                model=embedding_model,
+                content=texts)
+            return response['embedding']
+        except _TRANSIENT_ERRORS as e:
+            if attempt == EMBED_RETRIES:
+                print(f"Error embedding {len(texts)} texts, giving up after {attempt + 1} attempts: {e}")
+                raise
+            time.sleep(random.uniform(0, EMBED_BACKOFF * 2 ** attempt))
+        # Only a rejected request is worth splitting up, anything else would fail every half the same way
+        except google_exceptions.InvalidArgument as e:
+            if len(texts) == 1:
+                print(f"Error embedding text: {e}")
+                return [None]
+
+            # Find out which texts gemini doesn't like
+            middle = len(texts) // 2
+            return _embedBatch(genai, embedding_model, texts[:middle]) + _embedBatch(genai, embedding_model, texts[middle:])
+
+async def _embedBatchAsync(genai, embedding_model: str, texts: list) -> list:
+    # Async version of _embedBatch
+    for attempt in range(EMBED_RETRIES + 1):
+        try:
+            response = await genai.embed_content_async(
+                model=embedding_model,
+                content=texts)
+            return response['embedding']
+        except _TRANSIENT_ERRORS as e:
+            if attempt == EMBED_RETRIES:
+                print(f"Error embedding {len(texts)} texts, giving up after {attempt + 1} attempts: {e}")
+                raise
+            await asyncio.sleep(random.uniform(0, EMBED_BACKOFF * 2 ** attempt))
+        # Only a rejected request is worth splitting up, anything else would fail every half the same way
+        except google_exceptions.InvalidArgument as e:
+            if len(texts) == 1:
+                print(f"Error embedding text: {e}")
+                return [None]
+
+            middle = len(texts) // 2
+            return (await _embedBatchAsync(genai, embedding_model, texts[:middle])
+                    + await _embedBatchAsync(genai, embedding_model, texts[middle:]))
+
 
 def embedArticle(genai, embeddings: list, embedding_model: str, article):
     """
@@ -18,19 +137,8 @@ def embedArticle(genai, embeddings: list, embedding_model: str, article):
         content=content)
     embedding_vector = embedding_response['embedding']
 
-    # The new embedding that will be added to the embeddings array
-    new_embedding = {
-        "id": article_id,
-        "values": embedding_vector,
-        "metadata": {
-            "date": article['date'],
-            "date_gmt": article['date_gmt'],
-            "link": article['link']
-        }
-    }
-
     # Append the new embedding
-    embeddings.append(new_embedding)
+    embeddings.append(articleVector(article, embedding_vector))
 
 def embedChunksAsArticle(genai, embeddings: list, embedding_model: str, article, split_texts: list):
     """
@@ -55,17 +163,7 @@ def embedChunksAsArticle(genai, embeddings: list, embedding_model: str, article,
             embedding_vector = embedding_response['embedding']
         
             # Append to embeddings list
-            # The id for this is a bit different, with a chunk number added to the end (to preserve unique ids)
-            new_embeddings.append({
-                "id": f"{str(article['id'])}_chunk{i}",
-                "values": embedding_vector,
-                "metadata": {
-                    "date": article['date'],
-                    "date_gmt": article['date_gmt'],
-                    "link": article['link'],
-                    "chunk_total": len(split_texts)
-                }
-            })
+            new_embeddings.append(articleVector(article, embedding_vector, chunk=i, chunk_total=len(split_texts)))
         # If there was an error embedding
         except Exception as e:
             print(e)
@@ -77,14 +175,21 @@ def embedChunksAsArticle(genai, embeddings: list, embedding_model: str, article,
     # Return True indicating success
     return True
 
-def generateQueryEmbedding(genai, embedding_model: str, query: str):
+def generateQueryEmbedding(genai, embedding_model: str, query: str, cache=None):
     """
     Convert a query to an embedding using google gemini
 
     @param genai: The google gemini variable
     @param embedding_model: As a string, what embedding model to use
     @param query: The query string
+    @param cache: Optional QueryEmbeddingCache, repeated queries are answered from it instead of calling gemini
     """
+    # Check if we've already embedded this (normalized) query
+    if cache is not None:
+        cached_embedding = cache.get(embedding_model, query)
+        if cached_embedding is not None:
+            return cached_embedding
+
     # Convert the query to an embedding
     try:
         embedding = genai.embed_content(
@@ -92,9 +197,106 @@ def generateQueryEmbedding(genai, embedding_model: str, query: str):
             content=query
         )
 
+        if cache is not None:
+            cache.put(embedding_model, query, embedding["embedding"])
+
         # Return the query embedding
         return embedding["embedding"] 
     # If an error, return None
     except Exception as e:
         print(f"Error generating query embedding: {e}")
-        return None
\ No newline at end of file
+        return None
+
+async def generateQueryEmbeddingAsync(genai, embedding_model: str, query: str, cache=None):
+    """
+    Async version of generateQueryEmbedding
+    """
+    # Check if we've already embedded this (normalized) query
+    if cache is not None:
+        cached_embedding = cache.get(embedding_model, query)
+        if cached_embedding is not None:
+            return cached_embedding
+
+    # Convert the query to an embedding
+    try:
+        embedding = await genai.embed_content_async(
+            model=embedding_model,
+            content=query
+        )
+
+        if cache is not None:
+            cache.put(embedding_model, query, embedding["embedding"])
+
+        # Return the query embedding
+        return embedding["embedding"]
+    # If an error, return None
+    except Exception as e:
+        print(f"Error generating query embedding: {e}")
+        return None
+
+def generateQueryEmbeddings(genai, embedding_model: str, queries: list, cache=None) -> list:
+    """
+    Convert several queries to embeddings with batched gemini calls (EMBED_BATCH_SIZE queries per call instead
+    of one call per query). Rate limits and outages are retried like embedTexts does
+
+    @param genai: The google gemini variable
+    @param embedding_model: As a string, what embedding model to use
+    @param queries: The query strings
+    @param cache: Optional QueryEmbeddingCache, only the queries it doesn't have are sent to gemini
+    @return: The embeddings, in the same order as queries (None for every query that failed)
+    """
+    embeddings = [cache.get(embedding_model, query) if cache is not None else None for query in queries]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if not missing:
+        return embeddings
+
+    # The same question asked twice in a batch is only embedded once
+    texts = list(dict.fromkeys(queries[i] for i in missing))
+
+    new_embeddings = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        batch = texts[start:start + EMBED_BATCH_SIZE]
+        try:
+            new_embeddings.extend(_embedBatch(genai, embedding_model, batch))
+        # The questions in a batch that failed are answered with an error, like generateQueryEmbedding does
+        except Exception as e:
+            print(f"Error generating query embeddings: {e}")
+            new_embeddings.extend([None] * len(batch))
+
+    return _fillEmbeddings(embeddings, missing, queries, dict(zip(texts, new_embeddings)), embedding_model, cache)
+
+async def generateQueryEmbeddingsAsync(genai, embedding_model: str, queries: list, cache=None) -> list:
+    """
+    Async version of generateQueryEmbeddings
+    """
+    embeddings = [cache.get(embedding_model, query) if cache is not None else None for query in queries]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if not missing:
+        return embeddings
+
+    texts = list(dict.fromkeys(queries[i] for i in missing))
+
+    # The batches are sent at the same time
+    starts = range(0, len(texts), EMBED_BATCH_SIZE)
+    batches = await asyncio.gather(*[_embedBatchAsync(genai, embedding_model, texts[start:start + EMBED_BATCH_SIZE])
+                                     for start in starts], return_exceptions=True)
+
+    new_embeddings = []
+    for start, batch in zip(starts, batches):
+        if isinstance(batch, Exception):
+            print(f"Error generating query embeddings: {batch}")
+            batch = [None] * len(texts[start:start + EMBED_BATCH_SIZE])
+        new_embeddings.extend(batch)
+
+    return _fillEmbeddings(embeddings, missing, queries, dict(zip(texts, new_embeddings)), embedding_model, cache)
+
+def _fillEmbeddings(embeddings: list, missing: list, queries: list, new_embeddings: dict, embedding_model: str, cache):
+    # Put the freshly generated embeddings in place (and in the cache, unless they failed)
+    for text, embedding in new_embeddings.items():
+        if cache is not None and embedding is not None:
+            cache.put(embedding_model, text, embedding)
+
+    for i in missing:
+        embeddings[i] = new_embeddings[queries[i]]
+
+    return embeddings
@@ -0,0 +1,421 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class HedgedGenerator:
+    """
+    Generates responses with a primary gemini model, hedged by a fallback model.
+
+    If the primary model hasn't answered by the time most of its recent requests had
+    (a configurable percentile of its latency), or if it fails, the same request is sent
+    to the fallback model and whichever answers first wins. Every request has a deadline.
+    Streamed answers (stream) race the same way to their first chunk.
+
+    With an admission controller, every model call holds a slot of its own until it finishes (even after
+    the other model won), so hedging never takes gemini over the controller's cap: a hedge is only sent
+    if a slot is free right now.
+    """
+    def __init__(self, primary_model, fallback_model, safety_settings: dict,
+                 hedge_percentile: float = 95, initial_hedge_delay: float = 5.0, min_hedge_delay: float = 1.0,
+                 deadline: float = 30.0, window: int = 200, max_workers: int = 64, admission=None):
+        """
+        @param primary_model: The GenerativeModel to try first
+        @param fallback_model: The GenerativeModel to hedge with (built once, reused for every request)
+        @param safety_settings: Safety settings passed to every generate_content call
+        @param hedge_percentile: Percentile (0-100) of recent primary latencies after which we hedge
+        @param initial_hedge_delay: Seconds to wait before hedging until we have enough latency samples
+        @param min_hedge_delay: Never hedge sooner than this many seconds
+        @param deadline: Default seconds a request may take before giving up
+        @param window: How many recent primary latencies the percentile is computed over
+        @param max_workers: Threads available for (sync) generate calls
+        @param admission: Optional AdmissionController whose slots the model calls hold
+        """
+        self._primary_model = primary_model
+        self._fallback_model = fallback_model
+        self._safety_settings = safety_settings
+        self._hedge_percentile = hedge_percentile
+        self._initial_hedge_delay = initial_hedge_delay
+        self._min_hedge_delay = min_hedge_delay
+        self._deadline = deadline
+        self._admission = admission
+
+        self._lock = threading.Lock()
+        self._primary_latencies = deque(maxlen=window)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generate")
+
+        self._requests = 0
+        self._hedges = 0
+        self._fallback_wins = 0
+
+    def hedge_delay(self) -> float:
+        """
+        @return: Seconds to wait on the primary model before also asking the fallback model
+        """
+        with self._lock:
+            latencies = sorted(self._primary_latencies)
+
+        # Not enough samples for a meaningful percentile yet
+        if len(latencies) < 20:
+            return self._initial_hedge_delay
+
+        position = min(len(latencies) - 1, int(len(latencies) * self._hedge_percentile / 100))
+        return max(self._min_hedge_delay, latencies[position])
+
+    def generate(self, instructions: str, deadline: float = None, hedge: bool = True, slot: float = None) -> dict:
+        """
+        @param instructions: The prompt
+        @param deadline: Seconds before giving up, default is the generator's deadline
+        @param hedge: False to only ask the fallback model if the primary model fails, not when it's slow
+        @param slot: What admission.acquire() returned for this request. The generator gives that slot back
+                     once the primary call is done, don't release it yourself
+        @return: A dict with the response "text", the "model" that answered and whether the request was "hedged"
+        @raise TimeoutError: If no model answered before the deadline
+        @raise OverloadedError: If the primary model failed and no slot freed up for the fallback model
+        @raise Exception: The fallback model's error if both models failed
+        """
+        t0 = time.time()
+        deadline = t0 + (deadline or self._deadline)
+
+        futures = {self._submit(self._primary_model, instructions, slot): self._primary_model}
+        hedged = False
+
+        # Give the primary model until the hedge delay before also asking the fallback model
+        done, _ = wait(futures, timeout=self._hedge_timeout(hedge, deadline))
+        primary_failed = bool(done) and next(iter(done)).exception() is not None
+        if primary_failed or (not done and time.time() < deadline):
+            fallback_slot = self._fallback_slot(slot, primary_failed)
+            if fallback_slot is not None or not self._holds_slots(slot):
+                hedged = not done
+                futures[self._submit(self._fallback_model, instructions, fallback_slot)] = self._fallback_model
+
+        error = None
+        while futures:
+            done, _ = wait(futures, timeout=max(0, deadline - time.time()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+
+            for future in done:
+                model = futures.pop(future)
+                if future.exception() is not None:
+                    print(future.exception())
+                    error = future.exception()
+                    continue
+
+                return self._result(future.result(), model, hedged)
+
+        if futures:
+            raise TimeoutError(f"No model answered within {round(time.time() - t0, 2)} seconds")
+        raise error
+
+    async def generate_async(self, instructions: str, deadline: float = None, hedge: bool = True,
+                             slot: float = None) -> dict:
+        """
+        Async version of generate (the model that loses the race is cancelled, and its slot given back
+        once the cancellation went through)
+        """
+        t0 = time.time()
+        deadline = t0 + (deadline or self._deadline)
+
+        tasks = {self._submit_async(self._primary_model, instructions, slot): self._primary_model}
+        hedged = False
+
+        try:
+            # Give the primary model until the hedge delay before also asking the fallback model
+            done, _ = await asyncio.wait(tasks, timeout=self._hedge_timeout(hedge, deadline))
+            primary_failed = bool(done) and next(iter(done)).exception() is not None
+            if primary_failed or (not done and time.time() < deadline):
+                fallback_slot = await self._fallback_slot_async(slot, primary_failed)
+                if fallback_slot is not None or not self._holds_slots(slot):
+                    hedged = not done
+                    tasks[self._submit_async(self._fallback_model, instructions, fallback_slot)] = self._fallback_model
+
+            error = None
+            while tasks:
+                done, _ = await asyncio.wait(tasks, timeout=max(0, deadline - time.time()),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+
+                for task in done:
+                    model = tasks.pop(task)
+                    if task.exception() is not None:
+                        print(task.exception())
+                        error = task.exception()
+                        continue
+
+                    return self._result(task.result(), model, hedged)
+
+            if tasks:
+                raise TimeoutError(f"No model answered within {round(time.time() - t0, 2)} seconds")
+            raise error
+        finally:
+            # Don't keep paying for the request that lost
+            for task in tasks:
+                task.cancel()
+
+    def stream(self, deadline: float = None, hedge: bool = True, slot: float = None) -> "GenerationStream":
+        """
+        Like generate, but the answer is streamed: the models race to their first chunk (hedged and falling back
+        the same way), and the rest of the answer is read from the winner. The deadline covers the whole stream
+
+        @param deadline: Seconds before giving up, default is the generator's deadline
+        @param hedge: False to only ask the fallback model if the primary model fails, not when it's slow
+        @param slot: What admission.acquire() returned for this request. The stream gives it back, close the
+                     stream even if it's never read
+        @return: A GenerationStream, read it with texts(instructions) or texts_async(instructions)
+        """
+        return GenerationStream(self, deadline or self._deadline, hedge, slot)
+
+    def _holds_slots(self, slot) -> bool:
+        # Whether this request's model calls hold admission slots
+        return self._admission is not None and slot is not None
+
+    def _fallback_slot(self, slot, primary_failed: bool):
+        # A hedge only takes a slot that is free right now (None if there isn't one, and then no hedge is sent),
+        # a retry after the primary model failed waits for one like any other request
+        if not self._holds_slots(slot):
+            return None
+        return self._admission.acquire() if primary_failed else self._admission.try_acquire()
+
+    async def _fallback_slot_async(self, slot, primary_failed: bool):
+        if not self._holds_slots(slot):
+            return None
+        return await self._admission.acquire_async() if primary_failed else self._admission.try_acquire()
+
+    def _submit(self, model, instructions: str, slot):
+        future = self._executor.submit(self._call, model, instructions)
+        if self._holds_slots(slot):
+            # Held until the call is really done, even if the other model already answered
+            future.add_done_callback(lambda _: self._admission.release(slot))
+        return future
+
+    def _submit_async(self, model, instructions: str, slot):
+        task = asyncio.create_task(self._call_async(model, instructions))
+        if self._holds_slots(slot):
+            task.add_done_callback(lambda _: self._admission.release(slot))
+        return task
+
+    def _releaser(self, slot):
+        # Gives the slot back the first time it's called, later calls do nothing
+        lock = threading.Lock()
+        held = [self._holds_slots(slot)]
+
+        def release(*_):
+            with lock:
+                if not held[0]:
+                    return
+                held[0] = False
+            self._admission.release(slot)
+
+        return release
+
+    def _hedge_timeout(self, hedge: bool, deadline: float) -> float:
+        # Without hedging, wait on the primary model for the whole deadline
+        remaining = deadline - time.time()
+        return min(self.hedge_delay(), remaining) if hedge else remaining
+
+    def stats(self) -> dict:
+        hedge_delay = self.hedge_delay()
+
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "hedges": self._hedges,
+                "fallback_wins": self._fallback_wins,
+                "hedge_delay": hedge_delay,
+            }
+
+    def _call(self, model, instructions: str):
+        t0 = time.time()
+        response = model.generate_content(instructions, safety_settings=self._safety_settings)
+        # Accessing .text raises if the response was blocked, so count that as a failure too
+        text = response.text
+        self._record_latency(model, time.time() - t0)
+        return text
+
+    async def _call_async(self, model, instructions: str):
+        t0 = time.time()
+        response = await model.generate_content_async(instructions, safety_settings=self._safety_settings)
+        text = response.text
+        self._record_latency(model, time.time() - t0)
+        return text
+
+    def _open_stream(self, model, instructions: str):
+        # Starts a streamed response and waits for its first chunk (None if the answer is empty)
+        chunks = iter(model.generate_content(instructions, safety_settings=self._safety_settings, stream=True))
+        first_chunk = next(chunks, None)
+        return chunks, None if first_chunk is None else first_chunk.text
+
+    async def _open_stream_async(self, model, instructions: str):
+        chunks = aiter(await model.generate_content_async(instructions, safety_settings=self._safety_settings,
+                                                          stream=True))
+        first_chunk = await anext(chunks, None)
+        return chunks, None if first_chunk is None else first_chunk.text
+
+    def _record_latency(self, model, latency: float):
+        # Only the primary model's latency decides when to hedge
+        if model is self._primary_model:
+            with self._lock:
+                self._primary_latencies.append(latency)
+
+    def _result(self, text: str, model, hedged: bool) -> dict:
+        self._count(model, hedged)
+        return {
+            "text": text,
+            "model": model.model_name,
+            "hedged": hedged
+        }
+
+    def _count(self, model, hedged: bool):
+        with self._lock:
+            self._requests += 1
+            if hedged:
+                self._hedges += 1
+            if model is self._fallback_model:
+                self._fallback_wins += 1
+
+class GenerationStream:
+    """
+    One streamed answer from HedgedGenerator.stream. It owns the request's admission slot from the start,
+    so the slot is given back even if the client goes away before the stream is read (call close)
+    """
+    def __init__(self, generator: HedgedGenerator, deadline: float, hedge: bool, slot: float):
+        self._generator = generator
+        self._deadline = deadline
+        self._hedge = hedge
+        self._slot = slot
+        self._release_primary = generator._releaser(slot)
+        self._started = False
+        self._error = None
+
+        # The name of the model that answered and whether the request was hedged, once the first chunk arrived
+        self.model = None
+        self.hedged = False
+
+    def close(self):
+        """
+        Gives the slot back if the stream was never read (once it's read, the model calls give it back)
+        """
+        if not self._started:
+            self._release_primary()
+
+    def texts(self, instructions: str):
+        """
+        @param instructions: The prompt
+        @return: Iterator over the pieces of the answer's text
+        @raise TimeoutError: If the answer didn't finish before the deadline
+        @raise OverloadedError: If the primary model failed and no slot freed up for the fallback model
+        @raise Exception: The fallback model's error if both models failed, or the winner's error mid-stream
+        """
+        self._started = True
+        generator = self._generator
+        t0 = time.time()
+        deadline = t0 + self._deadline
+
+        primary = generator._executor.submit(generator._open_stream, generator._primary_model, instructions)
+        attempts = {primary: (generator._primary_model, self._release_primary)}
+        # The call that's still running for each attempt (the winner's last read once it's streaming)
+        running = {primary: primary}
+        winner = None
+
+        try:
+            # Give the primary model until the hedge delay to start answering before also asking the fallback model
+            done, _ = wait(attempts, timeout=generator._hedge_timeout(self._hedge, deadline))
+            primary_failed = bool(done) and primary.exception() is not None
+            if primary_failed or (not done and time.time() < deadline):
+                fallback_slot = generator._fallback_slot(self._slot, primary_failed)
+                if fallback_slot is not None or not generator._holds_slots(self._slot):
+                    self.hedged = not done
+                    fallback = generator._executor.submit(generator._open_stream, generator._fallback_model,
+                                                          instructions)
+                    attempts[fallback] = (generator._fallback_model, generator._releaser(fallback_slot))
+                    running[fallback] = fallback
+
+            pending = dict(attempts)
+            while winner is None:
+                done, _ = wait(pending, timeout=max(0, deadline - time.time()), return_when=FIRST_COMPLETED)
+                winner = self._winner(done, pending, t0)
+            chunks, text = winner.result()
+
+            while text is not None:
+                yield text
+                running[winner] = generator._executor.submit(next, chunks, None)
+                done, _ = wait([running[winner]], timeout=max(0, deadline - time.time()))
+                if not done:
+                    raise TimeoutError(f"The answer didn't finish within {round(time.time() - t0, 2)} seconds")
+                chunk = running[winner].result()
+                text = None if chunk is None else chunk.text
+        finally:
+            # Every call keeps its slot until it's really done, even the one that lost
+            for attempt, (_, release) in attempts.items():
+                running[attempt].add_done_callback(release)
+
+    async def texts_async(self, instructions: str):
+        """
+        Async version of texts (the model that loses the race is cancelled, and its slot given back once the
+        cancellation went through)
+        """
+        self._started = True
+        generator = self._generator
+        t0 = time.time()
+        deadline = t0 + self._deadline
+
+        primary = asyncio.create_task(generator._open_stream_async(generator._primary_model, instructions))
+        attempts = {primary: (generator._primary_model, self._release_primary)}
+        winner = None
+
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=generator._hedge_timeout(self._hedge, deadline))
+            primary_failed = bool(done) and primary.exception() is not None
+            if primary_failed or (not done and time.time() < deadline):
+                fallback_slot = await generator._fallback_slot_async(self._slot, primary_failed)
+                if fallback_slot is not None or not generator._holds_slots(self._slot):
+                    self.hedged = not done
+                    fallback = asyncio.create_task(generator._open_stream_async(generator._fallback_model,
+                                                                                instructions))
+                    attempts[fallback] = (generator._fallback_model, generator._releaser(fallback_slot))
+
+            pending = dict(attempts)
+            while winner is None:
+                done, _ = await asyncio.wait(pending, timeout=max(0, deadline - time.time()),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                winner = self._winner(done, pending, t0)
+            chunks, text = winner.result()
+
+            while text is not None:
+                yield text
+                try:
+                    chunk = await asyncio.wait_for(anext(chunks, None), timeout=max(0, deadline - time.time()))
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"The answer didn't finish within {round(time.time() - t0, 2)} seconds")
+                text = None if chunk is None else chunk.text
+        finally:
+            for attempt, (_, release) in attempts.items():
+                if attempt.done():
+                    release()
+                else:
+                    # Don't keep paying for the request that lost
+                    attempt.cancel()
+                    attempt.add_done_callback(release)
+
+    def _winner(self, done, pending: dict, t0: float):
+        # The first of the finished calls that started answering, or None to keep waiting on the others
+        if not done:
+            raise TimeoutError(f"No model answered within {round(time.time() - t0, 2)} seconds")
+
+        for attempt in done:
+            model, _ = pending.pop(attempt)
+            if attempt.exception() is not None:
+                print(attempt.exception())
+                self._error = attempt.exception()
+                continue
+
+            self.model = model.model_name
+            self._generator._count(model, self.hedged)
+            return attempt
+
+        if not pending:
+            raise self._error
+        return None
@@ -0,0 +1,151 @@
+import time
+import threading
+
+from modules.singleFlight import SingleFlight
+
+class UnknownIndexError(Exception):
+    """
+    Raised when a pinecone index with the given name doesn't exist
+    """
+
+class IndexNotReadyError(Exception):
+    """
+    Raised when a pinecone index exists but isn't ready to be queried yet
+    """
+
+class IndexRegistry:
+    """
+    Process-wide registry of pinecone indexes.
+
+    Index names are listed once and only listed again (at most every names_ttl seconds)
+    when an unknown name is asked for. Each index gets one warm Index handle, and its
+    readiness is refreshed by a background thread instead of on every request.
+
+    Pinecone is never called while holding the lock (a slow listing would stall requests for every
+    index); concurrent requests that need the same call share it instead.
+    """
+    def __init__(self, pc, refresh_interval: float = 30, names_ttl: float = 300):
+        """
+        @param pc: The pinecone client
+        @param refresh_interval: Seconds between background readiness checks
+        @param names_ttl: Minimum seconds between two listings of the index names
+        """
+        self._pc = pc
+        self._refresh_interval = refresh_interval
+        self._names_ttl = names_ttl
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+
+        self._names = set()
+        self._names_listed_at = None
+        self._ready = {}
+        self._handles = {}
+        self._refresher = None
+
+    def is_known(self, name: str) -> bool:
+        """
+        @return: True if an index with this name exists
+        """
+        with self._lock:
+            if name in self._names:
+                return True
+
+            # Only go back to pinecone if the names we have are old enough
+            stale = self._names_listed_at is None or time.time() - self._names_listed_at > self._names_ttl
+
+        if stale:
+            self._flight.do("names", self._list_names)
+
+        with self._lock:
+            return name in self._names
+
+    def get_index(self, name: str):
+        """
+        Get a warm Index handle without any control-plane calls (after the first one)
+
+        @raise UnknownIndexError: If the index doesn't exist
+        @raise IndexNotReadyError: If the index isn't ready yet
+        """
+        if not self.is_known(name):
+            raise UnknownIndexError(name)
+
+        with self._lock:
+            ready = self._ready.get(name)
+
+        # First time this index is used, check readiness now and let the background thread take over
+        if ready is None:
+            ready = self._flight.do(("ready", name), self._describe_ready, name)
+            with self._lock:
+                # Unless the background thread already has a newer answer
+                ready = self._ready.setdefault(name, ready)
+                self._start_refresher()
+
+        if not ready:
+            raise IndexNotReadyError(name)
+
+        return self._handle(name)
+
+    def wait_until_ready(self, name: str, verbose: bool = True):
+        """
+        Block until the index is ready (used by the scripts)
+
+        @param verbose: Print a message every time we wait
+        @return: The Index handle
+        @raise UnknownIndexError: If the index doesn't exist
+        """
+        if not self.is_known(name):
+            raise UnknownIndexError(name)
+
+        while not self._describe_ready(name):
+            if verbose:
+                print("Waiting for index...")
+            time.sleep(1)
+
+        with self._lock:
+            self._ready[name] = True
+        return self._handle(name)
+
+    def _list_names(self):
+        names = set(self._pc.list_indexes().names())
+        with self._lock:
+            self._names = names
+            self._names_listed_at = time.time()
+
+    def _describe_ready(self, name: str) -> bool:
+        return bool(self._pc.describe_index(name).status['ready'])
+
+    def _handle(self, name: str):
+        # Reuse the same handle (and its gRPC channel) for every request
+        with self._lock:
+            handle = self._handles.get(name)
+        if handle is not None:
+            return handle
+
+        # Building one can look up the index's host, so that's done outside the lock too
+        handle = self._flight.do(("handle", name), self._pc.Index, name)
+        with self._lock:
+            return self._handles.setdefault(name, handle)
+
+    def _start_refresher(self):
+        # Called with the lock held
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="index-refresher", daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self._refresh_interval)
+
+            with self._lock:
+                names = list(self._ready)
+
+            for name in names:
+                try:
+                    ready = self._describe_ready(name)
+                except Exception as e:
+                    # Keep the last known state if pinecone can't be reached
+                    print(f"Could not refresh readiness of index {name}: {e}")
+                    continue
+
+                with self._lock:
+                    self._ready[name] = ready
@@ -0,0 +1,312 @@
+import time
+import queue
+import threading
+
+from modules.articleCleaner import clean_article
+from modules.chunker import Chunker
+from modules.embeddingFuncs import articleVector, embedTexts, EMBED_BATCH_SIZE
+
+# Threads per stage
+CLEAN_WORKERS = 2
+CHUNK_WORKERS = 1
+EMBED_WORKERS = 2
+# Articles allowed to wait between two stages (a full queue makes the stage before it wait)
+QUEUE_SIZE = 128
+# Vectors upserted (and articles written to the document store) at a time
+UPSERT_BATCH_SIZE = 100
+
+# Marks the end of a queue
+_DONE = object()
+
+class IngestPipeline:
+    """
+    Streams articles through fetch -> clean -> chunk -> embed -> store/upsert.
+
+    Every stage runs in its own threads with bounded queues in between, so pages are downloaded
+    while earlier articles are cleaned and embedded, and a slow stage holds back the ones before
+    it instead of piling articles up in memory. Whether an article is split into chunks is decided
+    from its size before anything is sent to gemini. Articles are written to the document store, the
+    keyword index and the vector index in batches as they come out of the embedder.
+    """
+    def __init__(self, genai, index, document_store, lexical_index, embedding_model: str,
+                 clean_workers: int = CLEAN_WORKERS, embed_workers: int = EMBED_WORKERS,
+                 queue_size: int = QUEUE_SIZE, upsert_batch_size: int = UPSERT_BATCH_SIZE,
+                 embed_batch_size: int = EMBED_BATCH_SIZE,
+                 chunker: Chunker = None, embedding_cache=None, verbose: bool = True,
+                 on_page=None, on_skipped=None, on_upserted=None):
+        """
+        @param genai: The google gemini variable
+        @param index: The vector index to upsert into
+        @param document_store: Where cleaned articles and their chunks are saved
+        @param lexical_index: Where the embedded passages are keyword-indexed
+        @param embedding_model: As a string, what embedding model to use
+        @param embed_batch_size: Most articles embedded together (in as few gemini calls as possible)
+        @param chunker: Splits articles too big to embed whole (a default Chunker if None)
+        @param embedding_cache: Optional ArticleEmbeddingCache, passages it has are not embedded again
+        @param verbose: Print which articles are split into chunks
+        @param on_page: Optional function(page, articles) called for every page, articles is None if it couldn't be fetched
+        @param on_skipped: Optional function(reason, article_id) called for articles that weren't embedded,
+                           reason is "missing_content", "missing_id" or "embedding_error"
+        @param on_upserted: Optional function(num_embeddings) called after every upsert
+        (callbacks are never called at the same time, so they don't need to be thread-safe)
+        """
+        self._genai = genai
+        self._index = index
+        self._document_store = document_store
+        self._lexical_index = lexical_index
+        self._embedding_model = embedding_model
+        self._clean_workers = clean_workers
+        self._embed_workers = embed_workers
+        self._queue_size = queue_size
+        self._upsert_batch_size = upsert_batch_size
+        self._embed_batch_size = embed_batch_size
+        self._verbose = verbose
+        self._on_page = on_page
+        self._on_skipped = on_skipped
+        self._on_upserted = on_upserted
+
+        self._chunker = chunker if chunker is not None else Chunker()
+        self._embedding_cache = embedding_cache
+        self._callback_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._error = None
+
+    def run(self, pages) -> dict:
+        """
+        @param pages: An iterable of (page, articles), ex: articleFetcher.iterArticlePages(...).
+                      Reading stops at the first page whose articles are None (couldn't be fetched)
+        @return: Counts of what was done, "failed_page" (None if every page was fetched),
+                 "chunking" (the chunker's statistics, see Chunker.stats), and "embedding_cache"
+                 (its hits/misses/writes, None without a cache)
+        @raise Exception: The first error that stopped the pipeline (ex: an upsert failure)
+        """
+        self._stop.clear()
+        self._error = None
+        self._stats = {"pages": 0, "articles": 0, "embedded": 0, "chunked": 0, "skipped": 0,
+                       "embeddings": 0, "failed_page": None}
+        t0 = time.time()
+
+        to_clean = queue.Queue(maxsize=self._queue_size)
+        to_chunk = queue.Queue(maxsize=self._queue_size)
+        to_embed = queue.Queue(maxsize=self._queue_size)
+        to_store = queue.Queue(maxsize=self._queue_size)
+
+        threads = [threading.Thread(target=self._read_pages, args=(pages, to_clean), name="ingest-fetch")]
+        threads += self._stage("ingest-clean", self._clean, to_clean, to_chunk, self._clean_workers)
+        threads += self._stage("ingest-chunk", self._chunk, to_chunk, to_embed, CHUNK_WORKERS)
+        threads += self._stage("ingest-embed", self._embed, to_embed, to_store, self._embed_workers,
+                               batch_size=self._embed_batch_size)
+        threads.append(threading.Thread(target=self._store, args=(to_store,), name="ingest-store"))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+        self._stats["seconds"] = round(time.time() - t0, 2)
+        self._stats["chunking"] = self._chunker.stats()
+        self._stats["embedding_cache"] = self._embedding_cache.stats() if self._embedding_cache is not None else None
+        return self._stats
+
+    def _read_pages(self, pages, outbox: queue.Queue):
+        try:
+            for page, articles in pages:
+                if self._stop.is_set():
+                    break
+
+                self._callback(self._on_page, page, articles)
+                if articles is None:
+                    self._stats["failed_page"] = page
+                    break
+
+                self._count("pages")
+                for article in articles:
+                    outbox.put(article)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            # Stop downloading pages ahead
+            if hasattr(pages, "close"):
+                pages.close()
+            outbox.put(_DONE)
+
+    def _stage(self, name: str, function, inbox: queue.Queue, outbox: queue.Queue, workers: int,
+               batch_size: int = None) -> list:
+        """
+        @param batch_size: If set, function takes a list of up to batch_size items (as many as are waiting)
+                           and returns a list of results, instead of one item and one result
+        @return: Threads that run function on every item of inbox and put what it returns in outbox
+        """
+        remaining = [workers]
+        lock = threading.Lock()
+
+        def work():
+            done = False
+            while not done:
+                item = inbox.get()
+                if item is _DONE:
+                    # Let the other workers of this stage see it too
+                    inbox.put(_DONE)
+                    break
+
+                items = [item]
+                if batch_size:
+                    # Take whatever else is already waiting, without waiting for more
+                    while len(items) < batch_size:
+                        try:
+                            item = inbox.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is _DONE:
+                            inbox.put(_DONE)
+                            done = True
+                            break
+                        items.append(item)
+
+                # After an error, keep draining so nothing upstream blocks on a full queue
+                if self._stop.is_set():
+                    continue
+                try:
+                    if batch_size:
+                        for result in function(items):
+                            outbox.put(result)
+                    else:
+                        outbox.put(function(item))
+                except Exception as e:
+                    self._fail(e)
+
+            # The last worker out tells the next stage
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                outbox.put(_DONE)
+
+        return [threading.Thread(target=work, name=f"{name}-{i}") for i in range(workers)]
+
+    def _clean(self, article: dict) -> dict:
+        self._count("articles")
+        if article['content']['rendered']:
+            article['content']['rendered'] = clean_article(article['content']['rendered'])
+        return article
+
+    def _chunk(self, article: dict) -> tuple:
+        """
+        @return: (article, passages, chunked), passages is None if the article can't be embedded
+        """
+        content = article['content']['rendered']
+        article_id = str(article['id']) if article.get('id') else None
+
+        # Only embed if there is both content to embed and an id to associate it with
+        if not article_id:
+            self._skip("missing_id", None)
+            return article, None, False
+        if not content:
+            self._skip("missing_content", article_id)
+            return article, None, False
+
+        passages, chunked = self._chunker.split(content)
+        if chunked and self._verbose:
+            print(f"\nArticle {article_id} is too big to embed whole, splitting it into {len(passages)} chunks")
+        return article, passages, chunked
+
+    def _embed(self, items: list) -> list:
+        """
+        Embed a batch of chunked articles with as few gemini calls as possible (see embedTexts),
+        passages already in the embedding cache aren't sent to gemini at all
+
+        @param items: What _chunk returned
+        @return: (article, vectors, passages, chunked) for every article, passages is None if it wasn't embedded
+        """
+        # Every passage of every article goes out together
+        to_embed = [(article, passages, chunked) for article, passages, chunked in items if passages]
+        embeddings = iter(embedTexts(self._genai, self._embedding_model,
+                                     [passage for _, passages, _ in to_embed for passage in passages],
+                                     cache=self._embedding_cache))
+
+        results = [(article, [], None, False) for article, passages, _ in items if not passages]
+        for article, passages, chunked in to_embed:
+            article_embeddings = [next(embeddings) for _ in passages]
+            if any(embedding is None for embedding in article_embeddings):
+                self._skip("embedding_error", str(article['id']))
+                results.append((article, [], None, False))
+                continue
+
+            if chunked:
+                vectors = [articleVector(article, embedding, chunk=i, chunk_total=len(passages))
+                           for i, embedding in enumerate(article_embeddings)]
+                self._count("chunked")
+            else:
+                # The whole article is one chunk
+                vectors = [articleVector(article, article_embeddings[0])]
+            results.append((article, vectors, passages, chunked))
+
+        return results
+
+    def _store(self, inbox: queue.Queue):
+        # The only thread writing to sqlite and the vector index
+        batch = []
+        vectors = []
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            if self._stop.is_set():
+                continue
+
+            batch.append(item)
+            vectors.extend(item[1])
+            if len(vectors) >= self._upsert_batch_size or len(batch) >= self._upsert_batch_size:
+                self._flush(batch, vectors)
+                batch, vectors = [], []
+
+        if batch and not self._stop.is_set():
+            self._flush(batch, vectors)
+
+    def _flush(self, batch: list, vectors: list):
+        try:
+            # Save cleaned text so queries don't have to re-download and re-clean it
+            self._document_store.put_articles([article for article, _, _, _ in batch])
+
+            for article, _, passages, chunked in batch:
+                if passages is None:
+                    continue
+                # Record where each chunk is, so queries can use only the matched chunks as context
+                article_id = str(article['id'])
+                self._document_store.put_chunks(article_id, article['content']['rendered'], passages)
+                self._lexical_index.put_passages(article_id, article['content']['rendered'], passages, chunked=chunked)
+                self._count("embedded")
+
+            if vectors:
+                self._index.upsert(vectors=vectors)
+                self._count("embeddings", len(vectors))
+                self._callback(self._on_upserted, len(vectors))
+
+            # Expire answers the backend cached before these articles were added
+            self._document_store.bump_corpus_version()
+        except Exception as e:
+            self._fail(e)
+
+    def _skip(self, reason: str, article_id):
+        self._count("skipped")
+        self._callback(self._on_skipped, reason, article_id)
+
+    def _count(self, name: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def _callback(self, callback, *args):
+        if callback is not None:
+            with self._callback_lock:
+                callback(*args)
+
+    def _fail(self, error: Exception):
+        print(f"Stopping the pipeline: {error}")
+        with self._stats_lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
@@ -0,0 +1,247 @@
+import re
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+from modules.documentStore import chunkOffsets
+from modules.lruCache import LRUCache
+
+# Words too common to help a keyword search (leaving them out also keeps lookups fast)
+STOPWORDS = frozenset("""
+a about after all also an and any are as at be been but by can could did do does for from had has have
+he her his how i if in into is it its me my no not of on or our she so than that the their them then there
+these they this to was we were what when where which who why will with would you your
+""".split())
+
+# Words found in more than this fraction of passages are left out of the search. They barely
+# change BM25 scores (ex: "ucla" is in most articles) but are by far the slowest to look up
+MAX_TERM_FREQUENCY = 0.05
+# ...unless they're in fewer passages than this (small archives are fast to search anyway)
+MIN_TERM_FREQUENCY_LIMIT = 100
+
+# How many document frequencies to remember
+TERM_FREQUENCY_CACHE_SIZE = 100000
+
+def queryTerms(query: str) -> list:
+    """
+    Split a question into the words worth searching for
+    ex: "Who wore No. 23 for UCLA?" -> ["wore", "23", "ucla"]
+    """
+    words = re.findall(r'\w+', query.lower())
+    return list(dict.fromkeys(word for word in words if word not in STOPWORDS))
+
+class LexicalIndex:
+    """
+    BM25 keyword search over the cleaned article text, using sqlite's FTS5 inverted index.
+
+    Catches what embedding similarity tends to miss (names, jersey numbers, exact wording).
+    Lives in the same sqlite file as the DocumentStore and doesn't keep a copy of the text: every passage is
+    the offsets of its text in the articles table, indexed under the same id as its vector (ex: "18352" or
+    "18352_chunk3"). Triggers keep the inverted index in step with the articles, an article's passages are
+    dropped from it (while its old text is still there to tokenize) as soon as its text changes.
+    """
+    def __init__(self, db_path: str, max_term_frequency: float = MAX_TERM_FREQUENCY):
+        """
+        @param db_path: The sqlite file of the DocumentStore (create the DocumentStore first,
+                        the passages point into its articles)
+        @param max_term_frequency: Leave out words found in more than this fraction of passages
+        """
+        self._db_path = db_path
+        self._max_term_frequency = max_term_frequency
+        self._local = threading.local()
+
+        # term -> number of passages it's in (capped), cleared whenever the number of passages changes
+        self._term_frequencies = LRUCache(max_bytes=TERM_FREQUENCY_CACHE_SIZE, sizeof=lambda count: 1)
+        self._frequencies_lock = threading.Lock()
+        self._frequencies_total = None
+
+        connection = self._connection()
+        # Indexes made before passages pointed into the articles stored their own copy of the text
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(passages)")]
+        old_passages = self._drop_text_passages(connection) if "text" in columns else {}
+
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS passages (
+                rowid INTEGER PRIMARY KEY,
+                match_id TEXT NOT NULL,
+                article_id TEXT NOT NULL,
+                start_offset INTEGER NOT NULL,
+                end_offset INTEGER NOT NULL
+            )
+        """)
+        connection.execute("CREATE INDEX IF NOT EXISTS passages_article_id ON passages (article_id)")
+        connection.execute("""
+            CREATE VIEW IF NOT EXISTS passages_text AS
+            SELECT passages.rowid AS rowid,
+                   substr(articles.content, passages.start_offset + 1, passages.end_offset - passages.start_offset) AS text
+            FROM passages JOIN articles ON articles.id = passages.article_id
+        """)
+        # Only the inverted index is stored here, the text is read from the articles
+        connection.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS passages_fts USING fts5(
+                text,
+                content='passages_text',
+                content_rowid='rowid',
+                tokenize='porter unicode61 remove_diacritics 2'
+            )
+        """)
+        # How many passages there are, so searches don't have to count them
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS passages_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                total INTEGER NOT NULL
+            )
+        """)
+        connection.execute("INSERT OR IGNORE INTO passages_stats VALUES (0, (SELECT count(*) FROM passages))")
+        connection.execute("""
+            CREATE TRIGGER IF NOT EXISTS passages_insert AFTER INSERT ON passages BEGIN
+                INSERT INTO passages_fts (rowid, text)
+                SELECT new.rowid, substr(content, new.start_offset + 1, new.end_offset - new.start_offset)
+                FROM articles WHERE id = new.article_id;
+                UPDATE passages_stats SET total = total + 1;
+            END
+        """)
+        # FTS5 needs the exact text that was indexed to take it out again
+        connection.execute("""
+            CREATE TRIGGER IF NOT EXISTS passages_delete AFTER DELETE ON passages BEGIN
+                INSERT INTO passages_fts (passages_fts, rowid, text)
+                SELECT 'delete', old.rowid, substr(content, old.start_offset + 1, old.end_offset - old.start_offset)
+                FROM articles WHERE id = old.article_id;
+                UPDATE passages_stats SET total = total - 1;
+            END
+        """)
+        connection.execute("""
+            CREATE TRIGGER IF NOT EXISTS passages_article_update BEFORE UPDATE OF content ON articles
+            WHEN old.content IS NOT new.content BEGIN
+                DELETE FROM passages WHERE article_id = old.id;
+            END
+        """)
+        connection.execute("""
+            CREATE TRIGGER IF NOT EXISTS passages_article_delete BEFORE DELETE ON articles BEGIN
+                DELETE FROM passages WHERE article_id = old.id;
+            END
+        """)
+
+        # Point the old passages into their article instead
+        for article_id, passages in old_passages.items():
+            content = connection.execute("SELECT content FROM articles WHERE id = ?", (article_id,)).fetchone()
+            if content is not None:
+                self._insert_passages(connection, article_id, content[0], passages)
+        connection.commit()
+
+    def put_passages(self, article_id: str, content: str, passages: list, chunked: bool):
+        """
+        Index (or re-index) the text of an article. The article must already be in the DocumentStore
+
+        @param article_id: The id of the article
+        @param content: The cleaned article text, as stored in the DocumentStore
+        @param passages: The texts that were embedded, in order (ex: [content] if it wasn't split)
+        @param chunked: True if the passages were embedded as chunks ("<id>_chunk<i>"), False if as the whole article ("<id>")
+        """
+        article_id = str(article_id)
+        passages = [(f"{article_id}_chunk{i}" if chunked else article_id, passage) for i, passage in enumerate(passages)]
+
+        connection = self._connection()
+        connection.execute("DELETE FROM passages WHERE article_id = ?", (article_id,))
+        self._insert_passages(connection, article_id, content, passages)
+        connection.commit()
+
+    def _insert_passages(self, connection, article_id: str, content: str, passages: list):
+        # passages: (match id, text) pairs, in order
+        offsets = chunkOffsets(content, [text for _, text in passages])
+        rows = [(match_id, article_id, start, end) for (match_id, _), (start, end) in zip(passages, offsets)]
+        connection.executemany("INSERT INTO passages (match_id, article_id, start_offset, end_offset) VALUES (?, ?, ?, ?)",
+                               rows)
+
+    def _drop_text_passages(self, connection) -> dict:
+        """
+        @return: article id -> [(match id, text), ...] of the passages that were dropped
+        """
+        passages = {}
+        rows = connection.execute("SELECT match_id, article_id, text FROM passages ORDER BY rowid").fetchall()
+        for match_id, article_id, text in rows:
+            passages.setdefault(article_id, []).append((match_id, text))
+
+        for trigger in ("passages_insert", "passages_delete"):
+            connection.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        connection.execute("DROP TABLE IF EXISTS passages_fts")
+        connection.execute("DROP TABLE passages")
+        return passages
+
+    def search(self, query: str, top_k: int = 10, date_range: tuple = None) -> list:
+        """
+        @param query: The user's question
+        @param top_k: Max number of passages to return
+        @param date_range: Optional (start, end) unix timestamps, only articles published in between are returned
+        @return: Matches shaped like pinecone's ({"id", "score", "metadata"}), best first.
+                 The score is the BM25 relevance (higher is better)
+        """
+        terms = self._selective_terms(queryTerms(query))
+        if not terms:
+            return []
+
+        # Quote every term so punctuation in the question can't be read as FTS5 syntax
+        fts_query = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+        date_condition = ""
+        parameters = [fts_query]
+        if date_range is not None:
+            # date_gmt is ISO 8601, so comparing strings compares dates
+            date_condition = "AND articles.date_gmt >= ? AND articles.date_gmt < ?"
+            parameters += [datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+                           for timestamp in date_range]
+
+        rows = self._connection().execute(f"""
+            SELECT passages.match_id, articles.link, articles.date_gmt, bm25(passages_fts) AS rank
+            FROM passages_fts
+            JOIN passages ON passages.rowid = passages_fts.rowid
+            LEFT JOIN articles ON articles.id = passages.article_id
+            WHERE passages_fts MATCH ? {date_condition}
+            ORDER BY rank
+            LIMIT ?
+        """, (*parameters, top_k)).fetchall()
+
+        # sqlite's bm25() is negative (lower is better), flip it so it reads like a similarity
+        return [{"id": match_id, "score": -rank, "metadata": {"link": link, "date_gmt": date_gmt}}
+                for match_id, link, date_gmt, rank in rows]
+
+    def _selective_terms(self, terms: list) -> list:
+        """
+        @return: The terms that are in at most max_term_frequency of the passages
+        """
+        if not terms:
+            return []
+
+        connection = self._connection()
+        total = connection.execute("SELECT total FROM passages_stats").fetchone()[0]
+        # Anything above the limit is dropped, so there's no need to count past it
+        limit = max(MIN_TERM_FREQUENCY_LIMIT, int(total * self._max_term_frequency))
+
+        with self._frequencies_lock:
+            # New passages were indexed, the counts we remember are off
+            if total != self._frequencies_total:
+                self._term_frequencies.clear()
+                self._frequencies_total = total
+
+        selective = []
+        for term in terms:
+            count = self._term_frequencies.get(term)
+            if count is None:
+                count = connection.execute("""
+                    SELECT count(*) FROM (SELECT 1 FROM passages_fts WHERE passages_fts MATCH ? LIMIT ?)
+                """, ('"' + term.replace('"', '""') + '"', limit + 1)).fetchone()[0]
+                self._term_frequencies.put(term, count)
+
+            if 0 < count <= limit:
+                selective.append(term)
+
+        return selective
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads, so keep one per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._db_path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
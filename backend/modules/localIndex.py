@@ -0,0 +1,369 @@
+import os
+import json
+import threading
+
+import numpy as np
+
+from modules.indexRegistry import UnknownIndexError
+
+# Metadata filter operators (same names as pinecone's)
+FILTER_OPERATORS = {
+    "$eq": np.equal,
+    "$gt": np.greater,
+    "$gte": np.greater_equal,
+    "$lt": np.less,
+    "$lte": np.less_equal,
+}
+
+# Rows scored (or copied) at a time when the vectors are stored as float16 (converted to float32 block by block)
+SCORE_BLOCK_ROWS = 8192
+# Rows preallocated for a new index, every new generation has twice the room its live rows need
+MIN_CAPACITY = 1024
+
+class LocalIndex:
+    """
+    Exact vector search over a memory-mapped matrix, with the same query/upsert interface as a pinecone Index.
+
+    Each index is a directory holding:
+        manifest.json         - the current generation, and how many of its rows (and metadata bytes) are committed
+        vectors-<n>.npy       - one normalized row per vector (float32 or float16), preallocated with spare rows
+        metadata-<n>.jsonl    - the id and metadata of each row, one line per row in row order
+    An upsert writes its rows after the committed ones and then swaps the manifest, so readers (even in
+    other processes) never see a half-written index, and only read what was added since their last query.
+    A replaced id gets a new row and its old row is skipped. Once a generation is full, its live rows are
+    copied to a new generation with twice the room, so an ingest writes each row a few times at most
+    instead of rewriting the whole index on every upsert.
+    """
+    def __init__(self, path: str, dtype: str = "float32"):
+        """
+        @param path: The directory of this index
+        @param dtype: How vectors are stored, "float32" or "float16" (half the memory and disk, but slower to score)
+        """
+        self._path = path
+        self._dtype = np.dtype(dtype)
+        self._lock = threading.Lock()
+
+        self._manifest_mtime = None
+        self._reset(None, None)
+
+    def query(self, vector: list, top_k: int = 10, include_values: bool = False, include_metadata: bool = True,
+              filter: dict = None, **kwargs) -> dict:
+        """
+        Cosine similarity search
+
+        @param filter: Optional pinecone-style filter on numeric metadata, ex: {"timestamp": {"$gte": 0, "$lt": 10}}
+                       (supports $eq, $gt, $gte, $lt and $lte, rows missing the field never match)
+        @return: {"matches": [{"id", "score", "metadata", "values"}, ...]} sorted by score, like pinecone
+        """
+        # Everything below reads this one snapshot, even if an upsert starts a new generation meanwhile
+        vectors, ids, metadata, alive, columns = self._load()
+        if vectors is None or len(vectors) == 0:
+            return {"matches": []}
+
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        scores = self._scores(vectors, query)
+
+        # Rows of replaced ids, and rows the filter leaves out, can't be picked
+        mask = alive
+        if filter:
+            filter_mask = self._filter_mask(filter, metadata, columns, len(vectors))
+            mask = filter_mask if mask is None else mask & filter_mask
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+            top_k = min(top_k, int(mask.sum()))
+            if top_k == 0:
+                return {"matches": []}
+
+        # Only sort the top k rows, not the whole archive
+        top_k = min(top_k, len(scores))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+
+        matches = []
+        for row in top:
+            match = {"id": ids[row], "score": float(scores[row])}
+            if include_metadata:
+                match["metadata"] = metadata[row]
+            if include_values:
+                match["values"] = vectors[row].astype(np.float32).tolist()
+            matches.append(match)
+
+        return {"matches": matches}
+
+    def upsert(self, vectors: list, **kwargs):
+        """
+        @param vectors: A list of {"id": ..., "values": [...], "metadata": {...}}, ids already in the index are replaced
+        """
+        if not vectors:
+            return
+
+        # The last one wins if an id is in the batch twice
+        batch = {vector["id"]: vector for vector in vectors}
+        values = np.stack([np.asarray(vector["values"], dtype=np.float32) for vector in batch.values()])
+        values /= np.maximum(np.linalg.norm(values, axis=1, keepdims=True), np.finfo(np.float32).tiny)
+        records = [{"id": id, "metadata": vector.get("metadata", {})} for id, vector in batch.items()]
+        lines = [json.dumps(record) + "\n" for record in records]
+
+        with self._lock:
+            self._sync()
+            os.makedirs(self._path, exist_ok=True)
+
+            if self._legacy or self._vectors is None or self._count + len(values) > len(self._vectors):
+                self._compact(values, lines)
+                return
+
+            # Write after the committed rows (readers ignore anything past the manifest's count)
+            matrix = np.load(self._file("vectors", self._generation, "npy"), mmap_mode="r+")
+            matrix[self._count:self._count + len(values)] = values
+            matrix.flush()
+            del matrix
+
+            data = "".join(lines).encode("utf-8")
+            with open(self._file("metadata", self._generation, "jsonl"), "r+b") as file:
+                # Overwrite whatever a crashed upsert may have left after the committed metadata
+                file.seek(self._metadata_bytes)
+                file.write(data)
+                file.truncate()
+
+            for record in records:
+                self._add_row(record)
+            self._count += len(values)
+            self._metadata_bytes += len(data)
+            self._write_manifest()
+
+    def describe_index_stats(self) -> dict:
+        vectors, ids, _, alive, _ = self._load()
+        if vectors is None:
+            return {"dimension": None, "total_vector_count": 0}
+        return {"dimension": vectors.shape[1], "total_vector_count": len(vectors) if alive is None else int(alive.sum())}
+
+    def _filter_mask(self, filter: dict, metadata: list, columns: dict, count: int):
+        mask = np.ones(count, dtype=bool)
+        for field, conditions in filter.items():
+            column = self._column(field, metadata, columns, count)
+            if not isinstance(conditions, dict):
+                conditions = {"$eq": conditions}
+
+            for operator, value in conditions.items():
+                if operator not in FILTER_OPERATORS:
+                    raise ValueError(f"Unsupported filter operator {operator}")
+                # Comparisons with NaN (missing field) are always False
+                with np.errstate(invalid="ignore"):
+                    mask &= FILTER_OPERATORS[operator](column, value)
+        return mask
+
+    def _column(self, field: str, metadata: list, columns: dict, count: int):
+        # Rows never change once written, so a column only needs the values of rows added since it was built.
+        # metadata and columns belong to the same generation (a new generation gets new ones, see _reset)
+        with self._lock:
+            column = columns.get(field, np.empty(0, dtype=np.float64))
+            if len(column) < count:
+                values = [row.get(field) for row in metadata[len(column):count]]
+                column = np.concatenate([column, np.array([value if isinstance(value, (int, float)) else np.nan
+                                                           for value in values], dtype=np.float64)])
+                columns[field] = column
+            return column[:count]
+
+    def _scores(self, vectors, query):
+        if vectors.dtype == np.float32:
+            return vectors @ query
+
+        # numpy has no fast float16 matmul, so convert a block at a time
+        scores = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), SCORE_BLOCK_ROWS):
+            block = vectors[start:start + SCORE_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query
+        return scores
+
+    def _load(self):
+        """
+        @return: (vectors, ids, metadata, alive, columns) of the committed rows, all from the same generation.
+                 alive is None if no row was replaced, ids and metadata may hold more rows than vectors
+                 (only the first len(vectors) are committed), columns is that generation's column cache
+        """
+        with self._lock:
+            self._sync()
+            if self._vectors is None:
+                return None, [], [], None, {}
+
+            count = self._count
+            alive = self._alive[:count].copy() if self._dead else None
+            return self._vectors[:count], self._ids, self._metadata, alive, self._columns
+
+    def _sync(self):
+        # Catch up with the manifest if it changed (a stat per query, and only the new rows are read)
+        try:
+            mtime = os.stat(os.path.join(self._path, "manifest.json")).st_mtime_ns
+        except FileNotFoundError:
+            self._reset(None, None)
+            self._manifest_mtime = None
+            return
+        if mtime == self._manifest_mtime:
+            return
+
+        # An upsert in another process can start a new generation between reading the manifest and its files
+        for attempt in range(3):
+            manifest = self._read_manifest()
+            try:
+                self._read_manifest_rows(manifest)
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+        self._manifest_mtime = mtime
+
+    def _read_manifest_rows(self, manifest):
+        if manifest is None:
+            self._reset(None, None)
+            return
+
+        if "generation" not in manifest:
+            # Written before indexes were append-only: one file holding every row and its metadata
+            vectors = np.load(self._file("vectors", manifest["version"], "npy"), mmap_mode="r")
+            with open(self._file("metadata", manifest["version"], "json")) as file:
+                side = json.load(file)
+            self._reset(manifest["version"], vectors, legacy=True)
+            for id, metadata in zip(side["ids"], side["metadata"]):
+                self._add_row({"id": id, "metadata": metadata})
+            self._count = len(vectors)
+            return
+
+        if manifest["generation"] != self._generation or self._legacy or manifest["count"] < self._count:
+            vectors = np.load(self._file("vectors", manifest["generation"], "npy"), mmap_mode="r")
+            self._reset(manifest["generation"], vectors)
+
+        # Only parse the metadata committed since we last looked
+        if manifest["metadata_bytes"] > self._metadata_bytes:
+            with open(self._file("metadata", self._generation, "jsonl"), "rb") as file:
+                file.seek(self._metadata_bytes)
+                data = file.read(manifest["metadata_bytes"] - self._metadata_bytes)
+            for line in data.decode("utf-8").splitlines():
+                self._add_row(json.loads(line))
+            self._metadata_bytes = manifest["metadata_bytes"]
+        self._count = manifest["count"]
+
+    def _compact(self, values, lines: list):
+        """
+        Start a new generation holding the live rows and the new ones, with twice the room they need
+        """
+        live_rows = np.flatnonzero(self._alive[:self._count]) if self._vectors is not None else np.empty(0, dtype=int)
+        count = len(live_rows) + len(values)
+        dimension = values.shape[1] if self._vectors is None else self._vectors.shape[1]
+        old_generation, legacy = self._generation, self._legacy
+        generation = (old_generation or 0) + 1
+
+        matrix = np.lib.format.open_memmap(self._file("vectors", generation, "npy"), mode="w+",
+                                           dtype=self._dtype, shape=(max(MIN_CAPACITY, 2 * count), dimension))
+        for start in range(0, len(live_rows), SCORE_BLOCK_ROWS):
+            rows = live_rows[start:start + SCORE_BLOCK_ROWS]
+            matrix[start:start + len(rows)] = self._vectors[rows]
+        matrix[len(live_rows):count] = values
+        matrix.flush()
+        del matrix
+
+        with open(self._file("metadata", generation, "jsonl"), "wb") as file:
+            for row in live_rows:
+                file.write((json.dumps({"id": self._ids[row], "metadata": self._metadata[row]}) + "\n").encode("utf-8"))
+            file.write("".join(lines).encode("utf-8"))
+            metadata_bytes = file.tell()
+
+        self._reset(generation, np.load(self._file("vectors", generation, "npy"), mmap_mode="r"))
+        self._read_manifest_rows({"generation": generation, "count": count, "metadata_bytes": metadata_bytes})
+        self._write_manifest()
+
+        # Readers still using the old generation keep their open memmap
+        if old_generation is not None:
+            old_metadata = ("metadata", old_generation, "json" if legacy else "jsonl")
+            for name, version, extension in (("vectors", old_generation, "npy"), old_metadata):
+                try:
+                    os.remove(self._file(name, version, extension))
+                except OSError:
+                    pass
+
+    def _write_manifest(self):
+        # Swapping the manifest is what makes the new rows visible
+        manifest_tmp = os.path.join(self._path, "manifest.json.tmp")
+        with open(manifest_tmp, "w") as file:
+            json.dump({"generation": self._generation, "dimension": self._vectors.shape[1],
+                       "capacity": len(self._vectors), "count": self._count,
+                       "metadata_bytes": self._metadata_bytes}, file)
+        manifest = os.path.join(self._path, "manifest.json")
+        os.replace(manifest_tmp, manifest)
+        # We're already up to date with what we just wrote
+        self._manifest_mtime = os.stat(manifest).st_mtime_ns
+
+    def _reset(self, generation, vectors, legacy: bool = False):
+        # Forget every row, ex: before reading a new generation
+        self._generation = generation
+        self._legacy = legacy
+        self._vectors = vectors
+        self._count = 0
+        self._metadata_bytes = 0
+        self._ids = []
+        self._metadata = []
+        # id -> its current row, and which rows are current (a replaced id leaves a dead row behind)
+        self._rows = {}
+        self._alive = np.zeros(len(vectors) if vectors is not None else 0, dtype=bool)
+        self._dead = 0
+        # metadata field -> numpy array of its value in every row (built the first time a filter uses it).
+        # Always a new dict, queries still reading the old generation keep filling the old one
+        self._columns = {}
+
+    def _add_row(self, record: dict):
+        row = len(self._ids)
+        if record["id"] in self._rows:
+            self._alive[self._rows[record["id"]]] = False
+            self._dead += 1
+        self._rows[record["id"]] = row
+        self._alive[row] = True
+        self._ids.append(record["id"])
+        self._metadata.append(record["metadata"])
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self._path, "manifest.json")) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _file(self, name: str, version: int, extension: str) -> str:
+        return os.path.join(self._path, f"{name}-{version}.{extension}")
+
+class LocalIndexRegistry:
+    """
+    Same interface as IndexRegistry, for indexes stored on disk by LocalIndex (one directory per index)
+    """
+    def __init__(self, path: str, dtype: str = "float32", create_missing: bool = False):
+        """
+        @param path: The directory holding every local index
+        @param dtype: How vectors are stored, "float32" or "float16"
+        @param create_missing: Treat any index name as known, so the ingest scripts can fill a new index
+        """
+        self._path = path
+        self._dtype = dtype
+        self._create_missing = create_missing
+        self._lock = threading.Lock()
+        self._handles = {}
+
+    def is_known(self, name: str) -> bool:
+        if not name or os.sep in name or name.startswith("."):
+            return False
+        return self._create_missing or os.path.isfile(os.path.join(self._path, name, "manifest.json"))
+
+    def get_index(self, name: str) -> LocalIndex:
+        """
+        @raise UnknownIndexError: If the index doesn't exist
+        """
+        if not self.is_known(name):
+            raise UnknownIndexError(name)
+
+        with self._lock:
+            if name not in self._handles:
+                self._handles[name] = LocalIndex(os.path.join(self._path, name), dtype=self._dtype)
+            return self._handles[name]
+
+    def wait_until_ready(self, name: str, verbose: bool = True) -> LocalIndex:
+        # Local indexes are always ready
+        return self.get_index(name)
@@ -0,0 +1,117 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Thread-safe in-memory LRU cache with a size cap in bytes and an optional TTL.
+
+    Entries past their TTL are not dropped on lookup; they are handed back as
+    expired so the caller can revalidate them cheaply and call touch().
+    """
+    def __init__(self, max_bytes: int, ttl: float = None, sizeof=None):
+        """
+        @param max_bytes: Total size of all values before least recently used entries are evicted
+        @param ttl: Seconds an entry stays fresh, default is None (never expires)
+        @param sizeof: Function returning the size of a value in bytes, default is sys.getsizeof
+        """
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._sizeof = sizeof or sys.getsizeof
+        self._lock = threading.Lock()
+
+        # key -> (value, size, time stored)
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._evictions = 0
+        self._revalidations = 0
+
+    def lookup(self, key):
+        """
+        @return: A tuple (value, fresh). value is None if the key isn't cached,
+                 fresh is False if the entry is past its TTL
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None, False
+
+            self._entries.move_to_end(key)
+            value, _, stored_at = entry
+            if self._ttl is not None and time.time() - stored_at > self._ttl:
+                self._expired += 1
+                return value, False
+
+            self._hits += 1
+            return value, True
+
+    def get(self, key):
+        """
+        @return: The cached value, or None if the key isn't cached or has expired
+        """
+        value, fresh = self.lookup(key)
+        return value if fresh else None
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+
+        with self._lock:
+            # Values bigger than the whole cache are never stored
+            if size > self._max_bytes:
+                return
+
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._bytes -= old_entry[1]
+
+            self._entries[key] = (value, size, time.time())
+            self._bytes += size
+
+            # Evict least recently used entries until we're back under the cap
+            while self._bytes > self._max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._evictions += 1
+
+    def touch(self, key):
+        """
+        Mark an expired entry as fresh again after it was revalidated
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], entry[1], time.time())
+                self._revalidations += 1
+
+    def remove(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """
+        @return: Counters for tuning the cache size and TTL
+        """
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "expired": self._expired,
+                "evictions": self._evictions,
+                "revalidations": self._revalidations,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+            }
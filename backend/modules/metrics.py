@@ -0,0 +1,215 @@
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _formatLabels(labels: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{label}="{value}"' for label, value in zip(labels, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}"
+
+class Histogram:
+    """
+    Thread-safe Prometheus-style histogram, one series per combination of label values
+    """
+    def __init__(self, name: str, help: str, labels: tuple, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self._labels = labels
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        # label values -> [count per bucket..., sum, count]
+        self._series = {}
+
+    def observe(self, label_values: tuple, value: float):
+        with self._lock:
+            series = self._series.setdefault(label_values, [0] * len(self._buckets) + [0.0, 0])
+
+            # Values above the last bucket only show up in +Inf (the total count)
+            position = bisect.bisect_left(self._buckets, value)
+            if position < len(self._buckets):
+                series[position] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                # Prometheus buckets are cumulative
+                cumulative = 0
+                for upper_bound, count in zip(self._buckets, series):
+                    cumulative += count
+                    labels = _formatLabels(self._labels, label_values, f'le="{upper_bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+                labels = _formatLabels(self._labels, label_values, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+                lines.append(f"{self.name}_sum{_formatLabels(self._labels, label_values)} {series[-2]}")
+                lines.append(f"{self.name}_count{_formatLabels(self._labels, label_values)} {series[-1]}")
+        return lines
+
+class Counter:
+    """
+    Thread-safe Prometheus-style counter, one series per combination of label values
+    """
+    def __init__(self, name: str, help: str, labels: tuple):
+        self.name = name
+        self.help = help
+        self._labels = labels
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def inc(self, label_values: tuple, amount: float = 1):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._series.items()):
+                lines.append(f"{self.name}{_formatLabels(self._labels, label_values)} {value}")
+        return lines
+
+class RequestTimer:
+    """
+    Time spent in each stage of one request (stages recorded more than once are added up)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+        self._stages = {}
+        # (route, status code) once the request is left to be finished later (see deferRequest), False once it was
+        self.deferred = None
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self._stages[stage] = self._stages.get(stage, 0) + seconds
+
+    def elapsed(self) -> float:
+        return time.time() - self._started_at
+
+    def timings(self) -> dict:
+        with self._lock:
+            return {stage: round(seconds, 4) for stage, seconds in self._stages.items()}
+
+    def adopt(self, other: "RequestTimer"):
+        """
+        Copy the stages of another request that this one didn't time itself
+        (ex: the request whose answer this one shared, see SingleFlight)
+        """
+        if other is None or other is self:
+            return
+        with other._lock:
+            stages = dict(other._stages)
+        with self._lock:
+            for stage, seconds in stages.items():
+                self._stages.setdefault(stage, seconds)
+
+stage_seconds = Histogram("dbllm_stage_seconds", "Time spent in each stage of a query", ("stage",))
+request_seconds = Histogram("dbllm_request_seconds", "Total time to answer a request", ("route",))
+requests_total = Counter("dbllm_requests_total", "Requests answered", ("route", "status"))
+
+# Functions returning {metric name: value}, rendered as gauges (ex: cache counters)
+_collectors = []
+
+# The timer of the request being handled (follows the request into asyncio tasks and copied contexts)
+_current_timer = contextvars.ContextVar("request_timer", default=None)
+
+def startRequest() -> RequestTimer:
+    """
+    Start timing a new request in the current context
+    """
+    timer = RequestTimer()
+    _current_timer.set(timer)
+    return timer
+
+def currentRequest():
+    """
+    @return: The RequestTimer of the request being handled, or None outside of a request
+    """
+    return _current_timer.get()
+
+def finishRequest(route: str, status_code: int):
+    """
+    Record the total time and status of the request being handled (unless it was deferred)
+    """
+    timer = _current_timer.get()
+    if timer is not None:
+        if timer.deferred is not None:
+            return
+        request_seconds.observe((route,), timer.elapsed())
+    requests_total.inc((route, str(status_code)))
+
+def deferRequest(route: str, status_code: int) -> RequestTimer:
+    """
+    Record the request being handled when finishDeferredRequest is called instead of when its handler returns
+    (ex: a streamed response, which keeps running after that)
+
+    @return: Its RequestTimer, to pass to finishDeferredRequest
+    """
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.deferred = (route, status_code)
+    return timer
+
+def finishDeferredRequest(timer: RequestTimer):
+    """
+    Record the total time and status of a deferred request (ex: once its stream is closed)
+    """
+    if timer is None or not timer.deferred:
+        return
+    route, status_code = timer.deferred
+    # Only once (False still keeps finishRequest from recording it)
+    timer.deferred = False
+    request_seconds.observe((route,), timer.elapsed())
+    requests_total.inc((route, str(status_code)))
+
+@contextmanager
+def span(stage: str):
+    """
+    Time a stage, both for the current request's breakdown and the /metrics histograms
+    ex: with span("generation"): ...
+    """
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - t0
+        stage_seconds.observe((stage,), seconds)
+
+        timer = _current_timer.get()
+        if timer is not None:
+            timer.record(stage, seconds)
+
+def registerCollector(collector):
+    """
+    @param collector: A function returning a dict of metric name -> number, called on every scrape
+    """
+    _collectors.append(collector)
+
+def renderMetrics() -> str:
+    """
+    @return: Every metric in the Prometheus text exposition format
+    """
+    lines = stage_seconds.render() + request_seconds.render() + requests_total.render()
+
+    for collector in _collectors:
+        try:
+            values = collector()
+        except Exception as e:
+            print(f"Error collecting metrics: {e}")
+            continue
+
+        for name, value in values.items():
+            if value is None:
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,182 @@
+"""
+Picks where vectors are stored and searched, and which of the matches are used as context.
+
+Every backend is an index registry with the same interface:
+    is_known(name), get_index(name), wait_until_ready(name)
+and every index it returns has pinecone's query(vector, top_k, include_values, include_metadata) and upsert(vectors)
+"""
+
+import numpy as np
+
+from modules.contextBuilder import getArticleId
+from modules.indexRegistry import IndexRegistry
+from modules.localIndex import LocalIndexRegistry
+
+RETRIEVAL_BACKENDS = ("pinecone", "local")
+
+# Vector matches less similar (cosine) than this aren't worth putting in the prompt
+MIN_MATCH_SCORE = 0.3
+# How much the final picks trade relevance for variety (0 = pure score order)
+MMR_DIVERSITY = 0.3
+
+def createIndexRegistry(backend: str, pinecone_api_key: str = None, local_index_path: str = "./local_index",
+                        local_index_dtype: str = "float32", create_missing: bool = False):
+    """
+    @param backend: "pinecone" or "local" (an exact, in-process index stored under local_index_path)
+    @param pinecone_api_key: Only needed for the pinecone backend
+    @param local_index_path: Directory of the local indexes
+    @param local_index_dtype: "float32" or "float16", how the local index stores vectors
+    @param create_missing: Local backend only, let the ingest scripts fill an index that doesn't exist yet
+    @raise ValueError: If the backend is unknown
+    """
+    if backend == "local":
+        return LocalIndexRegistry(local_index_path, dtype=local_index_dtype, create_missing=create_missing)
+
+    if backend == "pinecone":
+        # Only import the pinecone client when it's used
+        from pinecone.grpc import PineconeGRPC as Pinecone
+        return IndexRegistry(Pinecone(api_key=pinecone_api_key))
+
+    raise ValueError(f"Unknown retrieval backend {backend}, expected one of {RETRIEVAL_BACKENDS}")
+
+def _matchValues(match):
+    # Pinecone matches only have values when queried with include_values=True, keyword matches never do
+    try:
+        values = match['values']
+    except (KeyError, AttributeError):
+        return None
+    return values if values is not None and len(values) else None
+
+def reciprocalRankFusion(result_lists: list, top_k: int = None, k: int = 60) -> list:
+    """
+    Merge ranked match lists (ex: vector and keyword results) with reciprocal rank fusion:
+    every match scores sum(1 / (k + rank)) over the lists it appears in, so only ranks matter
+    and scores from different kinds of search never have to be compared
+
+    @param result_lists: Lists of pinecone-shaped matches ({"id", "score", "metadata"}, queried with metadata), each best first
+    @param top_k: Max number of matches to return, None for all of them
+    @param k: Dampens the weight of the top ranks (60 is the usual choice)
+    @return: The fused matches, best first, with "score" replaced by the fused score
+    """
+    scores = {}
+    matches = {}
+    for results in result_lists:
+        for rank, match in enumerate(results):
+            scores[match['id']] = scores.get(match['id'], 0) + 1 / (k + rank + 1)
+            # Keep the first version we saw (the vector match has the most metadata)
+            matches.setdefault(match['id'], match)
+
+    fused = sorted(scores, key=lambda match_id: scores[match_id], reverse=True)[:top_k]
+    return [{"id": match_id,
+             "score": scores[match_id],
+             "metadata": matches[match_id]['metadata'],
+             "values": _matchValues(matches[match_id])}
+            for match_id in fused]
+
+def collapseByArticle(matches: list) -> list:
+    """
+    Keep only the best match of each article (long articles are stored as several "<id>_chunk<i>" vectors).
+    A kept match without values (ex: a keyword-only chunk) takes the values of the article's best chunk that has them
+
+    @param matches: Matches, best first
+    """
+    collapsed = {}
+    for match in matches:
+        article_id = getArticleId(match['id'])
+        if article_id not in collapsed:
+            collapsed[article_id] = match
+        elif _matchValues(collapsed[article_id]) is None and _matchValues(match) is not None:
+            collapsed[article_id] = dict(collapsed[article_id], values=_matchValues(match))
+    return list(collapsed.values())
+
+def maximalMarginalRelevance(matches: list, top_k: int, diversity: float = MMR_DIVERSITY) -> list:
+    """
+    Pick top_k matches that are relevant but not too similar to each other: each pick maximizes
+        (1 - diversity) * relevance - diversity * (highest similarity to an already picked match)
+    Relevance is the match score scaled to 0-1, similarity is the cosine of the match vectors.
+    A match without values (a keyword-only article) is assumed to be as similar to the others as the
+    matches with values are to each other on average, rather than unlike everything
+
+    @param matches: Matches, best first
+    @param diversity: 0 keeps the score order, higher values trade relevance for variety
+    """
+    if len(matches) <= top_k or diversity <= 0:
+        return matches[:top_k]
+
+    scores = np.array([match['score'] for match in matches], dtype=np.float32)
+    spread = scores.max() - scores.min()
+    relevance = (scores - scores.min()) / spread if spread > 0 else np.ones(len(matches), dtype=np.float32)
+
+    # Cosine similarity between every pair of matches that have vectors
+    dimension = next((len(_matchValues(match)) for match in matches if _matchValues(match) is not None), 0)
+    vectors = np.zeros((len(matches), dimension), dtype=np.float32)
+    for row, match in enumerate(matches):
+        values = _matchValues(match)
+        if values is not None:
+            vectors[row] = values
+            vectors[row] /= np.linalg.norm(vectors[row]) or 1.0
+    similarity = vectors @ vectors.T
+
+    has_values = np.array([_matchValues(match) is not None for match in matches])
+    if not has_values.all():
+        known = similarity[np.ix_(has_values, has_values)]
+        pairs = len(known) * (len(known) - 1)
+        typical = (known.sum() - np.trace(known)) / pairs if pairs else 0.0
+        similarity[~has_values, :] = typical
+        similarity[:, ~has_values] = typical
+
+    picked = [0]
+    redundancy = similarity[0].copy()
+    while len(picked) < top_k:
+        mmr = (1 - diversity) * relevance - diversity * redundancy
+        mmr[picked] = -np.inf
+        best = int(np.argmax(mmr))
+        picked.append(best)
+        redundancy = np.maximum(redundancy, similarity[best])
+
+    return [matches[row] for row in picked]
+
+def selectMatches(vector_matches: list, keyword_matches: list = None, top_k: int = 5,
+                  min_score: float = MIN_MATCH_SCORE, diversity: float = MMR_DIVERSITY) -> list:
+    """
+    Turn over-fetched search results into top_k distinct articles to use as context:
+    weak vector matches are dropped, keyword matches are fused in, chunks are collapsed
+    to one match per article and the final picks are diversified
+
+    @param vector_matches: Vector query matches, best first (queried with metadata, and values for diversification)
+    @param keyword_matches: Optional keyword (BM25) matches, best first
+    @param top_k: Number of distinct articles to return
+    @param min_score: Vector matches less similar than this are dropped
+    @param diversity: See maximalMarginalRelevance
+    """
+    vector_matches = [match for match in vector_matches if match['score'] >= min_score]
+    matches = reciprocalRankFusion([vector_matches, keyword_matches or []])
+    return maximalMarginalRelevance(collapseByArticle(matches), top_k, diversity)
+
+def _appendNew(matches: list, more: list) -> list:
+    # matches followed by the ones in more it doesn't have yet, None if neither has any
+    if matches is None and more is None:
+        return None
+    seen = {match['id'] for match in matches or []}
+    return list(matches or []) + [match for match in more or [] if match['id'] not in seen]
+
+def selectMatchesInRange(search, date_range, top_k: int = 5, **selection) -> list:
+    """
+    selectMatches for a question about date_range, widened to every date if fewer than top_k distinct
+    articles in the range are good enough (vectors stored before dates were added to the metadata
+    can't pass the filter). The widened picks still rank the in-range matches first
+
+    @param search: search(date_range) -> (vector_matches, keyword_matches), date_range None searches every date
+    @param date_range: (start, end) unix timestamps, or None
+    @param top_k: Number of distinct articles to return
+    @param selection: min_score and diversity, see selectMatches
+    """
+    vector_matches, keyword_matches = search(date_range)
+    matches = selectMatches(vector_matches, keyword_matches, top_k, **selection)
+    if date_range is None or len(matches) >= top_k:
+        return matches
+
+    more_vector_matches, more_keyword_matches = search(None)
+    return selectMatches(_appendNew(vector_matches, more_vector_matches),
+                         _appendNew(keyword_matches, more_keyword_matches),
+                         top_k, **selection)
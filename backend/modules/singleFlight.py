@@ -0,0 +1,86 @@
+import asyncio
+import threading
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the function and everyone
+    who asks for the same key while it's running waits for (and gets) that same result or exception.
+    Nothing is remembered once the call finishes, so this only dedupes work that is in flight at
+    the same moment (caches are still where finished results live).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> _Call (threads) or asyncio.Task (async callers)
+        self._calls = {}
+        self._async_calls = {}
+
+        self._executions = 0
+        self._coalesced = 0
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        @param key: Calls with equal (hashable) keys are coalesced
+        @return: What function(*args, **kwargs) returned, for whichever caller ran it
+        @raise Exception: Whatever function raised
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._executions += 1
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    async def do_async(self, key, function, *args, **kwargs):
+        """
+        Async version of do, for coroutine functions. The shared call runs as its own task,
+        so a caller that is cancelled doesn't cancel it for everyone else
+        """
+        with self._lock:
+            task = self._async_calls.get(key)
+            if task is not None:
+                self._coalesced += 1
+            else:
+                task = asyncio.ensure_future(function(*args, **kwargs))
+                self._async_calls[key] = task
+                self._executions += 1
+                task.add_done_callback(lambda _: self._forget_async(key, task))
+
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "executions": self._executions,
+                "coalesced": self._coalesced,
+                "in_flight": len(self._calls) + len(self._async_calls),
+            }
+
+    def _forget_async(self, key, task):
+        with self._lock:
+            if self._async_calls.get(key) is task:
+                del self._async_calls[key]
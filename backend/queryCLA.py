@@ -5,15 +5,16 @@ python3 queryCLA.py [index_name] [prompt_to_query]
 
 import os
 import sys
-import time
 from dotenv import load_dotenv
 
-from pinecone.grpc import PineconeGRPC as Pinecone
 import google.generativeai as genai  
 
-from modules.articleCleaner import clean_article
-from modules.articleFetcher import fetchArticleById
+from modules.contextBuilder import buildContext
+from modules.dateFilter import extractDateRange, buildDateFilter
+from modules.documentStore import DocumentStore
 from modules.embeddingFuncs import generateQueryEmbedding
+from modules.lexicalIndex import LexicalIndex
+from modules.retrieval import createIndexRegistry, selectMatchesInRange
 
 # Load environment variables from .env file
 load_dotenv()
@@ -21,12 +22,25 @@ load_dotenv()
 # Access variables
 GOOGLE_GENAI_API_KEY = os.getenv("GOOGLE_GENAI_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
+DOCUMENT_STORE_PATH = os.getenv("DOCUMENT_STORE_PATH", "./documents.db")
+# Where vectors are searched: "pinecone" or "local" (an exact in-process index, see modules/localIndex.py)
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "pinecone")
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "./local_index")
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE", "float32")
 
 # Configure the Google Generative AI library
 genai.configure(api_key=GOOGLE_GENAI_API_KEY)
 
-# Configure the Pinecone database
-pc = Pinecone(api_key=PINECONE_API_KEY)
+# Configure the vector database
+index_registry = createIndexRegistry(RETRIEVAL_BACKEND,
+                                     pinecone_api_key=PINECONE_API_KEY,
+                                     local_index_path=LOCAL_INDEX_PATH,
+                                     local_index_dtype=LOCAL_INDEX_DTYPE)
+
+# Cleaned articles written by store.py/update.py (missing ones are fetched from wordpress)
+document_store = DocumentStore(DOCUMENT_STORE_PATH)
+# Keyword (BM25) index of the same articles, fused with the vector results
+lexical_index = LexicalIndex(DOCUMENT_STORE_PATH)
 
 # Constants used throughout
 EMBEDDING_MODEL = "models/text-embedding-004"
@@ -39,16 +53,12 @@ if (len(sys.argv)-1 != 2):
     exit()
 
 DATABASE_INDEX_NAME = sys.argv[1]
-if DATABASE_INDEX_NAME not in pc.list_indexes().names():
+if not index_registry.is_known(DATABASE_INDEX_NAME):
     print("Invalid index name. Exiting.")
     exit()
 
 # Wait for the index to be ready
-while not pc.describe_index(DATABASE_INDEX_NAME).status['ready']:
-    print("Waiting for index...")
-    time.sleep(1)
-    
-index = pc.Index(DATABASE_INDEX_NAME)
+index = index_registry.wait_until_ready(DATABASE_INDEX_NAME)
 
 """ 
 /////////////////////////////////
@@ -65,12 +75,20 @@ embedding = generateQueryEmbedding(genai=genai,
                                    embedding_model=EMBEDDING_MODEL,
                                    query=query)
 
-results = index.query(
-    vector=embedding,
-    top_k=10,
-    include_values=False,
-    include_metadata=True
-)
+# Fuse the vector matches with a keyword (BM25) search so names and exact wording aren't missed
+def search(date_range):
+    vector_matches = index.query(
+        vector=embedding,
+        top_k=40,
+        filter=buildDateFilter(date_range),
+        include_values=True,
+        include_metadata=True
+    )['matches']
+    return vector_matches, lexical_index.search(query, top_k=40, date_range=date_range)
+
+# Keep 10 distinct articles (chunks of the same article only count once), only from the dates
+# the question mentions (ex: "homecoming in 2019") unless older, undated vectors leave too few of them
+results = {"matches": selectMatchesInRange(search, extractDateRange(query), top_k=10)}
 
 """ 
 /////////////////////////////////
@@ -79,25 +97,8 @@ results = index.query(
 """
 model = genai.GenerativeModel("gemini-1.5-flash")
 
-context = ""
-
-for result in results['matches']:
-    # Get ID (incase it's a chunk, only get whatever is before '_')
-    # ex: if id="18352_chunk0", we only want id="18352"
-    id = result['id'].split('_')[0]
-
-    # Get article
-    article = fetchArticleById(id)
-
-    # Clean article
-    cleanedArticle = clean_article(article)
-
-    # Add context to feed into LLM
-    link = result['metadata']['link']
-    context += f"""\nARTICLE START (Source: {link})\n
-    {cleanedArticle}
-    \nARTICLE END\n
-    """
+# Fetch and clean the matched articles in parallel
+context = buildContext(results['matches'], document_store=document_store)
 
 instructions = f"""
 You are an expert in whatever context is provided. Provide only factual information that you can back up using the context. Only mention facts, while keeping a light tone. Act like you are responding direclty to a question as a human.
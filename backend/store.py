@@ -1,15 +1,14 @@
 import os
-import time
 from dotenv import load_dotenv
 
-from pinecone.grpc import PineconeGRPC as Pinecone
 import google.generativeai as genai
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-from modules.articleCleaner import clean_all_articles
-from modules.articleFetcher import fetchArticles
-from modules.embeddingFuncs import embedArticle
-from modules.embeddingFuncs import embedChunksAsArticle
+from modules.articleFetcher import iterArticlePages
+from modules.documentStore import DocumentStore
+from modules.embeddingCache import ArticleEmbeddingCache
+from modules.ingestPipeline import IngestPipeline
+from modules.lexicalIndex import LexicalIndex
+from modules.retrieval import createIndexRegistry
 from modules.Logger import Logger
 
 print("\n----LOADING ENVIRONMENT VARIABLES----")
@@ -19,20 +18,35 @@ load_dotenv()
 # Access variables
 GOOGLE_GENAI_API_KEY = os.getenv("GOOGLE_GENAI_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
+DOCUMENT_STORE_PATH = os.getenv("DOCUMENT_STORE_PATH", "./documents.db")
+ARTICLE_EMBEDDING_CACHE_PATH = os.getenv("ARTICLE_EMBEDDING_CACHE_PATH", "./article_embeddings.db")
+# Where vectors are searched: "pinecone" or "local" (an exact in-process index, see modules/localIndex.py)
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "pinecone")
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "./local_index")
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE", "float32")
 
 # Configure the Google Generative AI library
 genai.configure(api_key=GOOGLE_GENAI_API_KEY)
 
-# Configure the Pinecone database
-pc = Pinecone(api_key=PINECONE_API_KEY)
+# Configure the vector database
+index_registry = createIndexRegistry(RETRIEVAL_BACKEND,
+                                     pinecone_api_key=PINECONE_API_KEY,
+                                     local_index_path=LOCAL_INDEX_PATH,
+                                     local_index_dtype=LOCAL_INDEX_DTYPE,
+                                     create_missing=True)
+
+# Local store of cleaned articles, read by the query path
+document_store = DocumentStore(DOCUMENT_STORE_PATH)
+# Keyword (BM25) index of the same text, searched alongside the vectors
+lexical_index = LexicalIndex(DOCUMENT_STORE_PATH)
+# Embeddings of every passage embedded so far, so unchanged articles aren't embedded again
+embedding_cache = ArticleEmbeddingCache(ARTICLE_EMBEDDING_CACHE_PATH)
 
 # Constants used throughout
 DATABASE_INDEX_NAME = str(input("Enter database index name: "))
 EMBEDDING_MODEL = "models/text-embedding-004"
-MODEL_MAX_CHUNKS = 9500
-CHUNK_OVERLAP = 200
 
-if DATABASE_INDEX_NAME not in pc.list_indexes().names():
+if not index_registry.is_known(DATABASE_INDEX_NAME):
     print("Invalid index name. Exiting.")
     exit()
 
@@ -59,9 +73,6 @@ try:
 except:
     ENDING_PAGE = 10
 
-# Store articles in segments (incase of runtime failure)
-EVERY_N = 5
-
 logger = Logger(storage_path="./logs",
                     index_name=DATABASE_INDEX_NAME,
                     logging_enabled=LOG_SKIPPED_ARTICLES,
@@ -77,146 +88,85 @@ if (LOG_SKIPPED_ARTICLES == "y"):
 
 if LOG_SKIPPED_ARTICLES=="y":
     logger.start_fetching_articles_section()
-# Loop through every n articles
-curr_page = STARTING_PAGE
-while (curr_page <= ENDING_PAGE):
-    # Calculate how many pages to search (either 5, or if we're near the end, less than 5)
-    page_range = min(4, ENDING_PAGE-curr_page)
-    end_segment = curr_page + page_range
-    print(f"Getting pages {curr_page}-{end_segment}")
-    
-    """ 
-    /////////////////////////////////
-    //////  Fetch and Clean Articles
-    /////////////////////////////////
-    """
-    articles = fetchArticles(starting_page=curr_page, ending_page=end_segment)
-
-    if (articles):
-        # Clean articles
-        print(len(articles), "articles successfully fetched")
-        logger.log_successful_article_fetch(curr_page, end_segment)
-
-        clean_all_articles(articles)
-
-        # Store ID of first (most recent) article found
-        if (curr_page == STARTING_PAGE):
-            logger.store_latest_id(str(articles[0]['id']))
+    logger.start_embedding_section(start_page=STARTING_PAGE, end_page=ENDING_PAGE)
+    logger.start_upserting_section(start_page=STARTING_PAGE, end_page=ENDING_PAGE)
+
+""" 
+/////////////////////////////////
+//////  Fetch, Clean, Embed and Upsert Articles
+/////////////////////////////////
+"""
+# Pages are downloaded, cleaned, embedded and upserted at the same time (see modules/ingestPipeline.py),
+# and everything is saved in small batches along the way (incase of runtime failure)
+def onPage(page, articles):
+    if articles is None:
+        print(f"Error fetching page {page}.")
+        logger.log_failed_article_fetch(page, page)
+        return
+
+    print(f"{len(articles)} articles successfully fetched from page {page}")
+    logger.log_successful_article_fetch(page, page)
+
+    # Store ID of first (most recent) article found
+    if page == STARTING_PAGE and articles:
+        logger.store_latest_id(str(articles[0]['id']))
+
+def onSkipped(reason, article_id):
+    if reason == "missing_content":
+        if DISPLAY_SKIPPED_ARTICLES=="y":
+            print(f"\nSkipping article with missing content (ID {article_id})\n")
+        if LOG_SKIPPED_ARTICLES=="y":
+            logger.log_missing_content(article_id=article_id)
+    elif reason == "missing_id":
+        if DISPLAY_SKIPPED_ARTICLES=="y":
+            print("\nSkipping article with no ID\n")
+        if LOG_SKIPPED_ARTICLES=="y":
+            logger.log_missing_id()
     else:
-        print("Error fetching articles.")
-        logger.log_failed_article_fetch(curr_page, end_segment)
-        logger.end_log(f"FATAL ERROR: COULD NOT FETCH ARTICLES {curr_page}-{end_segment}")
-        exit()
+        if DISPLAY_SKIPPED_ARTICLES=="y":
+            print(f"Error generating embedding for article {article_id}.\n")
+        if LOG_SKIPPED_ARTICLES=="y":
+            logger.log_embedding_error(article_id=article_id)
 
-    """ 
-    /////////////////////////////////
-    //////  Embed Articles
-    /////////////////////////////////
-    """
-    # Generate embeddings
-    embeddings = []
-    ARTICLES_LEN = len(articles)
-    # Dynamic step calculation
-    update_factor = max(1, len(articles) // 100)
-
-    print(f"Generating embeddings for {ARTICLES_LEN} articles")
+def onUpserted(num_embeddings):
+    print(f"Upserted {num_embeddings} embeddings")
     if LOG_SKIPPED_ARTICLES=="y":
-        logger.start_embedding_section(start_page=curr_page,
-                                   end_page=end_segment)
-
-    for i, article in enumerate(articles):
-        content = article['content']['rendered']
-        article_id = str(article['id'])
-        
-        # Only run if there is both content to embed and an id to associate it with
-        if content and article_id:
-            try:
-                # Embed the article
-                embedArticle(genai, embeddings, EMBEDDING_MODEL, article)
-            
-            # The article may be too big. In that case, try splitting it into chunks
-            except Exception as e:
-                if DISPLAY_SKIPPED_ARTICLES=="y":
-                    print(f"\nError generating embedding for article {article_id}: {e} (index {i}). Attempting to split into chunks...")
-                
-                # Split text into chunks of up to 10000
-                text_splitter = RecursiveCharacterTextSplitter(chunk_size=(MODEL_MAX_CHUNKS-CHUNK_OVERLAP), chunk_overlap=CHUNK_OVERLAP)
-                texts = text_splitter.split_text(content)
-
-                # Embed the chunks
-                embed_success = embedChunksAsArticle(genai, embeddings, EMBEDDING_MODEL, article, texts)
-
-                # If the embed of chunks was successful, print to indicate
-                if (embed_success):
-                    if DISPLAY_SKIPPED_ARTICLES=="y":
-                        print(f"Successfully split into {len(texts)} chunks.\n")
-                else:
-                    if DISPLAY_SKIPPED_ARTICLES=="y":
-                        print(f"Error generating embedding for article {article_id}. Could not split into chunks.\n")
-
-                    # Log skipped article
-                    if LOG_SKIPPED_ARTICLES=="y":
-                        logger.log_chunking_error(article_id=article_id)
-
-        # If the article is missing an id or content, skip it
-        else:
-            if article_id:
-                # No content
-                if DISPLAY_SKIPPED_ARTICLES=="y":
-                    print(f"\nSkipping article with missing content (ID {article_id}, index {i})\n")
-
-                # Log skipped article
-                if LOG_SKIPPED_ARTICLES=="y":
-                    logger.log_missing_content(article_id=article_id)
-
-            else:
-                # No ID
-                if DISPLAY_SKIPPED_ARTICLES=="y":
-                    print(f"\nSkipping article with no ID (index {i})\n")
-
-                # Log skipped article
-                if LOG_SKIPPED_ARTICLES=="y":
-                        logger.log_missing_id()
-
-        
-        # Print a progress bar (updates every {update_factor} articles)
-        if i % update_factor == 0 or i == ARTICLES_LEN-1:
-            # If we finished, set the percent to 100
-            if (i == ARTICLES_LEN-1):
-                percent = 100.0
-            # Otherwise, set percent to the ratio of index of current article and length of articles
-            else:
-                percent = str(round((i+update_factor)*100/ARTICLES_LEN, 2))
-            print(f"\r{'#'*(round((i+update_factor)/update_factor))}{' '*(round( (ARTICLES_LEN-(i+update_factor))/update_factor ))} {percent}%", end='', flush=True)
-
-    print(f"\nSuccessfully created {len(embeddings)} embeddings")
-
-    """ 
-    /////////////////////////////////
-    //////  Upsert Data
-    /////////////////////////////////
-    """
-
-    if LOG_SKIPPED_ARTICLES=="y":
-        logger.start_upserting_section(start_page=curr_page,
-                                   end_page=end_segment)
-    # Wait for the index to be ready
-    while not pc.describe_index(DATABASE_INDEX_NAME).status['ready']:
-        print("Waiting for index...")
-        time.sleep(1)
-
-    print("Index connected.")
-    index = pc.Index(DATABASE_INDEX_NAME)
-
-    index.upsert(
-        vectors=embeddings
-    )
-    print("---------------------------------------------------------")
-    print(f"\nSuccessfully upserted {len(embeddings)} embeddings.\n")
-    print("---------------------------------------------------------")
-    if LOG_SKIPPED_ARTICLES=="y":
-        logger.log_successful_upsert(len(embeddings))
+        logger.log_successful_upsert(num_embeddings)
+
+# Wait for the index to be ready
+index = index_registry.wait_until_ready(DATABASE_INDEX_NAME)
+print("Index connected.")
+
+pipeline = IngestPipeline(genai=genai,
+                          index=index,
+                          document_store=document_store,
+                          lexical_index=lexical_index,
+                          embedding_model=EMBEDDING_MODEL,
+                          embedding_cache=embedding_cache,
+                          verbose=DISPLAY_SKIPPED_ARTICLES=="y",
+                          on_page=onPage,
+                          on_skipped=onSkipped,
+                          on_upserted=onUpserted)
+
+print(f"Getting pages {STARTING_PAGE}-{ENDING_PAGE}")
+stats = pipeline.run(iterArticlePages(range(STARTING_PAGE, ENDING_PAGE + 1)))
+
+print("---------------------------------------------------------")
+print(f"\nSuccessfully upserted {stats['embeddings']} embeddings for {stats['embedded']} of {stats['articles']} articles "
+      f"from {stats['pages']} pages in {stats['seconds']} seconds ({stats['chunked']} split into chunks, {stats['skipped']} skipped).\n")
+chunking = stats['chunking']
+if chunking['chunks']:
+    print(f"Chunks: {chunking['chunked_articles']} of {chunking['articles']} articles were too big to embed whole. "
+          f"{chunking['chunks']} passages embedded, {chunking['mean_chunk_bytes']} bytes on average "
+          f"(max {chunking['max_chunk_bytes']} bytes, up to {chunking['max_chunks_per_article']} per article).\n")
+cached = stats['embedding_cache']
+print(f"Embedding cache: {cached['hits']} passages were already embedded, {cached['misses']} sent to gemini.\n")
+print("---------------------------------------------------------")
+
+if stats['failed_page'] is not None:
+    print("Error fetching articles.")
+    logger.end_log(f"FATAL ERROR: COULD NOT FETCH PAGE {stats['failed_page']}")
+    exit()
 
-    curr_page = end_segment + 1
 if LOG_SKIPPED_ARTICLES=="y":
-    logger.end_log()
\ No newline at end of file
+    logger.end_log()
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# Run against throwaway local stores, so importing app.py needs no pinecone account or .env
+_data_dir = tempfile.mkdtemp(prefix="dbllm-tests-")
+os.environ["RETRIEVAL_BACKEND"] = "local"
+os.environ["LOCAL_INDEX_PATH"] = os.path.join(_data_dir, "local_index")
+os.environ["DOCUMENT_STORE_PATH"] = os.path.join(_data_dir, "documents.db")
+os.environ["QUERY_EMBEDDING_CACHE_PATH"] = ""
+
+# The backend imports its modules as "modules.x" from the backend folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+
+from modules.admission import AdmissionController, OverloadedError
+
+def test_full_queue_is_turned_away_with_429():
+    admission = AdmissionController(max_in_flight=1, max_queue=0)
+    admission.acquire()
+    with pytest.raises(OverloadedError) as error:
+        admission.acquire()
+    assert error.value.status_code == 429
+    assert error.value.retry_after >= 1
+    assert admission.stats()["rejected"] == 1
+
+def test_wait_that_times_out_is_turned_away_with_503():
+    admission = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=0.05)
+    admission.acquire()
+    with pytest.raises(OverloadedError) as error:
+        admission.acquire()
+    assert error.value.status_code == 503
+    assert error.value.retry_after >= 1
+    assert admission.stats()["queue_depth"] == 0
+
+def test_released_slot_goes_to_the_waiting_request():
+    admission = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=5)
+    acquired_at = admission.acquire()
+    granted = threading.Event()
+    waiter = threading.Thread(target=lambda: (admission.acquire(), granted.set()))
+    waiter.start()
+    while admission.stats()["queue_depth"] == 0:
+        pass
+
+    admission.release(acquired_at)
+    waiter.join()
+    assert granted.is_set()
+    assert admission.stats()["in_flight"] == 1
+
+def test_try_acquire_never_waits_or_jumps_the_queue():
+    admission = AdmissionController(max_in_flight=2, max_queue=1)
+    assert admission.try_acquire() is not None
+    assert admission.try_acquire() is not None
+    assert admission.try_acquire() is None
+    assert admission.stats()["in_flight"] == 2
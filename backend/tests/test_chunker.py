@@ -0,0 +1,30 @@
+from modules.chunker import Chunker, textBytes
+
+def test_text_that_fits_is_one_passage():
+    chunker = Chunker(max_bytes=1000, overlap=50)
+    text = "word " * 199
+    assert chunker.split(text) == ([text], False)
+
+def test_limit_counts_bytes_not_characters():
+    chunker = Chunker(max_bytes=1000, overlap=50)
+    # 600 characters, but 1200 bytes
+    passages, chunked = chunker.split("é" * 600)
+    assert chunked
+    assert all(textBytes(passage) <= 1000 for passage in passages)
+
+def test_every_chunk_fits_under_the_limit():
+    chunker = Chunker(max_bytes=1000, overlap=50)
+    paragraphs = ["“Quoted” sentence with émojis 🐻 and accents. " * 12, "x" * 2500, "short paragraph"]
+    passages, chunked = chunker.split("\n\n".join(paragraphs))
+    assert chunked
+    assert all(textBytes(passage) <= 1000 for passage in passages)
+    assert chunker.stats()["max_chunk_bytes"] <= 1000
+
+def test_stats_count_articles_and_chunks():
+    chunker = Chunker(max_bytes=1000, overlap=50)
+    chunker.split("small")
+    passages, _ = chunker.split("sentence here. " * 200)
+    stats = chunker.stats()
+    assert (stats["articles"], stats["chunked_articles"]) == (2, 1)
+    assert stats["chunks"] == 1 + len(passages)
+    assert stats["max_chunks_per_article"] == len(passages)
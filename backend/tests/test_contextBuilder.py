@@ -0,0 +1,17 @@
+from modules.contextBuilder import selectPassage
+
+CONTENT = "aaaa bbbb cccc dddd"
+CHUNKS = [(0, 9), (10, 19)]
+
+def test_cut_on_a_word_boundary_keeps_the_whole_words():
+    assert selectPassage(CONTENT, CHUNKS, 1, char_budget=9) == "cccc dddd"
+    assert selectPassage(CONTENT, CHUNKS, 0, char_budget=9) == "aaaa bbbb"
+
+def test_cut_inside_a_word_drops_the_partial_word():
+    assert selectPassage(CONTENT, CHUNKS, 1, char_budget=7) == "cccc"
+    assert selectPassage(CONTENT, [(0, 9), (7, 19)], 1, char_budget=12) == "cccc dddd"
+
+def test_overlapping_chunks_keep_every_word():
+    content = "aaaa bbbb cccc dddd eeee ffff gggg"
+    chunks = [(0, 14), (10, 29), (25, 34)]
+    assert selectPassage(content, chunks, 1, char_budget=19) == "cccc dddd eeee ffff"
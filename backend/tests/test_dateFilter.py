@@ -0,0 +1,46 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from modules.dateFilter import extractDateRange
+
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+def year(start: int, end: int = None) -> tuple:
+    return (int(datetime(start, 1, 1, tzinfo=timezone.utc).timestamp()),
+            int(datetime((end or start) + 1, 1, 1, tzinfo=timezone.utc).timestamp()))
+
+@pytest.mark.parametrize("query", [
+    "who wore number 2000",
+    "who ran for 1999 yards",
+    "the team scored 2010 points",
+    "how many students live in the 2000 block of gayley",
+    "why did the '90s matter",
+    "advice from 2000 alumni",
+    "letters from 1999 graduates",
+])
+def test_numbers_shaped_like_years_are_not_dates(query):
+    assert extractDateRange(query, NOW) is None
+
+@pytest.mark.parametrize("query, expected", [
+    ("what happened at homecoming in 2019", year(2019)),
+    ("protests during 2020", year(2020)),
+    ("the 2019 season", year(2019)),
+    ("fall 2019 enrollment", year(2019)),
+    ("the class of '98", year(1998)),
+    ("the '19 championship", year(2019)),
+    ("games between 2015 and 2017", year(2015, 2017)),
+    ("2015-17 seasons", year(2015, 2017)),
+    ("in 2018 and in 2020", year(2018, 2020)),
+    ("since 2021", year(2021, 2024)),
+    ("from 2021 on", year(2021, 2024)),
+    ("from 2015 to 2017", year(2015, 2017)),
+    ("this year", year(2024)),
+])
+def test_years_with_date_context(query, expected):
+    assert extractDateRange(query, NOW) == expected
+
+def test_month_and_year():
+    start = int(datetime(2020, 10, 1, tzinfo=timezone.utc).timestamp())
+    end = int(datetime(2020, 11, 1, tzinfo=timezone.utc).timestamp())
+    assert extractDateRange("october 2020 protests", NOW) == (start, end)
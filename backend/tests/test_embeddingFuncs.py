@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from modules import embeddingFuncs
+from modules.embeddingFuncs import embedTexts, generateQueryEmbeddings, generateQueryEmbeddingsAsync
+
+class FakeGenai:
+    """
+    Embeds a text as [len(text)], failing the next calls with the queued errors first,
+    and rejecting every batch with one of the bad texts in it
+    """
+    def __init__(self, errors: list = None, bad: set = ()):
+        self.errors = list(errors or [])
+        self.bad = set(bad)
+        self.batch_sizes = []
+
+    def embed_content(self, model=None, content=None):
+        self.batch_sizes.append(len(content))
+        if self.errors:
+            raise self.errors.pop(0)
+        if self.bad.intersection(content):
+            raise google_exceptions.InvalidArgument("bad text")
+        return {"embedding": [[float(len(text))] for text in content]}
+
+    async def embed_content_async(self, model=None, content=None):
+        return self.embed_content(model, content)
+
+@pytest.fixture(autouse=True)
+def noBackoff(monkeypatch):
+    monkeypatch.setattr(embeddingFuncs, "EMBED_BACKOFF", 0)
+
+def test_query_batches_are_split_into_batch_size_calls():
+    genai = FakeGenai()
+    queries = [f"question {i}" for i in range(250)]
+    embeddings = generateQueryEmbeddings(genai, "model", queries)
+    assert genai.batch_sizes == [100, 100, 50]
+    assert embeddings == [[float(len(query))] for query in queries]
+
+def test_query_batches_retry_transient_errors():
+    genai = FakeGenai(errors=[google_exceptions.ServiceUnavailable("down")])
+    assert generateQueryEmbeddings(genai, "model", ["a", "bb"]) == [[1.0], [2.0]]
+    assert genai.batch_sizes == [2, 2]
+
+def test_async_query_batches_are_split_into_batch_size_calls():
+    genai = FakeGenai(errors=[google_exceptions.ResourceExhausted("slow down")])
+    queries = [f"question {i}" for i in range(150)]
+    embeddings = asyncio.run(generateQueryEmbeddingsAsync(genai, "model", queries))
+    # Two batches, the first one sent twice
+    assert sorted(genai.batch_sizes) == [50, 100, 100]
+    assert embeddings == [[float(len(query))] for query in queries]
+
+def test_rejected_batch_is_split_until_the_bad_text_is_found():
+    genai = FakeGenai(bad={"ccc"})
+    texts = ["a", "bb", "ccc", "dddd", "eeeee", "ffffff", "ggggggg", "hhhhhhhh"]
+    embeddings = embedTexts(genai, "model", texts)
+    assert embeddings == [[1.0], [2.0], None, [4.0], [5.0], [6.0], [7.0], [8.0]]
+    # Only the halves with the bad text in them are split again
+    assert genai.batch_sizes == [8, 4, 2, 2, 1, 1, 4]
+
+def test_errors_that_are_not_about_the_texts_are_raised_without_splitting():
+    genai = FakeGenai(errors=[google_exceptions.PermissionDenied("bad key")])
+    with pytest.raises(google_exceptions.PermissionDenied):
+        embedTexts(genai, "model", ["a", "bb", "ccc", "dddd"])
+    assert genai.batch_sizes == [4]
+
+def test_outage_that_outlasts_the_retries_is_raised(monkeypatch):
+    monkeypatch.setattr(embeddingFuncs, "EMBED_RETRIES", 1)
+    genai = FakeGenai(errors=[google_exceptions.ServiceUnavailable("down")] * 2)
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        embedTexts(genai, "model", ["a", "bb"])
+
+def test_failed_query_batch_only_fails_its_own_questions(monkeypatch):
+    monkeypatch.setattr(embeddingFuncs, "EMBED_BATCH_SIZE", 2)
+    genai = FakeGenai(errors=[google_exceptions.PermissionDenied("bad key")])
+    assert generateQueryEmbeddings(genai, "model", ["a", "bb", "ccc"]) == [None, None, [3.0]]
+
+    genai = FakeGenai(errors=[google_exceptions.PermissionDenied("bad key")])
+    embeddings = asyncio.run(generateQueryEmbeddingsAsync(genai, "model", ["a", "bb", "ccc"]))
+    assert embeddings == [None, None, [3.0]]
@@ -0,0 +1,142 @@
+import time
+import asyncio
+import types
+
+import pytest
+
+from modules.admission import AdmissionController
+from modules.generation import HedgedGenerator
+
+class FakeModel:
+    def __init__(self, name: str, latency: float = 0.0, error: Exception = None):
+        self.model_name = name
+        self.latency = latency
+        self.error = error
+        self.calls = 0
+
+    def generate_content(self, instructions, safety_settings=None, stream=False):
+        self.calls += 1
+        time.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+        if stream:
+            return iter(self.chunks())
+        return types.SimpleNamespace(text=f"{self.model_name} answer")
+
+    async def generate_content_async(self, instructions, safety_settings=None, stream=False):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+        if stream:
+            return self.chunks_async()
+        return types.SimpleNamespace(text=f"{self.model_name} answer")
+
+    def chunks(self) -> list:
+        return [types.SimpleNamespace(text=self.model_name), types.SimpleNamespace(text=" answer")]
+
+    async def chunks_async(self):
+        for chunk in self.chunks():
+            yield chunk
+
+def generator(primary, fallback, admission=None, deadline=2.0) -> HedgedGenerator:
+    return HedgedGenerator(primary, fallback, {}, initial_hedge_delay=0.05, min_hedge_delay=0.05,
+                           deadline=deadline, admission=admission)
+
+def test_fast_primary_is_not_hedged():
+    primary, fallback = FakeModel("primary"), FakeModel("fallback")
+    result = generator(primary, fallback).generate("prompt")
+    assert (result["model"], result["hedged"]) == ("primary", False)
+    assert fallback.calls == 0
+
+def test_slow_primary_is_hedged_after_the_hedge_delay():
+    primary, fallback = FakeModel("primary", latency=0.5), FakeModel("fallback")
+    result = generator(primary, fallback).generate("prompt")
+    assert (result["model"], result["hedged"]) == ("fallback", True)
+
+def test_failed_primary_falls_back():
+    primary, fallback = FakeModel("primary", error=RuntimeError("down")), FakeModel("fallback")
+    result = generator(primary, fallback).generate("prompt")
+    assert (result["model"], result["hedged"]) == ("fallback", False)
+
+def test_nobody_answering_before_the_deadline_times_out():
+    primary, fallback = FakeModel("primary", latency=0.5), FakeModel("fallback", latency=0.5)
+    with pytest.raises(TimeoutError):
+        generator(primary, fallback, deadline=0.2).generate("prompt")
+
+def test_hedge_is_skipped_without_a_free_slot():
+    admission = AdmissionController(max_in_flight=1)
+    primary, fallback = FakeModel("primary", latency=0.2), FakeModel("fallback")
+    result = generator(primary, fallback, admission).generate("prompt", slot=admission.acquire())
+    assert (result["model"], result["hedged"]) == ("primary", False)
+    assert fallback.calls == 0
+
+def test_losing_call_holds_its_slot_until_it_finishes():
+    admission = AdmissionController(max_in_flight=2)
+    primary, fallback = FakeModel("primary", latency=0.3), FakeModel("fallback")
+    result = generator(primary, fallback, admission).generate("prompt", slot=admission.acquire())
+    assert result["model"] == "fallback"
+    assert admission.stats()["in_flight"] == 1
+
+    time.sleep(0.4)
+    assert admission.stats()["in_flight"] == 0
+
+def test_async_hedge_takes_a_slot_and_gives_both_back():
+    admission = AdmissionController(max_in_flight=2)
+    primary, fallback = FakeModel("primary", latency=0.5), FakeModel("fallback")
+
+    async def main():
+        result = await generator(primary, fallback, admission).generate_async("prompt",
+                                                                              slot=await admission.acquire_async())
+        # Let the cancelled primary call finish
+        await asyncio.sleep(0.01)
+        return result
+
+    result = asyncio.run(main())
+    assert (result["model"], result["hedged"]) == ("fallback", True)
+    assert admission.stats()["in_flight"] == 0
+
+def test_stream_falls_back_before_the_first_chunk():
+    primary, fallback = FakeModel("primary", error=RuntimeError("down")), FakeModel("fallback")
+    stream = generator(primary, fallback).stream()
+    assert "".join(stream.texts("prompt")) == "fallback answer"
+    assert (stream.model, stream.hedged) == ("fallback", False)
+
+def test_slow_stream_is_hedged_and_both_slots_are_given_back():
+    admission = AdmissionController(max_in_flight=2)
+    primary, fallback = FakeModel("primary", latency=0.3), FakeModel("fallback")
+    stream = generator(primary, fallback, admission).stream(slot=admission.acquire())
+    assert "".join(stream.texts("prompt")) == "fallback answer"
+    assert (stream.model, stream.hedged) == ("fallback", True)
+    # The primary call that lost still holds its slot
+    assert admission.stats()["in_flight"] == 1
+
+    time.sleep(0.4)
+    assert admission.stats()["in_flight"] == 0
+
+def test_stream_times_out_at_the_deadline():
+    primary, fallback = FakeModel("primary", latency=0.5), FakeModel("fallback", latency=0.5)
+    with pytest.raises(TimeoutError):
+        list(generator(primary, fallback, deadline=0.2).stream().texts("prompt"))
+
+def test_unread_stream_gives_its_slot_back_when_closed():
+    admission = AdmissionController(max_in_flight=1)
+    stream = generator(FakeModel("primary"), FakeModel("fallback"), admission).stream(slot=admission.acquire())
+    stream.close()
+    assert admission.stats()["in_flight"] == 0
+
+def test_async_stream_is_hedged_and_gives_both_slots_back():
+    admission = AdmissionController(max_in_flight=2)
+    primary, fallback = FakeModel("primary", latency=0.5), FakeModel("fallback")
+
+    async def main():
+        stream = generator(primary, fallback, admission).stream(slot=await admission.acquire_async())
+        texts = [text async for text in stream.texts_async("prompt")]
+        # Let the cancelled primary call finish
+        await asyncio.sleep(0.01)
+        return stream, texts
+
+    stream, texts = asyncio.run(main())
+    assert "".join(texts) == "fallback answer"
+    assert (stream.model, stream.hedged) == ("fallback", True)
+    assert admission.stats()["in_flight"] == 0
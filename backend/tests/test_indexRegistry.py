@@ -0,0 +1,73 @@
+import time
+import types
+import threading
+
+import pytest
+
+from modules.indexRegistry import IndexRegistry, UnknownIndexError, IndexNotReadyError
+
+class FakePinecone:
+    """
+    Control plane with the given indexes (name -> ready). Listing blocks while `listing` is cleared
+    """
+    def __init__(self, indexes: dict):
+        self.indexes = indexes
+        self.listing = threading.Event()
+        self.listing.set()
+        self.list_calls = 0
+        self.describe_calls = 0
+
+    def list_indexes(self):
+        self.list_calls += 1
+        self.listing.wait()
+        return types.SimpleNamespace(names=lambda: list(self.indexes))
+
+    def describe_index(self, name: str):
+        self.describe_calls += 1
+        return types.SimpleNamespace(status={"ready": self.indexes[name]})
+
+    def Index(self, name: str):
+        return f"handle for {name}"
+
+def test_ready_index_gets_one_warm_handle():
+    pc = FakePinecone({"main": True})
+    registry = IndexRegistry(pc, refresh_interval=60)
+    assert registry.get_index("main") == "handle for main"
+    assert registry.get_index("main") == "handle for main"
+    assert (pc.list_calls, pc.describe_calls) == (1, 1)
+
+def test_unknown_and_unready_indexes_are_refused():
+    registry = IndexRegistry(FakePinecone({"main": True, "building": False}), refresh_interval=60)
+    with pytest.raises(UnknownIndexError):
+        registry.get_index("missing")
+    with pytest.raises(IndexNotReadyError):
+        registry.get_index("building")
+
+def test_slow_listing_does_not_hold_up_known_indexes():
+    pc = FakePinecone({"main": True})
+    registry = IndexRegistry(pc, refresh_interval=60, names_ttl=0)
+    registry.get_index("main")
+
+    # Someone asks for an index we don't know, and pinecone is slow to list them
+    pc.listing.clear()
+    lookups = [threading.Thread(target=registry.is_known, args=("new",)) for _ in range(3)]
+    for lookup in lookups:
+        lookup.start()
+
+    try:
+        # Wait for the other lookups to join the first one's listing
+        while registry._flight.stats()["coalesced"] < 2:
+            time.sleep(0.01)
+
+        answered = []
+        request = threading.Thread(target=lambda: answered.append(registry.get_index("main")))
+        request.start()
+        request.join(timeout=1)
+        assert answered == ["handle for main"]
+    finally:
+        pc.listing.set()
+        for lookup in lookups:
+            lookup.join()
+
+    # The first get_index's listing, then one shared by the three lookups
+    assert pc.list_calls == 2
@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from modules import embeddingFuncs
+from modules.documentStore import DocumentStore
+from modules.ingestPipeline import IngestPipeline
+from modules.lexicalIndex import LexicalIndex
+
+class FakeGenai:
+    """
+    Embeds a text as [len(text)], rejecting batches with a bad text in them and failing every call with error
+    """
+    def __init__(self, bad: set = (), error: Exception = None):
+        self.bad = set(bad)
+        self.error = error
+
+    def embed_content(self, model=None, content=None):
+        if self.error is not None:
+            raise self.error
+        if self.bad.intersection(content):
+            raise google_exceptions.InvalidArgument("bad text")
+        return {"embedding": [[float(len(text))] for text in content]}
+
+class FakeIndex:
+    def __init__(self, fail_after: int = None):
+        self.vectors = []
+        self.fail_after = fail_after
+
+    def upsert(self, vectors):
+        if self.fail_after is not None and len(self.vectors) >= self.fail_after:
+            raise RuntimeError("pinecone is down")
+        self.vectors.extend(vectors)
+
+def article(id, content: str) -> dict:
+    return {"id": id, "link": f"https://dailybruin.com/{id}", "date": "2020-01-01T00:00:00",
+            "date_gmt": "2020-01-01T00:00:00", "modified": "2020-01-01T00:00:00", "content": {"rendered": content}}
+
+def pipeline(tmp_path, genai, index, **options) -> IngestPipeline:
+    path = str(tmp_path / "documents.db")
+    document_store = DocumentStore(path)
+    return IngestPipeline(genai, index, document_store, LexicalIndex(path), "model", verbose=False, **options)
+
+@pytest.fixture(autouse=True)
+def noBackoff(monkeypatch):
+    monkeypatch.setattr(embeddingFuncs, "EMBED_BACKOFF", 0)
+
+def runWithin(ingest: IngestPipeline, pages, seconds: float = 10):
+    # Runs the pipeline, failing the test instead of hanging if it never finishes
+    outcome = {}
+    def run():
+        try:
+            outcome["stats"] = ingest.run(pages)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=seconds)
+    assert not thread.is_alive(), "the pipeline didn't drain"
+    return outcome
+
+def test_articles_are_stored_embedded_and_indexed(tmp_path):
+    index = FakeIndex()
+    ingest = pipeline(tmp_path, FakeGenai(), index)
+    pages = [(1, [article(1, "<p>Bruins win</p>"), article(2, "")]), (2, [article(3, "Regents meet")])]
+    stats = runWithin(ingest, pages)["stats"]
+
+    assert {key: stats[key] for key in ("pages", "articles", "embedded", "skipped", "embeddings")} == \
+           {"pages": 2, "articles": 3, "embedded": 2, "skipped": 1, "embeddings": 2}
+    assert sorted(vector["id"] for vector in index.vectors) == ["1", "3"]
+    assert [match["id"] for match in LexicalIndex(str(tmp_path / "documents.db")).search("bruins")] == ["1"]
+
+def test_rejected_article_is_skipped_and_the_run_goes_on(tmp_path):
+    skipped = []
+    index = FakeIndex()
+    ingest = pipeline(tmp_path, FakeGenai(bad={"bad article"}), index,
+                      on_skipped=lambda reason, article_id: skipped.append((reason, article_id)))
+    stats = runWithin(ingest, [(1, [article(1, "bad article"), article(2, "good article")])])["stats"]
+
+    assert skipped == [("embedding_error", "1")]
+    assert [vector["id"] for vector in index.vectors] == ["2"]
+    assert stats["embedded"] == 1
+
+def test_unfetched_page_stops_reading(tmp_path):
+    ingest = pipeline(tmp_path, FakeGenai(), FakeIndex())
+    pages = [(1, [article(1, "first")]), (2, None), (3, [article(3, "never read")])]
+    stats = runWithin(ingest, pages)["stats"]
+    assert (stats["pages"], stats["failed_page"], stats["articles"]) == (1, 2, 1)
+
+def test_embedding_error_stops_the_run(tmp_path):
+    ingest = pipeline(tmp_path, FakeGenai(error=google_exceptions.PermissionDenied("bad key")), FakeIndex())
+    outcome = runWithin(ingest, [(1, [article(i, f"article {i}") for i in range(1, 5)])])
+    assert isinstance(outcome["error"], google_exceptions.PermissionDenied)
+
+def test_upsert_error_drains_every_stage_and_stops_reading(tmp_path):
+    read = []
+    def pages():
+        for page in range(1, 51):
+            read.append(page)
+            yield page, [article(page * 10 + i, f"article {page} {i}") for i in range(10)]
+
+    # Small queues and batches, so every stage is full when the upsert fails
+    ingest = pipeline(tmp_path, FakeGenai(), FakeIndex(fail_after=2), queue_size=2, upsert_batch_size=1,
+                      embed_batch_size=1)
+    outcome = runWithin(ingest, pages())
+
+    assert str(outcome["error"]) == "pinecone is down"
+    assert len(read) < 50
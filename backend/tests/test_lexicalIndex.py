@@ -0,0 +1,108 @@
+import sqlite3
+
+from modules.documentStore import DocumentStore
+from modules.lexicalIndex import LexicalIndex
+from modules.retrieval import reciprocalRankFusion
+
+def article(id: int, content: str, date_gmt: str = "2020-01-01T00:00:00") -> dict:
+    return {"id": id, "link": f"https://dailybruin.com/{id}", "date_gmt": date_gmt, "modified": date_gmt,
+            "date": date_gmt, "content": {"rendered": content}}
+
+def stores(tmp_path):
+    path = str(tmp_path / "documents.db")
+    return DocumentStore(path), LexicalIndex(path, max_term_frequency=1.0), path
+
+def ids(matches: list) -> list:
+    return [match["id"] for match in matches]
+
+def integrityCheck(path: str):
+    # Raises if the inverted index doesn't match the text it's supposed to index
+    connection = sqlite3.connect(path)
+    connection.execute("INSERT INTO passages_fts (passages_fts) VALUES ('integrity-check')")
+    connection.close()
+
+def test_search_finds_names_in_whole_and_chunked_articles(tmp_path):
+    document_store, lexical_index, path = stores(tmp_path)
+    document_store.put_articles([article(1, "Jaime Jaquez scored 30 points"),
+                                 article(2, "The regents met on tuition. Jaquez was not there")])
+    lexical_index.put_passages("1", "Jaime Jaquez scored 30 points", ["Jaime Jaquez scored 30 points"], chunked=False)
+    lexical_index.put_passages("2", "The regents met on tuition. Jaquez was not there",
+                               ["The regents met on tuition.", "Jaquez was not there"], chunked=True)
+
+    assert ids(lexical_index.search("who is jaime jaquez?")) == ["1", "2_chunk1"]
+    assert ids(lexical_index.search("tuition")) == ["2_chunk0"]
+    integrityCheck(path)
+
+def test_passages_only_store_offsets_and_follow_article_edits(tmp_path):
+    document_store, lexical_index, path = stores(tmp_path)
+    document_store.put_articles([article(1, "the bruins won the rivalry game")])
+    lexical_index.put_passages("1", "the bruins won the rivalry game", ["the bruins won the rivalry game"], chunked=False)
+
+    columns = [row[1] for row in sqlite3.connect(path).execute("PRAGMA table_info(passages)")]
+    assert "text" not in columns
+
+    # The article is updated, then re-indexed (the order ingest uses)
+    document_store.put_articles([article(1, "the trojans lost the rivalry game")])
+    assert lexical_index.search("bruins") == []
+    lexical_index.put_passages("1", "the trojans lost the rivalry game", ["the trojans lost the rivalry game"],
+                               chunked=False)
+
+    assert ids(lexical_index.search("trojans")) == ["1"]
+    assert lexical_index.search("bruins") == []
+    integrityCheck(path)
+
+def test_passage_total_is_kept_without_counting(tmp_path):
+    document_store, lexical_index, path = stores(tmp_path)
+    document_store.put_articles([article(1, "aaa bbb"), article(2, "ccc")])
+    lexical_index.put_passages("1", "aaa bbb", ["aaa", "bbb"], chunked=True)
+    lexical_index.put_passages("2", "ccc", ["ccc"], chunked=False)
+    lexical_index.put_passages("1", "aaa bbb", ["aaa bbb"], chunked=False)
+
+    connection = sqlite3.connect(path)
+    assert connection.execute("SELECT total FROM passages_stats").fetchone()[0] == 2
+    assert connection.execute("SELECT count(*) FROM passages").fetchone()[0] == 2
+
+def test_date_range_only_returns_articles_published_in_it(tmp_path):
+    document_store, lexical_index, _ = stores(tmp_path)
+    document_store.put_articles([article(1, "homecoming parade", "2019-10-20T00:00:00"),
+                                 article(2, "homecoming concert", "2021-10-20T00:00:00")])
+    lexical_index.put_passages("1", "homecoming parade", ["homecoming parade"], chunked=False)
+    lexical_index.put_passages("2", "homecoming concert", ["homecoming concert"], chunked=False)
+
+    # 2021-01-01 to 2022-01-01 (UTC)
+    assert ids(lexical_index.search("homecoming", date_range=(1609459200, 1640995200))) == ["2"]
+
+def test_indexes_that_stored_their_own_text_are_migrated(tmp_path):
+    path = str(tmp_path / "documents.db")
+    document_store = DocumentStore(path)
+    document_store.put_articles([article(1, "old passage about westwood")])
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE passages (rowid INTEGER PRIMARY KEY, match_id TEXT NOT NULL, "
+                       "article_id TEXT NOT NULL, text TEXT NOT NULL)")
+    connection.execute("INSERT INTO passages (match_id, article_id, text) VALUES ('1', '1', 'old passage about westwood')")
+    connection.commit()
+
+    lexical_index = LexicalIndex(path, max_term_frequency=1.0)
+    assert ids(lexical_index.search("westwood")) == ["1"]
+    integrityCheck(path)
+
+def test_frequent_terms_are_left_out(tmp_path, monkeypatch):
+    import modules.lexicalIndex as lexicalIndex
+    monkeypatch.setattr(lexicalIndex, "MIN_TERM_FREQUENCY_LIMIT", 1)
+    path = str(tmp_path / "documents.db")
+    document_store = DocumentStore(path)
+    lexical_index = LexicalIndex(path, max_term_frequency=0.5)
+    for i in range(4):
+        text = f"ucla story {i}" + (" pauley" if i == 0 else "")
+        document_store.put_articles([article(i, text)])
+        lexical_index.put_passages(str(i), text, [text], chunked=False)
+
+    # "ucla" is in every passage, only "pauley" is searched
+    assert ids(lexical_index.search("ucla pauley")) == ["0"]
+
+def test_rank_fusion_rewards_matches_found_by_both_searches():
+    vector_matches = [{"id": "a", "score": 0.9, "metadata": {}}, {"id": "b", "score": 0.8, "metadata": {}}]
+    keyword_matches = [{"id": "b", "score": 12.0, "metadata": {}}, {"id": "c", "score": 10.0, "metadata": {}}]
+    fused = reciprocalRankFusion([vector_matches, keyword_matches])
+    assert ids(fused) == ["b", "a", "c"]
+    assert fused[0]["score"] == 1 / 62 + 1 / 61
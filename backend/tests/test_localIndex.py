@@ -0,0 +1,45 @@
+import modules.localIndex as localIndex
+from modules.localIndex import LocalIndex
+
+def vector(id: str, values: list, timestamp: int = 0) -> dict:
+    return {"id": id, "values": values, "metadata": {"timestamp": timestamp}}
+
+def test_upserts_append_and_replace(tmp_path, monkeypatch):
+    # Small generations, so the test also goes through compaction
+    monkeypatch.setattr(localIndex, "MIN_CAPACITY", 4)
+    writer = LocalIndex(str(tmp_path))
+    reader = LocalIndex(str(tmp_path))
+
+    writer.upsert([vector("a", [1, 0]), vector("b", [0, 1])])
+    assert reader.describe_index_stats()["total_vector_count"] == 2
+
+    for i in range(10):
+        writer.upsert([vector(f"c{i}", [-1, i])])
+    # Replacing an id leaves its old row behind, but only the new one can match
+    writer.upsert([vector("a", [0, 1], timestamp=5)])
+
+    assert reader.describe_index_stats()["total_vector_count"] == 12
+    matches = reader.query([0, 1], top_k=2)["matches"]
+    assert sorted(match["id"] for match in matches) == ["a", "b"]
+    assert [match["id"] for match in reader.query([1, 0], top_k=12)["matches"]].count("a") == 1
+
+    filtered = reader.query([0, 1], top_k=5, filter={"timestamp": {"$eq": 5}})["matches"]
+    assert [match["id"] for match in filtered] == ["a"]
+
+def test_query_keeps_reading_its_generation_while_a_new_one_starts(tmp_path, monkeypatch):
+    monkeypatch.setattr(localIndex, "MIN_CAPACITY", 4)
+    index = LocalIndex(str(tmp_path))
+    index.upsert([vector(f"x{i}", [1, i], timestamp=1) for i in range(3)])
+    # Replacing x0 leaves a dead row that the next generation drops, so row numbers shift
+    index.upsert([vector("x0", [1, 0], timestamp=3)])
+
+    # A query took its snapshot, then an upsert started a new generation (and another query
+    # filtered it) before the first query built its filter
+    vectors, _, metadata, _, columns = index._load()
+    index.upsert([vector(f"y{i}", [1, 5 + i], timestamp=2) for i in range(3)])
+    assert [match["id"] for match in index.query([1, 0], filter={"timestamp": {"$eq": 3}})["matches"]] == ["x0"]
+
+    mask = index._filter_mask({"timestamp": {"$eq": 3}}, metadata, columns, len(vectors))
+    assert mask.tolist() == [False, False, False, True]
+    matches = index.query([1, 0], filter={"timestamp": {"$eq": 2}})["matches"]
+    assert sorted(match["id"] for match in matches) == ["y0", "y1", "y2"]
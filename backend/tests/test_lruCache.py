@@ -0,0 +1,58 @@
+import types
+
+import pytest
+
+from modules import lruCache
+from modules.lruCache import LRUCache
+
+@pytest.fixture
+def clock(monkeypatch):
+    # The cache's clock, moved forward by hand
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(lruCache, "time", types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+def test_least_recently_used_entries_are_evicted_first():
+    cache = LRUCache(max_bytes=3, sizeof=len)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.put("c", "3")
+    # Reading a makes b the least recently used
+    assert cache.get("a") == "1"
+    cache.put("d", "4")
+
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["1", "3", "4"]
+    assert cache.stats()["evictions"] == 1
+
+def test_size_cap_counts_bytes_and_replacements():
+    cache = LRUCache(max_bytes=10, sizeof=len)
+    cache.put("a", "xxxx")
+    cache.put("a", "xxxxxx")
+    cache.put("b", "xxxx")
+    assert cache.stats()["bytes"] == 10
+
+    # Bigger than the whole cache, never stored (and nothing is evicted for it)
+    cache.put("c", "x" * 11)
+    assert cache.get("c") is None
+    assert cache.stats()["entries"] == 2
+
+def test_expired_entries_are_handed_back_for_revalidation(clock):
+    cache = LRUCache(max_bytes=100, ttl=60, sizeof=len)
+    cache.put("a", "old")
+
+    clock.now += 61
+    assert cache.lookup("a") == ("old", False)
+    assert cache.get("a") is None
+
+    cache.touch("a")
+    assert cache.lookup("a") == ("old", True)
+    stats = cache.stats()
+    assert (stats["expired"], stats["revalidations"], stats["hits"]) == (2, 1, 1)
+
+def test_removed_entries_free_their_bytes():
+    cache = LRUCache(max_bytes=100, sizeof=len)
+    cache.put("a", "xyz")
+    cache.remove("a")
+    assert cache.lookup("a") == (None, False)
+    assert cache.stats()["bytes"] == 0
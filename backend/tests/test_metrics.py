@@ -0,0 +1,30 @@
+from modules.metrics import (span, startRequest, finishRequest, deferRequest, finishDeferredRequest,
+                             renderMetrics, RequestTimer)
+
+def requestCount(route: str) -> str:
+    lines = [line for line in renderMetrics().splitlines()
+             if line.startswith(f'dbllm_request_seconds_count{{route="{route}"}}')]
+    return lines[0].split()[-1] if lines else "0"
+
+def test_deferred_request_is_recorded_once_when_finished():
+    timer = startRequest()
+    deferRequest("/deferred/", 200)
+    finishRequest("/deferred/", 200)
+    assert requestCount("/deferred/") == "0"
+
+    with span("generation"):
+        pass
+    finishDeferredRequest(timer)
+    finishDeferredRequest(timer)
+    assert requestCount("/deferred/") == "1"
+    assert "generation" in timer.timings()
+
+def test_adopt_only_copies_missing_stages():
+    leader = RequestTimer()
+    leader.record("auth", 1.0)
+    leader.record("generation", 2.0)
+    follower = RequestTimer()
+    follower.record("auth", 0.5)
+
+    follower.adopt(leader)
+    assert follower.timings() == {"auth": 0.5, "generation": 2.0}
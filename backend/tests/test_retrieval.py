@@ -0,0 +1,45 @@
+from modules.retrieval import maximalMarginalRelevance, selectMatches, selectMatchesInRange
+
+def match(match_id: str, score: float, values: list = None) -> dict:
+    return {"id": match_id, "score": score, "metadata": {}, "values": values}
+
+IN_RANGE = [match("1_chunk0", 0.9), match("1_chunk1", 0.8), match("1_chunk2", 0.7), match("2", 0.1)]
+EVERY_DATE = IN_RANGE + [match("3", 0.6), match("4", 0.5)]
+
+def search(searched: list):
+    def search(date_range):
+        searched.append(date_range)
+        return (IN_RANGE if date_range else EVERY_DATE), None
+    return search
+
+def test_widens_when_too_few_distinct_articles_are_good_enough():
+    # Four matches in range, but only one article above the score cutoff
+    searched = []
+    matches = selectMatchesInRange(search(searched), (0, 1), top_k=3, diversity=0)
+    assert searched == [(0, 1), None]
+    assert [m['id'] for m in matches] == ["1_chunk0", "3", "4"]
+
+def test_keeps_the_range_when_it_has_enough_articles():
+    searched = []
+    matches = selectMatchesInRange(search(searched), (0, 1), top_k=1, diversity=0)
+    assert searched == [(0, 1)]
+    assert [m['id'] for m in matches] == ["1_chunk0"]
+
+def test_no_range_searches_once():
+    searched = []
+    selectMatchesInRange(search(searched), None, top_k=5, diversity=0)
+    assert searched == [None]
+
+def test_keyword_only_chunk_is_as_redundant_as_its_article():
+    vector_matches = [match("1", 0.9, [1, 0]), match("3", 0.6, [0, 1]), match("2_chunk0", 0.5, [1, 0]),
+                      match("4", 0.45, [0.6, 0.8])]
+    # Article 2's best chunk only matched on keywords, its other chunk says the same as article 1
+    keyword_matches = [match("2_chunk1", 12.0)]
+    matches = selectMatches(vector_matches, keyword_matches, top_k=2, min_score=0, diversity=0.5)
+    assert [m['id'] for m in matches] == ["1", "3"]
+
+def test_keyword_only_article_is_not_treated_as_unlike_everything():
+    matches = [match("a", 1.0, [1, 0]), match("c", 0.99, [1, 0]), match("keyword", 0.6),
+               match("b", 0.5, [0, 1]), match("f", 0.4, [1, 0])]
+    picked = maximalMarginalRelevance(matches, top_k=2, diversity=0.5)
+    assert [m['id'] for m in picked] == ["a", "b"]
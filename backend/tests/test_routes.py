@@ -0,0 +1,11 @@
+import app
+import asgi
+
+def routes(server) -> set:
+    # HEAD and OPTIONS are added automatically (and differently) by flask and quart
+    return {(rule.rule, method)
+            for rule in server.url_map.iter_rules() if rule.endpoint != "static"
+            for method in rule.methods - {"HEAD", "OPTIONS"}}
+
+def test_flask_and_quart_expose_the_same_routes():
+    assert routes(app.app) == routes(asgi.app)
@@ -0,0 +1,87 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from modules.singleFlight import SingleFlight
+
+def waitForFollowers(flight: SingleFlight, followers: int):
+    while flight.stats()["coalesced"] < followers:
+        time.sleep(0.01)
+
+def test_concurrent_calls_for_a_key_share_one_execution():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fetch(key):
+        calls.append(key)
+        release.wait()
+        return f"value of {key}"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("a", fetch, "a"))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    waitForFollowers(flight, 3)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == ["a"]
+    assert results == ["value of a"] * 4
+    assert flight.stats() == {"executions": 1, "coalesced": 3, "in_flight": 0}
+
+def test_every_waiting_caller_gets_the_error():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fail():
+        release.wait()
+        raise ValueError("wordpress is down")
+
+    errors = []
+    def call():
+        try:
+            flight.do("a", fail)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    waitForFollowers(flight, 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 3
+
+def test_finished_calls_are_not_remembered():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: 1) == 1
+    assert flight.do("a", lambda: 2) == 2
+    assert flight.stats()["executions"] == 2
+
+def test_async_callers_share_a_call_that_survives_their_cancellation():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "value"
+
+    async def main():
+        impatient = asyncio.ensure_future(flight.do_async("a", fetch))
+        patient = asyncio.ensure_future(flight.do_async("a", fetch))
+        await asyncio.sleep(0.01)
+        impatient.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await impatient
+        return await patient
+
+    assert asyncio.run(main()) == "value"
+    assert calls == [1]
+    assert flight.stats()["in_flight"] == 0
@@ -3,18 +3,17 @@ Gets the latest articles that haven't been stored yet (uses last synced time)
 """
 
 import os
-import time
 from datetime import datetime
 from dotenv import load_dotenv
 
-from pinecone.grpc import PineconeGRPC as Pinecone
 import google.generativeai as genai
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-from modules.articleCleaner import clean_all_articles
-from modules.articleFetcher import getLatestArticlesByDate
-from modules.embeddingFuncs import embedArticle
-from modules.embeddingFuncs import embedChunksAsArticle
+from modules.articleFetcher import iterLatestArticlePagesByDate
+from modules.documentStore import DocumentStore
+from modules.embeddingCache import ArticleEmbeddingCache
+from modules.ingestPipeline import IngestPipeline
+from modules.lexicalIndex import LexicalIndex
+from modules.retrieval import createIndexRegistry
 
 print("\n----UPDATING DATABASE----\n")
 
@@ -25,20 +24,35 @@ load_dotenv()
 # Access variables
 GOOGLE_GENAI_API_KEY = os.getenv("GOOGLE_GENAI_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
+DOCUMENT_STORE_PATH = os.getenv("DOCUMENT_STORE_PATH", "./documents.db")
+ARTICLE_EMBEDDING_CACHE_PATH = os.getenv("ARTICLE_EMBEDDING_CACHE_PATH", "./article_embeddings.db")
+# Where vectors are searched: "pinecone" or "local" (an exact in-process index, see modules/localIndex.py)
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "pinecone")
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "./local_index")
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE", "float32")
 
 # Configure the Google Generative AI library
 genai.configure(api_key=GOOGLE_GENAI_API_KEY)
 
-# Configure the Pinecone database
-pc = Pinecone(api_key=PINECONE_API_KEY)
+# Configure the vector database
+index_registry = createIndexRegistry(RETRIEVAL_BACKEND,
+                                     pinecone_api_key=PINECONE_API_KEY,
+                                     local_index_path=LOCAL_INDEX_PATH,
+                                     local_index_dtype=LOCAL_INDEX_DTYPE,
+                                     create_missing=True)
+
+# Local store of cleaned articles, read by the query path
+document_store = DocumentStore(DOCUMENT_STORE_PATH)
+# Keyword (BM25) index of the same text, searched alongside the vectors
+lexical_index = LexicalIndex(DOCUMENT_STORE_PATH)
+# Embeddings of every passage embedded so far, so unchanged articles aren't embedded again
+embedding_cache = ArticleEmbeddingCache(ARTICLE_EMBEDDING_CACHE_PATH)
 
 # Constants used throughout
 DATABASE_INDEX_NAME = "main"
 EMBEDDING_MODEL = "models/text-embedding-004"
-MODEL_MAX_CHUNKS = 9500
-CHUNK_OVERLAP = 200
 
-if DATABASE_INDEX_NAME not in pc.list_indexes().names():
+if not index_registry.is_known(DATABASE_INDEX_NAME):
     print("Invalid index name. Exiting.")
     exit()
 
@@ -71,98 +85,60 @@ except Exception as e:
 
 """ 
 /////////////////////////////////
-//////  Fetch and Clean Articles
+//////  Fetch, Clean, Embed and Upsert Articles
 /////////////////////////////////
 """
-print("Fetching new articles...")
-articles = getLatestArticlesByDate(last_synced_date = last_synced_time)
-
-if len(articles) <= 0:
-    print("No new articles. Exiting.")
-    exit()
-
-print(f"{len(articles)} new articles successfully fetched")
-
-# Clean articles
+# New articles are downloaded, cleaned, embedded and upserted at the same time (see modules/ingestPipeline.py)
+def onPage(page, articles):
+    if articles is None:
+        print(f"Error fetching page {page}.")
+    else:
+        print(f"{len(articles)} new articles successfully fetched from page {page}")
 
-clean_all_articles(articles)
+def onSkipped(reason, article_id):
+    if reason == "missing_content":
+        print(f"\nSkipping article with missing content (ID {article_id})\n")
+    elif reason == "missing_id":
+        print("\nSkipping article with no ID\n")
+    else:
+        print(f"Error generating embedding for article {article_id}.\n")
 
+# Wait for the index to be ready
+index = index_registry.wait_until_ready(DATABASE_INDEX_NAME)
+print("Index connected.")
 
-""" 
-/////////////////////////////////
-//////  Embed Articles
-/////////////////////////////////
-"""
-# Generate embeddings
-embeddings = []
-ARTICLES_LEN = len(articles)
-update_factor = max(1, ARTICLES_LEN // 50)
-
-print(f"Generating embeddings for {ARTICLES_LEN} articles")
-
-for i, article in enumerate(articles):
-    content = article['content']['rendered']
-    article_id = str(article['id'])
-    
-    # Only run if there is both content to embed and an id to associate it with
-    if content and article_id:
-        try:
-            # Embed the article
-            embedArticle(genai, embeddings, EMBEDDING_MODEL, article)
-        
-        # The article may be too big. In that case, try splitting it into chunks
-        except Exception as e:
-            # Split text into chunks of up to 10000
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=(MODEL_MAX_CHUNKS-CHUNK_OVERLAP), chunk_overlap=CHUNK_OVERLAP)
-            texts = text_splitter.split_text(content)
-
-            # Embed the chunks
-            embed_success = embedChunksAsArticle(genai, embeddings, EMBEDDING_MODEL, article, texts)
-
-            if not embed_success:
-                print(f"Error generating embedding for article {article_id}. Could not split into chunks.\n")
-
-    # If the article is missing an id or content, skip it
-    else:
-        if article_id:
-            # No content
-            print(f"\nSkipping article with missing content (ID {article_id}, index {i})\n")
-
-        else:
-            print(f"\nSkipping article with no ID (index {i})\n")
-    
-    # Print a progress bar (updates every {update_factor} articles)
-    if i % update_factor == 0 or i == ARTICLES_LEN-1:
-        # If we finished, set the percent to 100
-        if (i == ARTICLES_LEN-1):
-            percent = 100.0
-        # Otherwise, set percent to the ratio of index of current article and length of articles
-        else:
-            percent = str(round((i+update_factor)*100/ARTICLES_LEN, 2))
-        print(f"\r{'#'*(round((i+update_factor)/update_factor))}{' '*(round( (ARTICLES_LEN-(i+update_factor))/update_factor ))} {percent}%", end='', flush=True)
-
-
-print(f"\nSuccessfully created {len(embeddings)} embeddings")
+pipeline = IngestPipeline(genai=genai,
+                          index=index,
+                          document_store=document_store,
+                          lexical_index=lexical_index,
+                          embedding_model=EMBEDDING_MODEL,
+                          embedding_cache=embedding_cache,
+                          on_page=onPage,
+                          on_skipped=onSkipped,
+                          on_upserted=lambda num_embeddings: print(f"Upserted {num_embeddings} embeddings"))
 
-""" 
-/////////////////////////////////
-//////  Upsert Data
-/////////////////////////////////
-"""
+print("Fetching new articles...")
+stats = pipeline.run(iterLatestArticlePagesByDate(last_synced_date = last_synced_time))
 
-# Wait for the index to be ready
-while not pc.describe_index(DATABASE_INDEX_NAME).status['ready']:
-    print("Waiting for index...")
-    time.sleep(1)
+if stats['failed_page'] is not None:
+    # Leave lastSynced alone so the next run picks up what was missed
+    print("Error fetching new articles. Exiting.")
+    exit()
 
-print("Index connected.")
-index = pc.Index(DATABASE_INDEX_NAME)
+if stats['articles'] <= 0:
+    print("No new articles. Exiting.")
+    exit()
 
-index.upsert(
-    vectors=embeddings
-)
 print("---------------------------------------------------------")
-print(f"\nSuccessfully upserted {len(embeddings)} embeddings.\n")
+print(f"\nSuccessfully upserted {stats['embeddings']} embeddings for {stats['embedded']} of {stats['articles']} new articles "
+      f"in {stats['seconds']} seconds ({stats['chunked']} split into chunks, {stats['skipped']} skipped).\n")
+chunking = stats['chunking']
+if chunking['chunks']:
+    print(f"Chunks: {chunking['chunked_articles']} of {chunking['articles']} articles were too big to embed whole. "
+          f"{chunking['chunks']} passages embedded, {chunking['mean_chunk_bytes']} bytes on average "
+          f"(max {chunking['max_chunk_bytes']} bytes, up to {chunking['max_chunks_per_article']} per article).\n")
+cached = stats['embedding_cache']
+print(f"Embedding cache: {cached['hits']} passages were already embedded, {cached['misses']} sent to gemini.\n")
 print("---------------------------------------------------------")
 
 # Update lastSynced with current time
@@ -0,0 +1,109 @@
+"""
+Fills a (fresh) vector index with every article in the document store, using the embeddings in the
+article embedding cache instead of calling gemini. Articles whose embeddings aren't cached are left
+out and listed at the end (store them again with store.py to embed them)
+"""
+
+import os
+import time
+from dotenv import load_dotenv
+
+from modules.documentStore import DocumentStore
+from modules.embeddingCache import ArticleEmbeddingCache
+from modules.embeddingFuncs import articleVector
+from modules.ingestPipeline import UPSERT_BATCH_SIZE
+from modules.retrieval import createIndexRegistry
+
+print("\n----LOADING ENVIRONMENT VARIABLES----")
+# Load environment variables from .env file
+load_dotenv()
+
+# Access variables
+PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
+DOCUMENT_STORE_PATH = os.getenv("DOCUMENT_STORE_PATH", "./documents.db")
+ARTICLE_EMBEDDING_CACHE_PATH = os.getenv("ARTICLE_EMBEDDING_CACHE_PATH", "./article_embeddings.db")
+# Where vectors are searched: "pinecone" or "local" (an exact in-process index, see modules/localIndex.py)
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "pinecone")
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "./local_index")
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE", "float32")
+
+# Configure the vector database
+index_registry = createIndexRegistry(RETRIEVAL_BACKEND,
+                                     pinecone_api_key=PINECONE_API_KEY,
+                                     local_index_path=LOCAL_INDEX_PATH,
+                                     local_index_dtype=LOCAL_INDEX_DTYPE,
+                                     create_missing=True)
+
+# Cleaned articles (and where their chunks are), saved by store.py/update.py
+document_store = DocumentStore(DOCUMENT_STORE_PATH)
+# Their embeddings, by hash of the exact text embedded
+embedding_cache = ArticleEmbeddingCache(ARTICLE_EMBEDDING_CACHE_PATH)
+
+# Constants used throughout
+DATABASE_INDEX_NAME = str(input("Enter database index name: "))
+# Must be the model the cached embeddings were made with
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+if not index_registry.is_known(DATABASE_INDEX_NAME):
+    print("Invalid index name. Exiting.")
+    exit()
+
+print("----FINISHED LOADING ENVIRONMENT VARIABLES----")
+
+"""
+/////////////////////////////////
+//////  Rebuild Vectors From the Cache and Upsert Them
+/////////////////////////////////
+"""
+# Wait for the index to be ready
+index = index_registry.wait_until_ready(DATABASE_INDEX_NAME)
+print("Index connected.")
+
+t0 = time.time()
+num_articles = 0
+num_upserted = 0
+not_cached = []
+vectors = []
+
+for articles in document_store.iter_articles():
+    chunks = document_store.get_chunks([article['id'] for article in articles])
+
+    # The exact passages that were embedded (an article embedded whole has a single chunk covering all of it)
+    passages = []
+    for article in articles:
+        offsets = chunks.get(article['id']) or [(0, len(article['content']))]
+        passages.append([article['content'][start:end] for start, end in offsets])
+
+    embeddings = iter(embedding_cache.get_many(EMBEDDING_MODEL, [text for texts in passages for text in texts]))
+    for article, texts in zip(articles, passages):
+        num_articles += 1
+        article_embeddings = [next(embeddings) for _ in texts]
+        if any(embedding is None for embedding in article_embeddings):
+            not_cached.append(article['id'])
+            continue
+
+        # Articles stored before the local date was kept only have the GMT one
+        article['date'] = article['date'] or article['date_gmt']
+        if len(texts) == 1:
+            vectors.append(articleVector(article, article_embeddings[0]))
+        else:
+            vectors.extend(articleVector(article, embedding, chunk=i, chunk_total=len(texts))
+                           for i, embedding in enumerate(article_embeddings))
+
+    while len(vectors) >= UPSERT_BATCH_SIZE:
+        index.upsert(vectors=vectors[:UPSERT_BATCH_SIZE])
+        num_upserted += UPSERT_BATCH_SIZE
+        vectors = vectors[UPSERT_BATCH_SIZE:]
+        print(f"Upserted {num_upserted} embeddings")
+
+if vectors:
+    index.upsert(vectors=vectors)
+    num_upserted += len(vectors)
+
+print("---------------------------------------------------------")
+print(f"\nSuccessfully upserted {num_upserted} embeddings for {num_articles - len(not_cached)} of {num_articles} articles "
+      f"in {round(time.time() - t0, 2)} seconds, without any embedding calls.\n")
+if not_cached:
+    print(f"{len(not_cached)} articles have no cached embeddings and were left out (IDs {', '.join(not_cached[:20])}"
+          f"{', ...' if len(not_cached) > 20 else ''}). Store them again with store.py to embed them.\n")
+print("---------------------------------------------------------")
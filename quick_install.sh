@@ -41,6 +41,10 @@ pip install -U "protobuf==5.26.1"
 pip install beautifulsoup4
 pip install flask
 pip install Flask-Cors
+pip install quart
+pip install quart-cors
+pip install httpx
+pip install numpy
 
 echo "All packages have been installed successfully!"
 